@@ -0,0 +1,238 @@
+# Copyright 2020 Petuum, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+This module compresses checkpoint files in independent frames, so that the
+frames are compressed by a pool of threads while earlier frames are written,
+and decompressed in parallel when loaded. The ``zlib`` codec is always
+available, and ``lz4`` and ``zstd`` are available if the ``lz4`` and
+``zstandard`` packages are installed. The codec is not detected from the
+data, it must be recorded when writing and given again when reading, and
+data read with no codec is returned unchanged.
+"""
+
+import concurrent.futures
+import collections
+import io
+import os
+import struct
+import zlib
+
+MAGIC = b"ADLZ"
+FRAME_SIZE = 1024 * 1024
+_FRAME_HEADER = struct.Struct("<II")  # Raw and compressed lengths.
+
+_CODECS = {"zlib": (lambda data: zlib.compress(data, 1), zlib.decompress)}
+
+try:
+    import lz4.frame
+    _CODECS["lz4"] = (lz4.frame.compress, lz4.frame.decompress)
+except ImportError:
+    pass
+
+try:
+    import zstandard
+    # Compressor objects are not thread-safe, so one is created per frame.
+    _CODECS["zstd"] = (
+        lambda data: zstandard.ZstdCompressor(level=3).compress(data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data))
+except ImportError:
+    pass
+
+_POOL = None
+
+
+def codecs():
+    """
+    Returns (list): Names of the codecs which are available.
+    """
+    return sorted(_CODECS)
+
+
+def _pool():
+    # Compression in zlib, lz4 and zstandard releases the GIL.
+    global _POOL
+    if _POOL is None:
+        _POOL = concurrent.futures.ThreadPoolExecutor(
+            min(8, os.cpu_count() or 1), thread_name_prefix="adaptdl-codec")
+    return _POOL
+
+
+def _check(codec):
+    if codec not in _CODECS:
+        raise ValueError("codec '{}' is not available, choose from {}"
+                         .format(codec, codecs()))
+
+
+class CompressedWriter(io.RawIOBase):
+    """
+    Writable file object which compresses everything written to it into the
+    given file object, one frame at a time. Up to two frames per thread are
+    compressed concurrently while the earlier ones are written.
+
+    Arguments:
+        fileobj (BinaryIO): A binary writable file object.
+        codec (str): Name of the codec to compress with.
+
+    Attributes:
+        raw_bytes (int): Number of bytes written so far.
+        stored_bytes (int): Number of compressed bytes written so far.
+    """
+
+    def __init__(self, fileobj, codec):
+        _check(codec)
+        self._fileobj = fileobj
+        self._compress = _CODECS[codec][0]
+        self._buffer = bytearray()
+        self._pending = collections.deque()
+        self._max_pending = 2 * _pool()._max_workers
+        self.raw_bytes = 0
+        name = codec.encode()
+        self.stored_bytes = len(MAGIC) + 1 + len(name)
+        fileobj.write(MAGIC + bytes([len(name)]) + name)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = memoryview(data).cast("B")
+        self._buffer += data
+        self.raw_bytes += len(data)
+        while len(self._buffer) >= FRAME_SIZE:
+            self._submit(bytes(self._buffer[:FRAME_SIZE]))
+            del self._buffer[:FRAME_SIZE]
+        return len(data)
+
+    def _submit(self, frame):
+        self._pending.append((len(frame),
+                              _pool().submit(self._compress, frame)))
+        while len(self._pending) > self._max_pending:
+            self._write_next()
+
+    def _write_next(self):
+        raw_len, future = self._pending.popleft()
+        data = future.result()
+        self._fileobj.write(_FRAME_HEADER.pack(raw_len, len(data)))
+        self._fileobj.write(data)
+        self.stored_bytes += _FRAME_HEADER.size + len(data)
+
+    def close(self):
+        """
+        Writes all remaining frames. Does not close the underlying file.
+        """
+        if not self.closed:
+            if self._buffer:
+                self._submit(bytes(self._buffer))
+                self._buffer = bytearray()
+            while self._pending:
+                self._write_next()
+        super().close()
+
+
+def compress(data, codec):
+    """
+    Returns (bytes): The data compressed like by `CompressedWriter`.
+    """
+    buf = io.BytesIO()
+    with CompressedWriter(buf, codec) as writer:
+        writer.write(data)
+    return buf.getvalue()
+
+
+def decompress(fileobj, codec):
+    """
+    Reads data compressed by `CompressedWriter`, and decompresses its frames
+    in parallel.
+
+    Arguments:
+        fileobj (BinaryIO): A binary readable file object, which is read from
+            its current position.
+        codec (str): Name of the codec the data was compressed with, or
+            ``None`` if it was not compressed.
+
+    Returns:
+        A binary readable file object of the decompressed data, or
+        ``fileobj`` itself if it was not compressed.
+    """
+    if codec is None:
+        return fileobj
+    decompress = _CODECS[_read_header(fileobj, codec)][1]
+    frames = []
+    while True:
+        header = fileobj.read(_FRAME_HEADER.size)
+        if not header:
+            break
+        raw_len, stored_len = _FRAME_HEADER.unpack(header)
+        frames.append(fileobj.read(stored_len))
+    return io.BytesIO(b"".join(_pool().map(decompress, frames)))
+
+
+def _read_header(fileobj, codec):
+    # Checks that the data was compressed with codec, and skips the header.
+    _check(codec)
+    if fileobj.read(len(MAGIC)) != MAGIC or \
+            fileobj.read(fileobj.read(1)[0]).decode() != codec:
+        raise ValueError("data was not compressed with codec '{}'"
+                         .format(codec))
+    return codec
+
+
+def raw_size(fileobj, codec):
+    """
+    Returns (int): The number of bytes `readinto` would read from the
+    current position of ``fileobj``, without decompressing any data.
+    """
+    start = fileobj.tell()
+    if codec is None:
+        size = fileobj.seek(0, io.SEEK_END) - start
+    else:
+        _read_header(fileobj, codec)
+        size = 0
+        header = fileobj.read(_FRAME_HEADER.size)
+        while header:
+            raw_len, stored_len = _FRAME_HEADER.unpack(header)
+            size += raw_len
+            fileobj.seek(stored_len, io.SEEK_CUR)
+            header = fileobj.read(_FRAME_HEADER.size)
+    fileobj.seek(start)
+    return size
+
+
+def readinto(fileobj, buf, codec):
+    """
+    Reads the data from the current position of ``fileobj``, decompressing
+    it if it was compressed by `CompressedWriter` with ``codec``, directly
+    into ``buf`` without an intermediate copy of all of it.
+
+    Returns (int): The number of bytes read.
+    """
+    buf = memoryview(buf).cast("B")
+    if codec is None:
+        offset = 0
+        while offset < len(buf):
+            count = fileobj.readinto(buf[offset:])
+            if not count:
+                break
+            offset += count
+        return offset
+    decompress = _CODECS[_read_header(fileobj, codec)][1]
+    offset = 0
+    header = fileobj.read(_FRAME_HEADER.size)
+    while header:
+        raw_len, stored_len = _FRAME_HEADER.unpack(header)
+        buf[offset:offset + raw_len] = decompress(fileobj.read(stored_len))
+        offset += raw_len
+        header = fileobj.read(_FRAME_HEADER.size)
+    return offset
@@ -0,0 +1,73 @@
+# Copyright 2020 Petuum, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import io
+import os
+import pickle
+
+import pytest
+
+from adaptdl import _compression
+
+
+@pytest.mark.parametrize("codec", _compression.codecs())
+def test_round_trip(codec):
+    # Compressible and incompressible data across several frames.
+    data = b"abc" * _compression.FRAME_SIZE + os.urandom(12345)
+    buf = io.BytesIO()
+    with _compression.CompressedWriter(buf, codec) as writer:
+        for start in range(0, len(data), 100000):
+            writer.write(data[start:start + 100000])
+    assert writer.raw_bytes == len(data)
+    assert writer.stored_bytes == len(buf.getvalue()) < len(data) / 2
+    buf.seek(0)
+    assert _compression.decompress(buf, codec).read() == data
+    assert _compression.decompress(io.BytesIO(
+        _compression.compress(b"", codec)), codec).read() == b""
+
+
+def test_pickle():
+    buf = io.BytesIO()
+    with _compression.CompressedWriter(buf, "zlib") as writer:
+        pickle.dump({"value": list(range(1000))}, writer)
+    buf.seek(0)
+    assert pickle.load(_compression.decompress(buf, "zlib")) == \
+        {"value": list(range(1000))}
+
+
+def test_uncompressed():
+    # Even if it looks like compressed data, it is read back unchanged.
+    data = _compression.compress(b"plain data", "zlib")
+    buf = io.BytesIO(b"x" + data)
+    buf.read(1)
+    assert _compression.decompress(buf, None).read() == data
+    with pytest.raises(ValueError):
+        _compression.decompress(io.BytesIO(b"plain data"), "zlib")
+
+
+def test_unavailable():
+    with pytest.raises(ValueError):
+        _compression.CompressedWriter(io.BytesIO(), "snappy")
+
+
+@pytest.mark.parametrize("codec", [None] + _compression.codecs())
+def test_readinto(codec):
+    data = os.urandom(_compression.FRAME_SIZE + 10)
+    stored = data if codec is None else _compression.compress(data, codec)
+    fileobj = io.BytesIO(stored)
+    assert _compression.raw_size(fileobj, codec) == len(data)
+    buf = bytearray(len(data))
+    assert _compression.readinto(fileobj, buf, codec) == len(data)
+    assert buf == data
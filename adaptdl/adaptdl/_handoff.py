@@ -0,0 +1,278 @@
+# Copyright 2020 Petuum, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Handoff of checkpoints from the replicas before a restart to the replicas
+after it, without reading them back from shared storage when possible.
+
+Each replica also keeps the files it writes into a checkpoint in a folder
+local to its node, given by `adaptdl.env.checkpoint_handoff_path`, such as
+one in ``/dev/shm`` which outlives the replicas on the node. After
+restarting, each replica reads a file of the checkpoint from the folder of
+its node if it is there, otherwise fetches it over HTTP from another replica
+which has it in the folder of its own node, and otherwise reads it from
+shared storage. Checkpoints are still written to shared storage in full,
+since it is not known which nodes will be kept when they are written. The
+files are only served to replicas of the same job, which send a token shared
+through `adaptdl.collective`.
+"""
+
+import functools
+import hashlib
+import hmac
+import http.server
+import logging
+import os
+import secrets
+import shutil
+import socket
+import threading
+import urllib.parse
+import urllib.request
+
+import adaptdl.collective
+from adaptdl.env import (checkpoint_handoff_path, checkpoint_path, job_id,
+                         replica_rank)
+
+logging.basicConfig(level=logging.INFO)
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.INFO)
+
+# Seconds to wait for another replica to respond before reading from shared
+# storage instead.
+_TIMEOUT = 30
+# Header with the token of the job, required to fetch files from a replica.
+_TOKEN_HEADER = "X-AdaptDL-Handoff-Token"
+
+# Serves the files of the checkpoint kept on this node to other replicas.
+_SERVER = None
+# Where to find the files of the checkpoint being loaded.
+_SOURCE = None
+
+
+def local_dir(checkpoint_id=None):
+    """
+    Returns the folder of the current job on this node, or of the checkpoint
+    with the given id in it, or `None` if handoff is disabled.
+    """
+    path = checkpoint_handoff_path()
+    if path is None:
+        return None
+    # Distinguishes jobs sharing the same node, also when run standalone.
+    key = hashlib.sha256("{}:{}".format(
+        job_id() or "", os.path.abspath(checkpoint_path() or "")
+    ).encode()).hexdigest()[:16]
+    path = os.path.join(path, key)
+    if checkpoint_id is not None:
+        path = os.path.join(path, checkpoint_id)
+    return path
+
+
+def prepare(checkpoint_id, subdirs=()):
+    """
+    Creates the folder on this node to keep the checkpoint being written.
+
+    Returns:
+        The folder, or `None` if handoff is disabled.
+    """
+    path = local_dir(checkpoint_id)
+    if path is not None:
+        for subdir in subdirs:
+            os.makedirs(os.path.join(path, subdir), exist_ok=True)
+        os.makedirs(path, exist_ok=True)
+    return path
+
+
+def link(checkpoint_id, name, path):
+    """
+    Hard-links a file kept on this node for an earlier checkpoint to `path`,
+    e.g. a chunk which did not change since.
+
+    Returns:
+        `True` if linked, `False` if no earlier checkpoint has the file.
+    """
+    for other in _other_dirs(checkpoint_id):
+        try:
+            os.link(os.path.join(other, name), path)
+            return True
+        except FileExistsError:
+            return True  # Linked by another replica on this node.
+        except OSError:
+            # Missing, or being removed by another replica on this node.
+            continue
+    return False
+
+
+def clean(*checkpoint_ids):
+    """
+    Removes the checkpoints kept on this node other than the given ones,
+    which should include the last committed checkpoint.
+    """
+    for other in _other_dirs(*checkpoint_ids):
+        shutil.rmtree(other, ignore_errors=True)
+
+
+def _other_dirs(*checkpoint_ids):
+    root = local_dir()
+    if root is None or not os.path.isdir(root):
+        return []
+    return [os.path.join(root, name) for name in sorted(os.listdir(root))
+            if name not in checkpoint_ids]
+
+
+class Source(object):
+    """
+    Finds the files of a checkpoint in the folder of this node, on the other
+    replicas, or in shared storage, in that order.
+    """
+
+    def __init__(self, checkpoint_id, shared_path, peers=(), token=None):
+        self.checkpoint_id = checkpoint_id
+        self._dir = local_dir(checkpoint_id)
+        self._shared_path = shared_path
+        self._token = token
+        # Spread the replicas fetching the same file over its peers.
+        peers = list(peers)
+        if peers:
+            offset = replica_rank() % len(peers)
+            peers = peers[offset:] + peers[:offset]
+        self._peers = peers
+
+    def path(self, name):
+        """
+        Returns a local path to read the file with the given name from,
+        which is fetched from another replica first if needed.
+        """
+        local_path = os.path.join(self._dir, name)
+        if os.path.isfile(local_path):
+            return local_path
+        for url, names in self._peers:
+            if name in names and _fetch(url + urllib.parse.quote(name),
+                                        local_path, self._token):
+                return local_path
+        return self._shared_path(name)
+
+
+def source(checkpoint_id, shared_path):
+    """
+    Returns the `Source` of the checkpoint with the given id. The first time
+    it is invoked after `adaptdl.collective` is initialized, serves the files
+    of the checkpoint kept on this node, and gathers which files every
+    replica has, so it must then be invoked on all replicas.
+
+    Arguments:
+        checkpoint_id (str): Id of the checkpoint, from its manifest.
+        shared_path (callable): Returns the path of a file in shared storage
+            given its name.
+    """
+    global _SOURCE
+    if _SOURCE is not None and _SOURCE[0].checkpoint_id == checkpoint_id \
+            and (_SOURCE[1] or adaptdl.collective._REDUCER is None):
+        return _SOURCE[0]
+    peers, token = [], None
+    if adaptdl.collective._REDUCER is not None:
+        token = adaptdl.collective.broadcast(secrets.token_hex(16))
+        path = local_dir(checkpoint_id)
+        names = _list_files(path)
+        url = _serve(path, token) if names else None
+        found = adaptdl.collective.allreduce({replica_rank(): (url, names)},
+                                             lambda a, b: {**a, **b})
+        peers = [(url, set(names)) for rank, (url, names)
+                 in sorted(found.items()) if url and rank != replica_rank()]
+        LOG.info("Checkpoint %s is kept by %d other replicas", checkpoint_id,
+                 len(peers))
+    _SOURCE = (Source(checkpoint_id, shared_path, peers, token),
+               adaptdl.collective._REDUCER is not None)
+    return _SOURCE[0]
+
+
+def _list_files(path):
+    # Names of the files in a folder and its sub-folders, relative to it.
+    names = []
+    if path is None:
+        return names
+    for dir_path, _, file_names in os.walk(path):
+        rel_path = os.path.relpath(dir_path, path)
+        for file_name in file_names:
+            names.append(os.path.normpath(os.path.join(rel_path, file_name)))
+    return names
+
+
+def _fetch(url, path, token):
+    # Downloads a file to path, returns whether it succeeded.
+    tmp_path = f"{path}.{replica_rank()}"
+    request = urllib.request.Request(url, headers={_TOKEN_HEADER: token})
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with urllib.request.urlopen(request, timeout=_TIMEOUT) as response, \
+                open(tmp_path, "wb") as f:
+            shutil.copyfileobj(response, f, 1 << 20)
+        os.replace(tmp_path, path)
+        return True
+    except OSError as exc:
+        LOG.warning("Could not fetch %s: %s", url, exc)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def __init__(self, *args, directory, token, **kwargs):
+        self.directory = directory
+        self.token = token
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        token = self.headers.get(_TOKEN_HEADER, "")
+        if not hmac.compare_digest(token.encode(), self.token.encode()):
+            self.send_error(403)
+            return
+        name = os.path.normpath(urllib.parse.unquote(
+            self.path.split("?")[0].lstrip("/")))
+        # Only serve files inside the folder of the checkpoint.
+        if name.startswith("..") or os.path.isabs(name):
+            self.send_error(404)
+            return
+        try:
+            f = open(os.path.join(self.directory, name), "rb")
+        except OSError:
+            self.send_error(404)
+            return
+        with f:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length",
+                             str(os.fstat(f.fileno()).st_size))
+            self.end_headers()
+            shutil.copyfileobj(f, self.wfile, 1 << 20)
+
+    def log_message(self, format, *args):
+        LOG.debug("%s - %s", self.address_string(), format % args)
+
+
+def _serve(path, token):
+    # Serves the files in path to requests with the token until the process
+    # exits, returns the URL. Only listens on the address of the pod or node.
+    global _SERVER
+    if _SERVER is not None:
+        _SERVER.shutdown()
+        _SERVER.server_close()
+    host = socket.gethostbyname(socket.gethostname())
+    _SERVER = http.server.ThreadingHTTPServer(
+        (host, 0), functools.partial(_Handler, directory=path, token=token))
+    _SERVER.daemon_threads = True
+    threading.Thread(target=_SERVER.serve_forever, daemon=True,
+                     name="adaptdl-handoff").start()
+    return f"http://{host}:{_SERVER.server_address[1]}/"
@@ -0,0 +1,163 @@
+# Copyright 2020 Petuum, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+This module contains a mergeable streaming quantile sketch with bounded memory
+and relative-error guarantees, based on DDSketch (Masson et al., VLDB 2019).
+Sketches can be reduced across replicas with `adaptdl.collective.allreduce`
+using the default reduce function, which adds them together.
+"""
+
+import math
+
+
+class QuantileSketch(object):
+    """
+    Streaming sketch of a distribution of positive values. Values are counted
+    in logarithmically-sized buckets so that every quantile is estimated with
+    a relative error of at most `rel_acc`. If more than `max_buckets` buckets
+    are needed, the lowest buckets are collapsed together, which only affects
+    the accuracy of the lowest quantiles.
+
+    Arguments:
+        rel_acc (float): Relative accuracy of the quantile estimates.
+        max_buckets (int): Maximum number of buckets kept in memory.
+    """
+
+    def __init__(self, rel_acc=0.01, max_buckets=512):
+        self._gamma = (1 + rel_acc) / (1 - rel_acc)
+        self._log_gamma = math.log(self._gamma)
+        self._max_buckets = max_buckets
+        self._buckets = {}  # Bucket index -> count.
+        self._zero_count = 0  # Values too small to be bucketed.
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value, count=1):
+        """
+        Adds a value to the sketch.
+
+        Arguments:
+            value (float): The value to add, non-positive values are counted
+                as zero.
+            count (int): Number of times to add the value.
+        """
+        self.count += count
+        self.sum += value * count
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if value <= 1e-12:
+            self._zero_count += count
+            return
+        index = math.ceil(math.log(value) / self._log_gamma)
+        self._buckets[index] = self._buckets.get(index, 0) + count
+        self._collapse()
+
+    def _collapse(self):
+        if len(self._buckets) <= self._max_buckets:
+            return
+        indices = sorted(self._buckets)
+        excess = len(indices) - self._max_buckets
+        target = indices[excess]
+        for index in indices[:excess]:
+            self._buckets[target] += self._buckets.pop(index)
+
+    def _value(self, index):
+        # Representative value of a bucket, within rel_acc of all its values.
+        return 2 * self._gamma ** index / (self._gamma + 1)
+
+    def __iadd__(self, other):
+        if not math.isclose(self._gamma, other._gamma):
+            raise ValueError("cannot merge sketches of different accuracy")
+        for index, count in other._buckets.items():
+            self._buckets[index] = self._buckets.get(index, 0) + count
+        self._zero_count += other._zero_count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._collapse()
+        return self
+
+    def __add__(self, other):
+        ret = self.copy()
+        ret += other
+        return ret
+
+    def copy(self):
+        ret = QuantileSketch.__new__(QuantileSketch)
+        ret.__dict__.update(self.__dict__)
+        ret._buckets = dict(self._buckets)
+        return ret
+
+    def __len__(self):
+        return self.count
+
+    def mean(self):
+        """
+        Returns (float): Exact mean of all values added to the sketch.
+        """
+        return self.sum / self.count if self.count else math.nan
+
+    def quantile(self, q):
+        """
+        Estimates a quantile of the values added to the sketch.
+
+        Arguments:
+            q (float): Quantile to estimate, between 0 and 1.
+
+        Returns (float): Estimated quantile, or NaN if the sketch is empty.
+        """
+        if not self.count:
+            return math.nan
+        rank = q * (self.count - 1)
+        if rank < self._zero_count:
+            return 0.0
+        seen = self._zero_count
+        for index in sorted(self._buckets):
+            seen += self._buckets[index]
+            if seen > rank:
+                return min(max(self._value(index), self.min), self.max)
+        return self.max
+
+    def trimmed_mean(self, lower=0.1, upper=0.9):
+        """
+        Estimates the mean of the values between two quantiles, which is
+        robust to outliers such as occasional stalls.
+
+        Arguments:
+            lower (float): Lower quantile of the values to include.
+            upper (float): Upper quantile of the values to include.
+
+        Returns (float): Estimated trimmed mean, or NaN if the sketch is empty.
+        """
+        if not self.count:
+            return math.nan
+        lo, hi = lower * self.count, upper * self.count
+        if hi <= lo:
+            return self.quantile(lower)
+        total = 0.0  # Zero values contribute nothing to the total.
+        seen = self._zero_count
+        for index in sorted(self._buckets):
+            count = self._buckets[index]
+            # Portion of this bucket which lies between the two quantiles.
+            overlap = min(seen + count, hi) - max(seen, lo)
+            if overlap > 0:
+                value = min(max(self._value(index), self.min), self.max)
+                total += overlap * value
+            seen += count
+        return total / (hi - lo)
@@ -0,0 +1,74 @@
+# Copyright 2020 Petuum, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import pickle
+
+import numpy as np
+import pytest
+
+from adaptdl._sketch import QuantileSketch
+
+
+@pytest.mark.parametrize("q", [0.1, 0.5, 0.9, 0.99])
+def test_quantile(q):
+    rng = np.random.RandomState(0)
+    values = rng.lognormal(-2.0, 1.0, 10000)
+    sketch = QuantileSketch(rel_acc=0.01)
+    for value in values:
+        sketch.add(value)
+    assert len(sketch) == len(values)
+    assert np.isclose(sketch.mean(), np.mean(values))
+    assert np.isclose(sketch.quantile(q), np.quantile(values, q), rtol=0.02)
+
+
+def test_trimmed_mean():
+    # Steady step times with a few long stalls.
+    values = [0.1] * 95 + [30.0] * 5
+    sketch = QuantileSketch()
+    for value in values:
+        sketch.add(value)
+    assert sketch.mean() > 1.0
+    assert np.isclose(sketch.trimmed_mean(0.1, 0.9), 0.1, rtol=0.01)
+    assert np.isclose(sketch.quantile(0.5), 0.1, rtol=0.01)
+
+
+def test_merge():
+    rng = np.random.RandomState(0)
+    values = rng.uniform(0.5, 2.0, 1000)
+    sketch1, sketch2 = QuantileSketch(), QuantileSketch()
+    for value in values[:300]:
+        sketch1.add(value)
+    for value in values[300:]:
+        sketch2.add(value)
+    merged = sketch1 + sketch2
+    assert len(sketch1) == 300  # Not modified.
+    sketch1 += sketch2
+    for sketch in (merged, pickle.loads(pickle.dumps(sketch1))):
+        assert len(sketch) == 1000
+        assert sketch.min == values.min() and sketch.max == values.max()
+        assert np.isclose(sketch.quantile(0.5), np.median(values), rtol=0.02)
+    with pytest.raises(ValueError):
+        sketch1 += QuantileSketch(rel_acc=0.05)
+
+
+def test_bounded():
+    sketch = QuantileSketch(rel_acc=0.01, max_buckets=64)
+    values = np.geomspace(1e-4, 1e4, 10000)
+    for value in values:
+        sketch.add(value)
+    assert len(sketch._buckets) <= 64
+    # Only the lowest quantiles lose accuracy.
+    assert np.isclose(sketch.quantile(0.99), np.quantile(values, 0.99),
+                      rtol=0.02)
@@ -18,25 +18,69 @@ This module provides functionality to Save and load arbitrary state as part of
 checkpoint-restart elasticity. The `State` class can be subclassed to define
 how to save/load any state to/from persistent storage, so it can be restored
 after the current job restarts and resumed from where it left off.
+
+Checkpoints are taken in two phases. Each `State` is first copied in memory
+on the training thread, and the copies are then written to persistent
+storage by a background thread, so that training can continue meanwhile.
+Large states may also be split into shards which are written by all replicas
+in parallel, and listed in a manifest written by the replica of rank 0.
+Tensors can be written into a store of chunks addressed by their hashes,
+which is shared by all checkpoints, so that unchanged tensors are not written
+again. Chunks which are not referenced by any checkpoint are removed. The
+files and chunks of each `State` can be compressed, see
+:mod:`adaptdl._compression`. Checkpoints can also be kept on each node to be
+handed off to the replicas after restarting, see :mod:`adaptdl._handoff`.
 """
 
+import collections
+import concurrent.futures
+import functools
+import hashlib
+import io
+import json
+import mmap
 import os
 import shutil
 import logging
+import threading
+import time
 
-from adaptdl.env import checkpoint_path, replica_rank, num_restarts, from_ray
+import adaptdl.collective
+import adaptdl.trace
+from adaptdl import _compression, _handoff
+from adaptdl.env import (checkpoint_path, checkpoint_compression,
+                         replica_rank, num_replicas, num_restarts, from_ray)
 
 logging.basicConfig(level=logging.INFO)
 LOG = logging.getLogger(__name__)
 LOG.setLevel(logging.INFO)
 
 CKPT_DIR_PREFIX = "checkpoint-"
+MANIFEST_NAME = "_manifest"
+CHUNKS_DIR = "_chunks"
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# Seconds the replica of rank 0 waits for the others to write their shards.
+_SHARD_TIMEOUT = 600
 
 # FIXME: Keeping global state like this will result in memory leaks for
 # applications which do not restart too often.
 _STATES_TO_NAMES = {}
 _NAMES_TO_STATES = {}
 
+# Background thread writing the last checkpoint, and the exception it raised.
+_WRITER = None
+_WRITER_ERROR = None
+_NUM_SAVES = 0
+# Chunks referenced by the checkpoint being written by this replica.
+_CHUNKS = None
+# Whether the states being synced will be saved with their shards.
+_SAVING_SHARDS = False
+# Whether the checkpoint folder is shared by all replicas, checked once.
+_SHARED = None
+# Id of the last checkpoint committed or loaded, known by rank 0.
+_COMMITTED_ID = None
+
 
 class State(object):
     """
@@ -45,7 +89,7 @@ class State(object):
     Should be sub-classed to define custom save, load, and sync logic.
     """
 
-    def __init__(self, name):
+    def __init__(self, name, compression=None):
         """
         Initialize the state object with a unique identifier `name`, which is
         used to refer to the saved object in persistent storage. No two `State`
@@ -53,12 +97,21 @@ class State(object):
 
         Arguments:
             name (str): Unique name of this `State` object.
+            compression (str): Codec to compress the saved state with, such
+                as "zlib", "lz4" or "zstd". Defaults to
+                `adaptdl.env.checkpoint_compression`. Can also be changed
+                later through the `compression` attribute.
 
         Raises:
-            ValueError: If a `State` object with the given name already exists.
+            ValueError: If a `State` object with the given name already
+                exists, or the codec is not available.
         """
         if name in _NAMES_TO_STATES:
             raise ValueError("State '{}' already exists".format(name))
+        if compression is not None and \
+                compression not in _compression.codecs():
+            raise ValueError("codec '{}' is not available".format(compression))
+        self.compression = compression
         _NAMES_TO_STATES[name] = self
         _STATES_TO_NAMES[self] = name
 
@@ -80,7 +133,9 @@ class State(object):
         storage.
 
         Arguments:
-            fileobj (BinaryIO): A binary readable file object.
+            fileobj (BinaryIO): A binary readable file object. Unless the
+                state was compressed, it is the saved file itself, and its
+                `name` may be used to memory-map it.
         """
         pass
 
@@ -89,10 +144,239 @@ class State(object):
         This method should be overridden by subclasses to define how the state
         is synchronized across replicas. This might be necessary to make sure
         the state is consistent before saving it to persistent storage. Is
-        invoked by `save_state` before saving the state.
+        invoked by `save_state` before saving the state. If `saving_shards`
+        returns `True`, the state saved in shards need not be gathered.
         """
         pass
 
+    def snapshot(self):
+        """
+        This method may be overridden by subclasses to define how the state
+        is copied for `save_all_states`, which writes the copy from a
+        background thread while training continues. Is invoked on the replica
+        of rank 0 only, after `State.sync`. The default copies the state by
+        saving it into memory with `State.save`.
+
+        Returns:
+            A callable which writes the copied state into a binary writable
+            file object, and must not refer to any state which may be changed
+            by training.
+        """
+        buf = io.BytesIO()
+        self.save(buf)
+        data = buf.getvalue()
+        return lambda fileobj: fileobj.write(data)
+
+    def snapshot_shards(self):
+        """
+        This method may be overridden by subclasses with large state, such as
+        model and optimizer tensors, to split it into shards which are written
+        by all replicas in parallel. Is invoked by `save_all_states` on all
+        replicas, after `State.sync` and before `State.snapshot`. The default
+        returns no shards, so that the state is only written by `State.save`.
+
+        Returns:
+            A dict from names of shards, which must be unique across all
+            replicas, to callables like the one returned by `State.snapshot`.
+        """
+        return {}
+
+    def load_sharded(self, fileobj, shards):
+        """
+        This method should be overridden by subclasses which override
+        `State.snapshot_shards`, to define how the state is loaded from its
+        shards. Is invoked by `load_state` instead of `State.load` if the
+        state was saved with shards. The default ignores the shards.
+
+        Arguments:
+            fileobj (BinaryIO): A binary readable file object of the state
+                written by the replica of rank 0, or `None`.
+            shards (Shards): The shards written by all replicas.
+        """
+        if fileobj is not None:
+            self.load(fileobj)
+
+
+class Shards(object):
+    """
+    The shards of a `State` in a checkpoint, which are read only when needed.
+
+    Attributes:
+        names (list): Names of all the shards saved.
+        num_replicas (int): Number of replicas which saved the checkpoint.
+    """
+
+    def __init__(self, ckpt_dir, name, names, num_replicas, source=None,
+                 codec=None):
+        self._ckpt_dir = ckpt_dir
+        self._name = name
+        self._source = source
+        # Codec the shards were compressed with, recorded in the manifest.
+        self._codec = codec
+        self.names = list(names)
+        self.num_replicas = num_replicas
+
+    def _path(self, name):
+        if self._source is not None:
+            return self._source.path(name)
+        return _shared_path(self._ckpt_dir, name)
+
+    def read(self, names):
+        """
+        Reads the given shards in parallel.
+
+        Arguments:
+            names (list): Names of the shards to read.
+
+        Returns:
+            A dict from each name to a binary readable file object.
+        """
+        def read(name):
+            with open(self._path(f"{self._name}.{name}"), "rb") as f:
+                return _compression.decompress(io.BytesIO(f.read()),
+                                               self._codec)
+
+        names = list(names)
+        if len(names) <= 1:
+            return {name: read(name) for name in names}
+        with concurrent.futures.ThreadPoolExecutor(len(names)) as executor:
+            return dict(zip(names, executor.map(read, names)))
+
+    def read_chunks(self, chunks):
+        """
+        Reads data written by `write_chunks`. Data in a single chunk which is
+        not compressed is memory-mapped copy-on-write, so that it is only
+        read from storage when accessed. Otherwise, the chunks are read in
+        parallel directly into one buffer.
+
+        Arguments:
+            chunks (list): Names of the chunks returned by `write_chunks`.
+
+        Returns:
+            A writable bytes-like object of the data.
+        """
+        def open_chunk(index):
+            return open(self._path(os.path.join(CHUNKS_DIR, chunks[index])),
+                        "rb")
+
+        if not chunks:
+            return bytearray()
+        with open_chunk(-1) as f:
+            codec = _chunk_codec(chunks[-1])
+            if len(chunks) == 1 and codec is None and \
+                    os.fstat(f.fileno()).st_size:
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+            # Every chunk except the last one has CHUNK_SIZE bytes.
+            data = bytearray(CHUNK_SIZE * (len(chunks) - 1) +
+                             _compression.raw_size(f, codec))
+        view = memoryview(data)
+
+        def read(index):
+            with open_chunk(index) as f:
+                _compression.readinto(
+                    f, view[index * CHUNK_SIZE:(index + 1) * CHUNK_SIZE],
+                    _chunk_codec(chunks[index]))
+
+        if len(chunks) == 1:
+            read(0)
+        else:
+            with concurrent.futures.ThreadPoolExecutor(
+                    min(len(chunks), 16)) as executor:
+                list(executor.map(read, range(len(chunks))))
+        return data
+
+
+class _Chunks(object):
+    # Chunk store of the checkpoints in a folder, and the chunks referenced
+    # by the checkpoint being written.
+    def __init__(self, checkpoint_dir, local_dir=None):
+        self.dir = os.path.join(checkpoint_dir, CHUNKS_DIR)
+        os.makedirs(self.dir, exist_ok=True)
+        # Folder on this node the checkpoint is also kept in, for handoff.
+        self.local_dir = local_dir
+        self.refs = set()
+        self.num_bytes = 0
+        self.written_bytes = 0
+        # Codec and [raw bytes, stored bytes] of the state being written.
+        self.codec = None
+        self.sizes = [0, 0]
+
+
+def write_chunks(data):
+    """
+    Writes data, such as the contents of a tensor, into the chunk store of
+    the checkpoint folder. The data is split into chunks of `CHUNK_SIZE`
+    bytes, which are addressed by their hashes, and only the chunks which are
+    not already in the store, e.g. from unchanged tensors in a previous
+    checkpoint, are written. May only be invoked by the callables returned by
+    `State.snapshot` and `State.snapshot_shards`.
+
+    Arguments:
+        data (bytes-like): Data to write.
+
+    Returns:
+        A list of the names of the chunks, to read with `Shards.read_chunks`.
+        Each name is the hash of the chunk, followed by the codec it was
+        compressed with, if any.
+    """
+    if _CHUNKS is None:
+        raise RuntimeError("no checkpoint is being written")
+    data = memoryview(data).cast("B")
+    chunks = []
+    for start in range(0, len(data), CHUNK_SIZE):
+        chunk = data[start:start + CHUNK_SIZE]
+        digest = hashlib.sha256(chunk).hexdigest()
+        if _CHUNKS.codec is not None:
+            digest = f"{digest}.{_CHUNKS.codec}"
+        path = os.path.join(_CHUNKS.dir, digest)
+        stored = local_path = None
+        if _CHUNKS.local_dir is not None:
+            # Unchanged chunks are linked from the previous checkpoint kept.
+            name = os.path.join(CHUNKS_DIR, digest)
+            local_path = os.path.join(_CHUNKS.local_dir, name)
+            if not os.path.exists(local_path) and not _handoff.link(
+                    os.path.basename(_CHUNKS.local_dir), name, local_path):
+                stored = _compress_chunk(chunk)
+                _replace_file(local_path, lambda f: f.write(stored))
+        if digest not in _CHUNKS.refs and not os.path.exists(path):
+            if stored is None and local_path is not None:
+                with open(local_path, "rb") as f:
+                    stored = f.read()
+            elif stored is None:
+                stored = _compress_chunk(chunk)
+            _replace_file(path, lambda f: f.write(stored))
+            _CHUNKS.written_bytes += len(chunk)
+            _CHUNKS.sizes[0] += len(chunk)
+            _CHUNKS.sizes[1] += len(stored)
+        _CHUNKS.refs.add(digest)
+        _CHUNKS.num_bytes += len(chunk)
+        chunks.append(digest)
+    return chunks
+
+
+def _chunk_codec(chunk):
+    # Codec a chunk was compressed with, given its name.
+    return chunk.partition(".")[2] or None
+
+
+def _compress_chunk(chunk):
+    if _CHUNKS.codec is None:
+        return chunk
+    return _compression.compress(chunk, _CHUNKS.codec)
+
+
+def saving_shards():
+    """
+    Whether the states are being saved by `save_all_states` together with
+    the shards returned by `State.snapshot_shards`, which are written by all
+    replicas. May be invoked by `State.sync`, e.g. to skip gathering state
+    to the replica of rank 0 which is saved in shards instead.
+
+    Returns:
+        `True` if shards are being saved, `False` otherwise.
+    """
+    return _SAVING_SHARDS
+
 
 def _get_tmp_ckpt_dir(checkpoint_path):
     if checkpoint_path is None:
@@ -103,12 +387,26 @@ def _get_tmp_ckpt_dir(checkpoint_path):
     return tmp_dir
 
 
-def save_all_states():
+def save_all_states(blocking=True):
     """
-    Invokes `save_state` on all `State` objects for which `State.skip` is True.
-    This function can be used to trigger a global checkpoint and save every
-    `State` in the current job.
+    Saves every `State` object in the current job. First invokes `State.sync`
+    and `State.snapshot_shards` on all replicas, and `State.snapshot` on the
+    replica of rank 0. Then, each replica writes its snapshots from a
+    background thread into a temporary folder, and the replica of rank 0
+    writes a manifest of all shards and renames the folder to the checkpoint
+    folder of the current restart after all replicas are done. Waits for any
+    checkpoint still being written first.
+
+    Arguments:
+        blocking (bool): Whether to wait until the checkpoint is written.
+            Otherwise, returns as soon as the snapshots are taken, and
+            `wait_for_checkpoint` should be invoked before exiting.
+
+    Returns:
+        The checkpoint folder on the replica of rank 0, `None` otherwise.
     """
+    global _WRITER, _NUM_SAVES, _SAVING_SHARDS
+    wait_for_checkpoint()
     if from_ray():
         from ray.tune.trainable import TrainableUtil
         checkpoint_dir = TrainableUtil.make_checkpoint_dir("/tmp",
@@ -116,21 +414,288 @@ def save_all_states():
                                                            override=True)
     else:
         checkpoint_dir = checkpoint_path()
-    for state in _STATES_TO_NAMES:
-        save_state(state, checkpoint_dir)
+    # Shards are written by all replicas into the same folder, and gathered
+    # by a collective, so only if the folder is shared by all replicas.
+    sharded = checkpoint_dir is not None and not from_ray() and \
+        adaptdl.collective._REDUCER is not None and \
+        _is_shared(checkpoint_dir)
+    rank = replica_rank()
+    start = time.time()
+    # File name -> (state name, codec, callable writing the file).
+    files, shard_names = {}, {}
+    for state, name in list(_STATES_TO_NAMES.items()):
+        codec = state.compression or checkpoint_compression()
+        if codec is not None and codec not in _compression.codecs():
+            raise ValueError("codec '{}' is not available".format(codec))
+        _SAVING_SHARDS = sharded
+        try:
+            state.sync()
+        finally:
+            _SAVING_SHARDS = False
+        if sharded:
+            for shard, write in state.snapshot_shards().items():
+                files[f"{name}.{shard}"] = (name, codec, write)
+                shard_names.setdefault(name, []).append(shard)
+        if rank == 0 and checkpoint_dir is not None:
+            files[name] = (name, codec, state.snapshot())
+    writers = {rank: shard_names}
+    # Identifies the checkpoint, e.g. to find the copies kept for handoff.
+    # Random since restarts are counted from 0 again in a new standalone run.
+    ids = (f"{num_restarts()}-{_NUM_SAVES}-{os.urandom(4).hex()}",
+           _COMMITTED_ID)
+    if sharded:
+        # Also keeps other replicas from writing into the temporary folder
+        # until rank 0 has renamed the previous checkpoint, so the last
+        # committed checkpoint is known.
+        writers, ids = adaptdl.collective.allreduce(
+            (writers, ids if rank == 0 else None),
+            lambda a, b: ({**a[0], **b[0]}, a[1] or b[1]))
+    manifest = {"num_replicas": num_replicas(), "shards": {},
+                "writers": sorted(r for r in writers if writers[r]),
+                "codecs": {name: codec for name, codec, _ in files.values()}}
+    for names in writers.values():
+        for name, shard in names.items():
+            manifest["shards"].setdefault(name, []).extend(shard)
+    manifest["id"] = ids[0]
+    snapshot_time = time.time() - start
+    _record_times(snapshot_time=snapshot_time)
+    marker = f"_done-{manifest['id']}-"
+    _NUM_SAVES += 1
+    if checkpoint_dir is None or not (rank == 0 or shard_names):
+        return None
+    _WRITER = threading.Thread(target=_write_checkpoint,
+                               args=(checkpoint_dir, files, manifest,
+                                     marker, ids[1]),
+                               name="adaptdl-checkpoint")
+    _WRITER.start()
+    if blocking:
+        wait_for_checkpoint()
+    return checkpoint_dir if rank == 0 else None
+
+
+def _is_shared(checkpoint_dir):
+    # Whether every replica sees a file written by the replica of rank 0,
+    # otherwise the folder is local to each node, e.g. in standalone runs.
+    global _SHARED
+    if _SHARED is None:
+        path = os.path.join(checkpoint_dir, f"_probe-{num_restarts()}")
+        token = None
+        if replica_rank() == 0:
+            os.makedirs(checkpoint_dir, exist_ok=True)
+            token = os.urandom(16).hex()
+            _write_file(path, lambda f: f.write(token.encode()))
+        token = adaptdl.collective.broadcast(token)
+        deadline = time.time() + 2.0
+        while True:
+            try:
+                with open(path, "rb") as f:
+                    found = f.read().decode() == token
+                break
+            except FileNotFoundError:
+                found = False
+                if time.time() > deadline:
+                    break
+                time.sleep(0.05)
+        _SHARED = adaptdl.collective.allreduce(found, lambda a, b: a and b)
+        if replica_rank() == 0:
+            os.remove(path)
+        if not _SHARED:
+            LOG.warning("Checkpoint path %s is not shared by all replicas, "
+                        "only the replica of rank 0 writes checkpoints",
+                        checkpoint_dir)
+    return _SHARED
+
+
+def wait_for_checkpoint():
+    """
+    Waits until the checkpoint being written in the background by
+    `save_all_states`, if any, is complete. Should be invoked before the
+    process exits, so that the checkpoint is not lost or left incomplete.
 
-    # Prevent corrupting original state files in case the process got killed
-    # during state file writing.
-    if replica_rank() == 0 and checkpoint_dir is not None:
-        tmp_ckpt_dir = _get_tmp_ckpt_dir(checkpoint_dir)
+    Raises:
+        Exception: Any exception raised while writing the checkpoint.
+    """
+    global _WRITER, _WRITER_ERROR
+    if _WRITER is not None:
+        _WRITER.join()
+        _WRITER = None
+    if _WRITER_ERROR is not None:
+        error, _WRITER_ERROR = _WRITER_ERROR, None
+        raise error
+
+
+def _write_file(path, write, codec=None):
+    # Returns the number of bytes written, before and after compression.
+    with open(path, "wb") as f:
+        if codec is None:
+            write(f)
+            raw_bytes = f.tell()
+        else:
+            with _compression.CompressedWriter(f, codec) as writer:
+                write(writer)
+            raw_bytes = writer.raw_bytes
+        f.flush()
+        os.fsync(f.fileno())
+        return raw_bytes, f.tell()
+
+
+def _replace_file(path, write, codec=None):
+    # Writes the file under a temporary name first, since another replica
+    # may be writing the same file.
+    tmp_path = f"{path}.{replica_rank()}"
+    sizes = _write_file(tmp_path, write, codec)
+    os.replace(tmp_path, path)
+    return sizes
+
+
+def _write_kept(path, local_path, write, codec=None):
+    # Writes the file into the folder kept on this node first, if any, and
+    # copies it from there into shared storage.
+    if local_path is None:
+        return _write_file(path, write, codec)
+    sizes = _replace_file(local_path, write, codec)
+    with open(local_path, "rb") as src:
+        _write_file(path, lambda f: shutil.copyfileobj(src, f, 1 << 20))
+    return sizes
+
+
+def _write_checkpoint(checkpoint_dir, files, manifest, marker,
+                      committed_id):
+    global _WRITER_ERROR, _CHUNKS, _COMMITTED_ID
+    rank = replica_rank()
+    tmp_ckpt_dir = _get_tmp_ckpt_dir(checkpoint_dir)
+    start = time.time()
+    local_dir = None
+    try:
+        if not from_ray():
+            local_dir = _handoff.prepare(manifest["id"], [CHUNKS_DIR])
+        _CHUNKS = _Chunks(checkpoint_dir, local_dir)
+        # State name -> [raw bytes, stored bytes, seconds] written.
+        report = collections.defaultdict(lambda: [0, 0, 0.0])
+        for file_name, (name, codec, write) in files.items():
+            file_start = time.time()
+            _CHUNKS.codec, _CHUNKS.sizes = codec, report[name]
+            sizes = _write_kept(
+                os.path.join(tmp_ckpt_dir, file_name),
+                local_dir and os.path.join(local_dir, file_name),
+                write, codec)
+            report[name][0] += sizes[0]
+            report[name][1] += sizes[1]
+            report[name][2] += time.time() - file_start
+        _report(report, files)
+    except BaseException as exc:
+        _WRITER_ERROR = exc
+    chunks, _CHUNKS = _CHUNKS, None
+    if rank != 0:
+        # Tell rank 0 that the shards of this replica are done.
+        done = {"error": None if _WRITER_ERROR is None
+                else repr(_WRITER_ERROR)}
+        if chunks is not None:
+            done.update(chunks=sorted(chunks.refs),
+                        num_bytes=chunks.num_bytes,
+                        written_bytes=chunks.written_bytes)
+        _write_file(os.path.join(tmp_ckpt_dir, f"{marker}{rank}"),
+                    lambda f: f.write(json.dumps(done).encode()))
+        if local_dir is not None:
+            # Kept until this checkpoint is committed in its place.
+            _handoff.clean(manifest["id"], committed_id)
+        return
+    try:
+        if _WRITER_ERROR is not None:
+            return
+        done = [{"chunks": chunks.refs, "num_bytes": chunks.num_bytes,
+                 "written_bytes": chunks.written_bytes}]
+        done.extend(_wait_for_shards(tmp_ckpt_dir, manifest["writers"],
+                                     marker))
+        manifest["chunks"] = sorted(set().union(*(d["chunks"]
+                                                  for d in done)))
+        _write_file(os.path.join(tmp_ckpt_dir, MANIFEST_NAME),
+                    lambda f: f.write(json.dumps(manifest).encode()))
+        # Prevent corrupting original state files in case the process got
+        # killed during state file writing.
         ckpt_dir = os.path.join(checkpoint_dir,
                                 f"{CKPT_DIR_PREFIX}{num_restarts()}")
+        if os.path.exists(ckpt_dir):
+            # Saved before in the same restart, rename cannot replace it.
+            os.rename(ckpt_dir, os.path.join(checkpoint_dir, "_old"))
         os.rename(tmp_ckpt_dir, ckpt_dir)  # atomic, rename(src, dst)
         for dir_name in os.listdir(checkpoint_dir):
             dir_path = os.path.join(checkpoint_dir, dir_name)
-            if dir_name.startswith(CKPT_DIR_PREFIX) and dir_path != ckpt_dir:
+            if (dir_name.startswith(CKPT_DIR_PREFIX) or dir_name == "_old") \
+                    and dir_path != ckpt_dir:
                 shutil.rmtree(dir_path)
-        return checkpoint_dir
+        _COMMITTED_ID = manifest["id"]
+        if local_dir is not None:
+            _handoff.clean(manifest["id"])
+        _collect_chunks(checkpoint_dir)
+        _record_times(write_time=time.time() - start,
+                      chunk_bytes=sum(d["num_bytes"] for d in done),
+                      written_bytes=sum(d["written_bytes"] for d in done))
+    except BaseException as exc:
+        _WRITER_ERROR = exc
+
+
+def _wait_for_shards(tmp_ckpt_dir, writers, marker):
+    # Returns what each of the other replicas reported when done.
+    deadline = time.time() + _SHARD_TIMEOUT
+    done = []
+    for rank in writers:
+        if rank == 0:
+            continue
+        path = os.path.join(tmp_ckpt_dir, f"{marker}{rank}")
+        while not os.path.exists(path):
+            if time.time() > deadline:
+                raise TimeoutError(f"replica {rank} did not write its "
+                                   "checkpoint shards in time")
+            time.sleep(0.05)
+        with open(path, "rb") as f:
+            done.append(json.loads(f.read()))
+        os.remove(path)
+        if done[-1]["error"] is not None:
+            raise RuntimeError(f"replica {rank} failed to write its "
+                               f"checkpoint shards: {done[-1]['error']}")
+    return done
+
+
+def _report(report, files):
+    # Logs how well each state was compressed, and how fast it was written.
+    from adaptdl.torch import _exporter
+    codecs = {name: codec for name, codec, _ in files.values()}
+    for name, (raw_bytes, stored_bytes, seconds) in report.items():
+        _exporter.CHECKPOINT_BYTES_RAW.inc(raw_bytes)
+        _exporter.CHECKPOINT_BYTES_STORED.inc(stored_bytes)
+        LOG.info("State %s: wrote %d bytes as %d (%s, ratio %.2f) at "
+                 "%.1f MB/s", name, raw_bytes, stored_bytes, codecs[name],
+                 raw_bytes / max(stored_bytes, 1),
+                 raw_bytes / max(seconds, 1e-9) / 1e6)
+
+
+def _collect_chunks(checkpoint_dir):
+    # Removes the chunks which are not referenced by any checkpoint left.
+    refs = set()
+    for dir_name in os.listdir(checkpoint_dir):
+        if dir_name.startswith(CKPT_DIR_PREFIX):
+            manifest = _load_manifest(os.path.join(checkpoint_dir, dir_name))
+            refs.update(manifest.get("chunks", ()))
+    chunk_dir = os.path.join(checkpoint_dir, CHUNKS_DIR)
+    for chunk in os.listdir(chunk_dir):
+        if chunk not in refs:
+            os.remove(os.path.join(chunk_dir, chunk))
+
+
+def _record_times(snapshot_time=None, write_time=None, chunk_bytes=None,
+                  written_bytes=None):
+    # Imported here since adaptdl.torch depends on this module.
+    from adaptdl.torch import _exporter
+    if snapshot_time is not None:
+        LOG.debug("Checkpoint snapshot took %.3fs", snapshot_time)
+        _exporter.CHECKPOINT_SNAPSHOT_TIME.set(snapshot_time)
+    if write_time is not None:
+        LOG.info("Checkpoint written in %.3fs, %d of %d bytes of chunks "
+                 "were new", write_time, written_bytes, chunk_bytes)
+        _exporter.CHECKPOINT_WRITE_TIME.set(write_time)
+        _exporter.CHECKPOINT_CHUNK_BYTES.inc(chunk_bytes)
+        _exporter.CHECKPOINT_CHUNK_BYTES_WRITTEN.inc(written_bytes)
 
 
 def save_state(state, checkpoint_dir, sync=True):
@@ -139,7 +704,8 @@ def save_state(state, checkpoint_dir, sync=True):
     all replicas if `sync` is `True` (default), and then invokes `State.save`
     on the replica of rank 0 only. Note that we save state to a temporary
     folder first. Then, it will be renamed to the formal checkpoint folder
-    after all states are saved.
+    after all states are saved. The state is not compressed, since no manifest
+    is written to record the codec.
 
     Arguments:
         state (State): The `State` object to save to persistent storage.
@@ -152,8 +718,7 @@ def save_state(state, checkpoint_dir, sync=True):
         name = _STATES_TO_NAMES[state]
         state_file = os.path.join(_get_tmp_ckpt_dir(checkpoint_dir), name)
 
-        with open(state_file, "wb") as f:
-            state.save(f)
+        _write_file(state_file, state.save)
 
 
 def load_state(state):
@@ -169,6 +734,7 @@ def load_state(state):
         `True` if state was previously saved and `State.load` was invoked,
         `False` otherwise.
     """
+    global _COMMITTED_ID
     if from_ray():
         from ray.tune import session
         checkpoint_dir = session.get_session().get_checkpoint()
@@ -195,12 +761,58 @@ def load_state(state):
     ckpt_dir = os.path.join(checkpoint_dir,
                             f"{CKPT_DIR_PREFIX}{latest_restart_id}")
     name = _STATES_TO_NAMES[state]
-    state_file = os.path.join(ckpt_dir, name)
-    if not os.path.isfile(state_file):
+    manifest = _load_manifest(ckpt_dir)
+    _COMMITTED_ID = manifest.get("id")
+    source = None
+    if "id" in manifest and not from_ray() and \
+            _handoff.local_dir() is not None:
+        source = _handoff.source(manifest["id"], functools.partial(
+            _shared_path, ckpt_dir))
+    state_file = source.path(name) if source else os.path.join(ckpt_dir, name)
+    shards = manifest.get("shards", {}).get(name)
+    # Checkpoints without a manifest were not compressed.
+    codec = manifest.get("codecs", {}).get(name)
+    start = time.time()
+    if shards:
+        shards = Shards(ckpt_dir, name, shards, manifest["num_replicas"],
+                        source, codec)
+        if os.path.isfile(state_file):
+            with open(state_file, "rb") as f:
+                state.load_sharded(_compression.decompress(f, codec), shards)
+        else:
+            state.load_sharded(None, shards)
+    elif os.path.isfile(state_file):
+        with open(state_file, "rb") as f:
+            state.load(_compression.decompress(f, codec))
+    else:
         LOG.warning(f"Cannot find state file {state_file}.")
         return False
 
-    with open(state_file, "rb") as f:
-        state.load(f)
-
+    _record_restore(name, start)
     return True
+
+
+def _record_restore(name, start):
+    # Restore latency of each state, to see where restart time goes.
+    from adaptdl.torch import _exporter
+    end = time.time()
+    LOG.info("Restored state %s in %.3fs", name, end - start)
+    _exporter.CHECKPOINT_RESTORE_TIME.inc(end - start)
+    adaptdl.trace.complete(f"restore {name}", "checkpoint", start, end)
+
+
+def _shared_path(ckpt_dir, name):
+    # Path of a file of the checkpoint in shared storage. Chunks are shared
+    # by all checkpoints in the same folder.
+    return os.path.join(os.path.dirname(ckpt_dir) if
+                        name.startswith(CHUNKS_DIR + os.sep) else ckpt_dir,
+                        name)
+
+
+def _load_manifest(ckpt_dir):
+    # Checkpoints written without shards have no manifest.
+    path = os.path.join(ckpt_dir, MANIFEST_NAME)
+    if not os.path.isfile(path):
+        return {}
+    with open(path, "rb") as f:
+        return json.loads(f.read())
@@ -68,3 +68,243 @@ def test_save_load():
         assert state_2.value == 20
     else:
         assert False
+
+
+@elastic_multiprocessing
+def test_async_save():
+    import os
+    import pickle
+    import threading
+    from adaptdl.checkpoint import (State, save_all_states, load_state,
+                                    wait_for_checkpoint)
+    from adaptdl.env import checkpoint_path, replica_rank, num_restarts
+
+    written = threading.Event()
+
+    class TestState(State):
+        def save(self, fileobj):
+            pickle.dump(self.value, fileobj)
+
+        def load(self, fileobj):
+            self.value = pickle.load(fileobj)
+
+        def snapshot(self):
+            value = self.value
+
+            def write(fileobj):
+                written.wait()
+                pickle.dump(value, fileobj)
+            return write
+
+    state = TestState("state")
+    ckpt_dir = os.path.join(checkpoint_path(), "checkpoint-0")
+    if num_restarts() == 0:
+        state.value = 10
+        save_all_states(blocking=False)
+        # Training continues while the snapshot is written.
+        state.value = 20
+        assert not os.path.exists(ckpt_dir)
+        written.set()
+        wait_for_checkpoint()
+        assert os.path.isdir(ckpt_dir)
+        # Saved again in the same restart.
+        state.value = 30
+        save_all_states()
+        return 2
+    load_state(state)
+    assert state.value == 30
+    if replica_rank() == 0:
+        assert [name for name in os.listdir(checkpoint_path())
+                if name.startswith("checkpoint-")] == ["checkpoint-0"]
+
+
+@elastic_multiprocessing
+def test_chunks():
+    import os
+    from adaptdl.checkpoint import (State, save_all_states, load_state,
+                                    write_chunks, CHUNK_SIZE, CHUNKS_DIR)
+    from adaptdl.env import checkpoint_path, num_restarts
+
+    class TestState(State):
+        def snapshot_shards(self):
+            data = bytes(self.data)
+            return {"data": lambda f: f.write(" ".join(
+                write_chunks(data)).encode())}
+
+        def load_sharded(self, fileobj, shards):
+            chunks = shards.read(["data"])["data"].read().decode().split()
+            self.data = shards.read_chunks(chunks)
+
+    import adaptdl.collective
+    adaptdl.collective.initialize("0.0.0.0")
+    state = TestState("state")
+    chunk_dir = os.path.join(checkpoint_path(), CHUNKS_DIR)
+    if num_restarts() == 0:
+        frozen = os.urandom(2 * CHUNK_SIZE)
+        state.data = frozen + b"x"
+        save_all_states()
+        assert len(os.listdir(chunk_dir)) == 3
+        mtimes = {chunk: os.stat(os.path.join(chunk_dir, chunk)).st_mtime_ns
+                  for chunk in os.listdir(chunk_dir)}
+        state.data = frozen + b"y"
+        save_all_states()
+        # Only the last chunk changed, and the replaced one was removed.
+        chunks = os.listdir(chunk_dir)
+        assert len(chunks) == 3
+        assert sum(mtimes.get(chunk) == os.stat(
+            os.path.join(chunk_dir, chunk)).st_mtime_ns
+            for chunk in chunks) == 2
+        with open(os.path.join(chunk_dir, "stale"), "wb"):
+            pass
+        return 1
+    load_state(state)
+    assert state.data[-1:] == b"y" and len(state.data) == 2 * CHUNK_SIZE + 1
+    save_all_states()
+    assert "stale" not in os.listdir(chunk_dir)
+
+
+@elastic_multiprocessing
+def test_compression():
+    import os
+    import pickle
+    from adaptdl import _compression
+    from adaptdl.checkpoint import State, save_all_states, load_state
+    from adaptdl.env import checkpoint_path, num_restarts
+
+    class TestState(State):
+        def save(self, fileobj):
+            pickle.dump(self.value, fileobj)
+
+        def load(self, fileobj):
+            self.value = pickle.load(fileobj)
+
+    class RawState(State):
+        def save(self, fileobj):
+            fileobj.write(self.value)
+
+        def load(self, fileobj):
+            self.value = fileobj.read()
+
+    compressed = TestState("compressed", compression="zlib")
+    plain = TestState("plain")
+    # Looks like compressed data, but is read back as it was saved.
+    raw = RawState("raw")
+    raw_value = _compression.compress(b"raw", "zlib")
+    if num_restarts() == 0:
+        compressed.value = plain.value = "x" * 100000
+        raw.value = raw_value
+        save_all_states()
+        ckpt_dir = os.path.join(checkpoint_path(), "checkpoint-0")
+        with open(os.path.join(ckpt_dir, "compressed"), "rb") as f:
+            assert f.read(len(_compression.MAGIC)) == _compression.MAGIC
+        assert os.path.getsize(os.path.join(ckpt_dir, "compressed")) < \
+            os.path.getsize(os.path.join(ckpt_dir, "plain")) / 10
+        return 1
+    from adaptdl.torch import _exporter
+    load_state(compressed)
+    load_state(plain)
+    load_state(raw)
+    assert compressed.value == plain.value == "x" * 100000
+    assert raw.value == raw_value
+    assert _exporter.CHECKPOINT_RESTORE_TIME.value > 0
+    with pytest.raises(ValueError):
+        State("unavailable", compression="snappy")
+
+
+@elastic_multiprocessing
+def test_handoff():
+    import os
+    from adaptdl.checkpoint import (State, save_all_states, load_state,
+                                    write_chunks, CHUNK_SIZE, CHUNKS_DIR)
+    from adaptdl.env import checkpoint_path, num_restarts, replica_rank
+
+    class TestState(State):
+        def save(self, fileobj):
+            fileobj.write(b"meta")
+
+        def snapshot_shards(self):
+            data = bytes([replica_rank()]) * CHUNK_SIZE + b"x"
+            return {f"data-{replica_rank()}": lambda f: f.write(" ".join(
+                write_chunks(data)).encode())}
+
+        def load_sharded(self, fileobj, shards):
+            self.meta = fileobj.read()
+            self.data = {}
+            for name, f in shards.read(shards.names).items():
+                self.data[name] = bytes(shards.read_chunks(
+                    f.read().decode().split()))
+
+    if num_restarts() == 0:
+        return 2
+    # Each replica runs on a node of its own.
+    os.environ["ADAPTDL_CHECKPOINT_HANDOFF_PATH"] = os.path.join(
+        checkpoint_path(), f"node-{replica_rank()}")
+    import adaptdl.collective
+    adaptdl.collective.initialize("0.0.0.0")
+    state = TestState("state")
+    if num_restarts() == 1:
+        save_all_states()
+        if replica_rank() == 0:
+            # Checkpoint handed off without reading from shared storage.
+            ckpt_dir = os.path.join(checkpoint_path(), "checkpoint-1")
+            chunk_dir = os.path.join(checkpoint_path(), CHUNKS_DIR)
+            paths = [os.path.join(ckpt_dir, name) for name in
+                     os.listdir(ckpt_dir) if name != "_manifest"]
+            paths += [os.path.join(chunk_dir, name) for name in
+                      os.listdir(chunk_dir)]
+            for path in paths:
+                open(path, "wb").close()
+        return 3
+    # The replica on the new node fetches everything from the other two.
+    assert load_state(state)
+    assert state.meta == b"meta"
+    assert state.data == {f"data-{rank}": bytes([rank]) * CHUNK_SIZE + b"x"
+                          for rank in range(2)}
+    # Files are only served to the replicas of the same job.
+    import urllib.error
+    import urllib.request
+    from adaptdl import _handoff
+    for url, _ in _handoff._SOURCE[0]._peers:
+        with pytest.raises(urllib.error.HTTPError, match="403"):
+            urllib.request.urlopen(url + "state", timeout=10)
+    # Keep serving files until all replicas have loaded the checkpoint.
+    adaptdl.collective.allreduce(0)
+
+
+@elastic_multiprocessing
+def test_local_path():
+    import os
+    from adaptdl.checkpoint import (State, save_all_states, load_state,
+                                    _load_manifest)
+    from adaptdl.env import checkpoint_path, num_restarts, replica_rank
+
+    class TestState(State):
+        def save(self, fileobj):
+            fileobj.write(self.value)
+
+        def load(self, fileobj):
+            self.value = fileobj.read()
+
+        def snapshot_shards(self):
+            return {f"shard-{replica_rank()}": lambda f: f.write(b"x")}
+
+    if num_restarts() == 0:
+        return 2
+    if num_restarts() == 1:
+        if replica_rank() == 1:
+            # The checkpoint path is local to the node of each replica.
+            os.environ["ADAPTDL_CHECKPOINT_PATH"] = os.path.join(
+                checkpoint_path(), "node-1")
+        import adaptdl.collective
+        adaptdl.collective.initialize("0.0.0.0")
+        state = TestState("state")
+        state.value = b"value"
+        save_all_states()
+        if replica_rank() == 0:
+            # Only written by rank 0, without shards.
+            ckpt_dir = os.path.join(checkpoint_path(), "checkpoint-1")
+            assert not _load_manifest(ckpt_dir)["shards"]
+        return 1
+    state = TestState("state")
+    assert load_state(state)
+    assert state.value == b"value"
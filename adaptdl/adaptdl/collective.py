@@ -29,6 +29,7 @@ encounter unexpected bugs and errors.
 # are removed.
 
 import adaptdl.env
+import adaptdl.trace
 from .reducer import Reducer, default_reduce_fn
 
 _REDUCER = None
@@ -99,7 +100,9 @@ def allreduce(value, reduce_fn=default_reduce_fn):
     """
     if _REDUCER is None:
         raise RuntimeError("{} has not been initialized".format(__name__))
-    return _REDUCER.allreduce(value, reduce_fn)
+    with adaptdl.trace.span("allreduce", "collective",
+                            tid=adaptdl.trace.COLLECTIVE_TID):
+        return _REDUCER.allreduce(value, reduce_fn)
 
 
 def allreduce_async(value, reduce_fn=default_reduce_fn):
@@ -141,4 +144,6 @@ def broadcast(value):
     """
     if _REDUCER is None:
         raise RuntimeError("{} has not been initialized".format(__name__))
-    return _REDUCER.broadcast(value)
+    with adaptdl.trace.span("broadcast", "collective",
+                            tid=adaptdl.trace.COLLECTIVE_TID):
+        return _REDUCER.broadcast(value)
@@ -164,6 +164,60 @@ def supervisor_url():
     return os.getenv("ADAPTDL_SUPERVISOR_URL")
 
 
+def metrics_port():
+    """
+    Port on which each replica serves its training metrics for Prometheus at
+    ``/metrics``. Determined by the environment variable
+    ``ADAPTDL_METRICS_PORT``, or ``None`` if unset, in which case the metrics
+    are not served.
+
+    Returns:
+        int: port to serve metrics on, or ``None``.
+    """
+    port = os.getenv("ADAPTDL_METRICS_PORT")
+    return int(port) if port else None
+
+
+def trace_events():
+    """
+    Maximum number of timeline events each replica keeps in its trace buffer,
+    see :mod:`adaptdl.trace`. Determined by the environment variable
+    ``ADAPTDL_TRACE_EVENTS``, or 0 if unset, in which case tracing is disabled.
+
+    Returns:
+        int: size of the trace buffer, or 0.
+    """
+    return int(os.getenv("ADAPTDL_TRACE_EVENTS", "0"))
+
+
+def checkpoint_compression():
+    """
+    Codec used to compress checkpointed states by default, such as ``zlib``,
+    ``lz4`` or ``zstd``, see :mod:`adaptdl._compression`. Determined by the
+    environment variable ``ADAPTDL_CHECKPOINT_COMPRESSION``, or ``None`` if
+    unset, in which case checkpoints are not compressed.
+
+    Returns:
+        str: name of the codec, or ``None``.
+    """
+    return os.getenv("ADAPTDL_CHECKPOINT_COMPRESSION") or None
+
+
+def checkpoint_handoff_path():
+    """
+    Path to a directory local to each node, such as one in ``/dev/shm``,
+    where replicas keep the checkpoints they write so that the replicas after
+    a restart can read them from the same node or from each other instead of
+    from shared storage, see :mod:`adaptdl._handoff`. Determined by the
+    environment variable ``ADAPTDL_CHECKPOINT_HANDOFF_PATH``, or ``None`` if
+    unset, in which case checkpoints are only kept in shared storage.
+
+    Returns:
+        str: node-local directory path or ``None``.
+    """
+    return os.getenv("ADAPTDL_CHECKPOINT_HANDOFF_PATH") or None
+
+
 def from_ray():
     """ Returns True if the code is being called from Ray"""
     if os.getenv("ADAPTDL_TUNE_TRIAL_SCHED", "False") == "True":
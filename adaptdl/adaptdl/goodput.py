@@ -55,28 +55,41 @@ GradParams = collections.namedtuple("GradParams", ["sqr", "var"])
 
 class GoodputFunction(object):
 
-    def __init__(self, perf_params, grad_params, init_batch_size):
+    def __init__(self, perf_params, grad_params, init_batch_size,
+                 perf_err=0.0, grad_err=0.0):
         self._perf_params = PerfParams(*perf_params)
         self._grad_params = GradParams(*grad_params)
         self._init_batch_size = init_batch_size
-
-    def __call__(self, num_nodes, num_replicas, atomic_bsz, accum_steps):
-        return self.evaluate(num_nodes, num_replicas, atomic_bsz, accum_steps)
-
-    def evaluate(self, num_nodes, num_replicas, atomic_bsz, accum_steps):
+        # Log-scale standard errors of the throughput model (from the perf
+        # fit residuals) and of the efficiency model (from the variance of
+        # the gradient statistics).
+        self._perf_err = perf_err
+        self._grad_err = grad_err
+
+    def __call__(self, num_nodes, num_replicas, atomic_bsz, accum_steps,
+                 local_steps=1):
+        return self.evaluate(num_nodes, num_replicas, atomic_bsz, accum_steps,
+                             local_steps)
+
+    def evaluate(self, num_nodes, num_replicas, atomic_bsz, accum_steps,
+                 local_steps=1):
         # batch_size = num_replicas * atomic_bsz * (accum_steps + 1)
         batch_size = atomic_bsz / adaptdl.torch.data.data_ratio * (accum_steps + 1)
         # print("evaluate", batch_size)
         # assert np.all(self._init_batch_size <= batch_size)
         print("goodput", self.throughput(num_nodes, num_replicas, atomic_bsz,accum_steps), self.efficiency(batch_size))
+        # The measured throughput already reflects the current local steps.
         return self.throughput(num_nodes, num_replicas, atomic_bsz,
-                               accum_steps) * self.efficiency(batch_size)
+                               accum_steps) * \
+            self.efficiency(batch_size, num_replicas, local_steps)
 
-    def evaluate_opt(self, num_nodes, num_replicas, atomic_bsz, accum_steps):
+    def evaluate_opt(self, num_nodes, num_replicas, atomic_bsz, accum_steps,
+                     local_steps=1):
         batch_size = atomic_bsz / ratio_calculate * (accum_steps + 1)
         # assert np.all(self._init_batch_size <= batch_size)
         return self.throughput_opt(num_nodes, num_replicas, atomic_bsz,
-                               accum_steps) * self.efficiency_opt(batch_size)
+                                   accum_steps, local_steps) * \
+            self.efficiency_opt(batch_size, num_replicas, local_steps)
 
     def throughput(self, num_nodes, num_replicas, atomic_bsz, accum_steps):
         global ratio_calculate 
@@ -127,41 +140,124 @@ class GoodputFunction(object):
         # print("throughput",batch_size, total_time)
         return batch_size / total_time
 
-    def throughput_opt(self, num_nodes, num_replicas, atomic_bsz, accum_steps):
+    def throughput_opt(self, num_nodes, num_replicas, atomic_bsz, accum_steps,
+                       local_steps=1):
+        total_time = self.step_time(num_nodes, num_replicas, atomic_bsz,
+                                    accum_steps, local_steps)
+        batch_size = atomic_bsz / ratio_calculate * (accum_steps + 1)
+        # print("throughput opt",batch_size, total_time)
+        return batch_size / total_time
+
+    def step_time(self, num_nodes, num_replicas, atomic_bsz, accum_steps,
+                  local_steps=1):
+        """
+        Predicted time of one optimizer step on this replica, including its
+        accumulation steps.
+        """
         accum_time = _predict_accum_time(self._perf_params, atomic_bsz)
         network_time = _predict_network_time(self._perf_params,
                                              num_nodes, num_replicas)
         optim_time = np.exp(_predict_log_optim_time(self._perf_params,
                                                     accum_time, network_time))
         total_time = accum_steps * accum_time + optim_time
-        batch_size = atomic_bsz / ratio_calculate * (accum_steps + 1)
-        # print("throughput opt",batch_size, total_time)
-        return batch_size / total_time
-
-    def efficiency(self, batch_size):
+        # With local steps, parameters are averaged once every local_steps
+        # optimizer steps without overlapping the backward pass.
+        return np.where(
+            np.greater(local_steps, 1),
+            (accum_steps + 1) * accum_time + network_time / local_steps,
+            total_time)
+
+    def fill_step_time(self, num_nodes, num_replicas, atomic_bsz,
+                       accum_steps, step_time, max_atomic_bsz, max_local_bsz,
+                       accumulation=False, local_steps=1):
+        """
+        Grow the local batch size of a replica which would otherwise finish
+        its optimizer steps before the slowest replica, so that all replicas
+        finish at about the same time.
+
+        Arguments:
+            step_time (float): Predicted step time of the slowest replica.
+            max_atomic_bsz (int): Max atomic batch size of this replica.
+            max_local_bsz (int): Max local batch size of this replica,
+                including its accumulation steps.
+            accumulation (bool): Whether more accumulation steps may be added.
+
+        Returns (tuple): The atomic batch size and accumulation steps with the
+            largest local batch size predicted to finish within step_time,
+            never smaller than the given ones.
+        """
+        best = (atomic_bsz, accum_steps)
+        candidates = np.arange(atomic_bsz, max(max_atomic_bsz, atomic_bsz) + 1)
+        steps = accum_steps
+        while candidates.size:
+            times = self.step_time(num_nodes, num_replicas, candidates, steps,
+                                   local_steps)
+            valid = candidates[(times <= step_time) &
+                               (candidates * (steps + 1) <= max_local_bsz)]
+            if not valid.size:
+                break  # More accumulation steps would take even longer.
+            if valid[-1] * (steps + 1) > best[0] * (best[1] + 1):
+                best = (int(valid[-1]), int(steps))
+            if not accumulation:
+                break
+            steps += 1
+            candidates = np.arange(
+                1, min(max_atomic_bsz, max_local_bsz // (steps + 1)) + 1)
+        return best
+
+    def efficiency(self, batch_size, num_replicas=1, local_steps=1):
         grad_sqr = self._grad_params.sqr
         grad_var = self._grad_params.var
         print("var and grad", grad_var, grad_sqr)
         scale = batch_size / self._init_batch_size
         # print("in efficiency,batch size and initial size",batch_size, self._init_batch_size )
-        denom = grad_var / scale + grad_sqr
+        denom = grad_var * _drift(num_replicas, local_steps) / scale + grad_sqr
         gain = np.where(denom > 0, (grad_var + grad_sqr) / denom, 1.0)
         print("efficiency", (grad_var / grad_sqr))
         return gain / scale
 
-    def efficiency_opt(self, batch_size):
+    def efficiency_opt(self, batch_size, num_replicas=1, local_steps=1):
         grad_sqr = self._grad_params.sqr
         grad_var = self._grad_params.var
         scale = batch_size / self._init_batch_size
         # print("in opt efficiency,batch size and initial size",batch_size, self._init_batch_size )
-        denom = grad_var / scale + grad_sqr
+        denom = grad_var * _drift(num_replicas, local_steps) / scale + grad_sqr
         gain = np.where(denom > 0, (grad_var + grad_sqr) / denom, 1.0)
         # print("sqr and var", grad_sqr,  grad_var)
         # print("efficiency opt", gain / scale)
         return gain / scale
 
+    def speedup_lower_bound(self, speedup, z=1.645):
+        """
+        Lower confidence bound of a predicted speedup between two
+        configurations, i.e. the ratio of their goodputs. The errors of both
+        goodput predictions are conservatively treated as independent.
+
+        Arguments:
+            speedup (float): Predicted speedup.
+            z (float): Number of standard deviations below the prediction,
+                the default corresponds to a one-sided 95% bound.
+
+        Returns (float): Lower bound of the speedup.
+        """
+        log_std = np.sqrt(2 * (self._perf_err ** 2 + self._grad_err ** 2))
+        return speedup * np.exp(-z * log_std)
+
     def optimize(self, num_nodes, num_replicas, max_batch_size=None,
-                 atomic_bsz_range=None, accumulation=False):
+                 atomic_bsz_range=None, accumulation=False,
+                 max_local_steps=None):
+        """
+        Find the batch size configuration with the highest goodput.
+
+        Arguments:
+            max_local_steps (int): If not None, also search over the number
+                of local optimizer steps between parameter averages, from 1
+                up to max_local_steps, and return it as a fourth value.
+
+        Returns (tuple): The goodput, atomic batch size and accumulation
+            steps of the best configuration, and its local steps if
+            max_local_steps is not None.
+        """
         assert np.all(np.less_equal(1, num_nodes))
         assert np.all(np.less_equal(num_nodes, num_replicas))
         if max_batch_size is None:
@@ -209,7 +305,14 @@ class GoodputFunction(object):
         # print("geospace", atomic_bsz)
 
         goodput = self.evaluate_opt(num_nodes, num_replicas,
-                                atomic_bsz, accum_steps)
+                                    atomic_bsz, accum_steps)
+        local_steps = np.ones_like(goodput)
+        # Jointly search over the local steps, in powers of two.
+        for steps in _local_steps_candidates(max_local_steps):
+            candidate = self.evaluate_opt(num_nodes, num_replicas,
+                                          atomic_bsz, accum_steps, steps)
+            local_steps = np.where(candidate > goodput, steps, local_steps)
+            goodput = np.maximum(candidate, goodput)
         # Set the goodput of invalid configurations to 0.0.
         goodput = np.where((min_atomic_bsz <= atomic_bsz) &
                            (atomic_bsz <= max_atomic_bsz), goodput, 0.0)
@@ -219,12 +322,16 @@ class GoodputFunction(object):
         goodput = goodput[indices].reshape(output_shape)
         atomic_bsz = atomic_bsz[indices].reshape(output_shape)
         accum_steps = accum_steps[indices].reshape(output_shape)
+        local_steps = local_steps[indices].reshape(output_shape)
         if output_scalar:
             goodput = goodput.item()
             atomic_bsz = atomic_bsz.item()
             accum_steps = accum_steps.item()
+            local_steps = int(local_steps.item())
         atomic_bsz = math.ceil(atomic_bsz)
         print("optimized batch",atomic_bsz, goodput)
+        if max_local_steps is not None:
+            return goodput, atomic_bsz, accum_steps, local_steps
         return goodput, atomic_bsz, accum_steps
 
 
@@ -289,6 +396,28 @@ class GoodputFunction(object):
     #             accum_steps = accum_steps.item()
     #         return goodput, atomic_bsz, accum_steps
 
+def _drift(num_replicas, local_steps):
+    # Statistical cost of taking local optimizer steps between parameter
+    # averages. Until the next average, each replica's model drifts with the
+    # noise of its own gradients, which adds to the gradient noise of the
+    # averaged updates. On average, an update is applied half of a period
+    # after the last average. There is no drift with a single replica.
+    return 1.0 + (np.asarray(local_steps) - 1) / 2 * \
+        (1.0 - 1.0 / np.asarray(num_replicas))
+
+
+def _local_steps_candidates(max_local_steps):
+    # Local steps greater than 1 to search over, powers of two up to and
+    # including max_local_steps.
+    if not max_local_steps or max_local_steps <= 1:
+        return []
+    num_doublings = int(math.log2(max_local_steps))
+    candidates = [2 ** k for k in range(1, num_doublings + 1)]
+    if candidates[-1] != max_local_steps:
+        candidates.append(max_local_steps)
+    return candidates
+
+
 def fit_perf_params(num_nodes, num_replicas, atomic_bsz,
                     accum_step_time, optim_step_time):
     # Fit the performance model given accum time and optim time measurements
@@ -352,6 +481,22 @@ def fit_perf_params(num_nodes, num_replicas, atomic_bsz,
     return PerfParams(*params)
 
 
+def perf_fit_error(perf_params, num_nodes, num_replicas, atomic_bsz,
+                   accum_step_time, optim_step_time):
+    # Root-mean-square of the log residuals of a fitted performance model,
+    # which approximates the log-scale standard error of its predictions.
+    num_nodes = np.array(num_nodes)
+    num_replicas = np.array(num_replicas)
+    pred_accum = _predict_accum_time(perf_params, np.array(atomic_bsz))
+    pred_network = _predict_network_time(perf_params, num_nodes, num_replicas)
+    pred_log_optim = _predict_log_optim_time(perf_params, pred_accum,
+                                             pred_network)
+    residuals = np.concatenate([
+        np.log(pred_accum) - np.log(accum_step_time),
+        pred_log_optim - np.log(optim_step_time)])
+    return float(np.sqrt(np.mean(residuals ** 2)))
+
+
 def _rmse(pred, true):
     return np.sqrt(((pred - true) ** 2).mean())
 
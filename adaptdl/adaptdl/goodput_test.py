@@ -343,3 +343,88 @@ def test_one_replica_accumulation(perf_params, grad_params):
             )
         )
         assert np.all(np.logical_or(bsz * (steps + 1) != 128, steps == 0))
+
+
+@pytest.mark.parametrize("perf_params", PERF_PARAMS)
+def test_perf_fit_error(perf_params):
+    from adaptdl.goodput import (perf_fit_error, _predict_accum_time,
+                                 _predict_network_time,
+                                 _predict_log_optim_time)
+    num_nodes = np.array([1, 1, 2, 2])
+    num_replicas = np.array([1, 2, 2, 4])
+    atomic_bsz = np.array([8, 16, 16, 32])
+    accum_time = _predict_accum_time(perf_params, atomic_bsz)
+    network_time = _predict_network_time(perf_params, num_nodes, num_replicas)
+    optim_time = np.exp(_predict_log_optim_time(perf_params, accum_time,
+                                                network_time))
+    assert np.isclose(perf_fit_error(perf_params, num_nodes, num_replicas,
+                                     atomic_bsz, accum_time, optim_time), 0.0)
+    # Uniform multiplicative error of 10% in every measurement.
+    err = perf_fit_error(perf_params, num_nodes, num_replicas, atomic_bsz,
+                         accum_time * 1.1, optim_time * 1.1)
+    assert np.isclose(err, np.log(1.1))
+
+
+def test_speedup_lower_bound():
+    perf_params, grad_params = PERF_PARAMS[0], GRAD_PARAMS[0]
+    fun = GoodputFunction(perf_params, grad_params, 128)
+    assert fun.speedup_lower_bound(1.2) == 1.2
+    fun = GoodputFunction(perf_params, grad_params, 128,
+                          perf_err=0.05, grad_err=0.05)
+    assert fun.speedup_lower_bound(1.2) < 1.2
+    assert fun.speedup_lower_bound(1.2, z=3.0) < fun.speedup_lower_bound(1.2)
+    noisier = GoodputFunction(perf_params, grad_params, 128,
+                              perf_err=0.05, grad_err=0.5)
+    assert noisier.speedup_lower_bound(1.2) < fun.speedup_lower_bound(1.2)
+
+
+@pytest.mark.parametrize("perf_params", PERF_PARAMS)
+@pytest.mark.parametrize("grad_params", GRAD_PARAMS)
+def test_local_steps(perf_params, grad_params):
+    goodput_fn = GoodputFunction(perf_params, grad_params, 16)
+    batch_size = np.array([16, 32, 64, 128])
+    efficiency = goodput_fn.efficiency(batch_size, 4)
+    assert np.allclose(goodput_fn.efficiency(batch_size, 4, 1), efficiency)
+    # No drift between replicas with a single replica.
+    assert np.allclose(goodput_fn.efficiency(batch_size, 1, 8),
+                       goodput_fn.efficiency(batch_size, 1))
+    # Parameter averages do not overlap with computation, so only compare
+    # the throughput of different numbers of local steps.
+    throughput = None
+    for local_steps in (2, 4, 8):
+        # More local steps cost statistical efficiency, but communicate less.
+        prev_efficiency = efficiency
+        efficiency = goodput_fn.efficiency(batch_size, 4, local_steps)
+        assert np.all(0 < efficiency) and np.all(efficiency < prev_efficiency)
+        prev_throughput = throughput
+        throughput = goodput_fn.throughput_opt(2, 4, 16, 0, local_steps)
+        assert prev_throughput is None or throughput > prev_throughput
+
+
+def test_local_steps_candidates():
+    from adaptdl.goodput import _local_steps_candidates
+    assert _local_steps_candidates(None) == []
+    assert _local_steps_candidates(1) == []
+    assert _local_steps_candidates(8) == [2, 4, 8]
+    assert _local_steps_candidates(12) == [2, 4, 8, 12]
+
+
+@pytest.mark.parametrize("perf_params", PERF_PARAMS)
+def test_fill_step_time(perf_params):
+    goodput_fn = GoodputFunction(perf_params, GRAD_PARAMS[0], 16)
+    step_time = goodput_fn.step_time(1, 2, 64, 1)
+    # Already the slowest replica.
+    assert goodput_fn.fill_step_time(1, 2, 64, 1, step_time, 64, 512,
+                                     accumulation=True) == (64, 1)
+    # A replica limited to atomic batch sizes of 16 takes more accumulation
+    # steps to finish at about the same time.
+    atomic_bsz, accum_steps = goodput_fn.fill_step_time(
+        1, 2, 16, 0, step_time, 16, 512, accumulation=True)
+    assert atomic_bsz <= 16 and accum_steps >= 1
+    assert goodput_fn.step_time(1, 2, atomic_bsz, accum_steps) <= step_time
+    assert goodput_fn.step_time(
+        1, 2, atomic_bsz, accum_steps + 1) > step_time or \
+        atomic_bsz * (accum_steps + 2) > 512
+    # Without accumulation, only the atomic batch size can grow.
+    assert goodput_fn.fill_step_time(1, 2, 16, 0, step_time, 16, 512) == \
+        (16, 0)
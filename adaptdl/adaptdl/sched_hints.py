@@ -15,9 +15,11 @@
 
 import json
 import logging
+import numbers
 import requests
+import threading
 from collections import OrderedDict
-from adaptdl.goodput import PerfParams
+from adaptdl.goodput import PerfParams, _predict_accum_time
 import adaptdl.env
 from types import MappingProxyType
 
@@ -40,20 +42,146 @@ SCHED_HINTS = MappingProxyType({'initBatchSize': 0,
                                 'perfParams': None})
 
 
+_SESSION = None
+
+
+def _session():
+    # A single pooled session keeps the connection to the supervisor alive
+    # across reports instead of opening a new one each time.
+    global _SESSION
+    if _SESSION is None:
+        _SESSION = requests.Session()
+    return _SESSION
+
+
 def post_sched_hints(sched_hints, job_key):
     url = adaptdl.env.supervisor_url()
     if not url or url == "":
-        return  # skip
+        return False  # skip
     headers = {"Content-Type": "application/json"}
     try:
         for k in sched_hints:
             assert k in SCHED_HINTS  # validate
 
         response = \
-            requests.put(url=f"{url}/hints/{job_key}",
-                         data=json.dumps(sched_hints),
-                         headers=headers)
+            _session().put(url=f"{url}/hints/{job_key}",
+                           data=json.dumps(sched_hints),
+                           headers=headers)
         if response.status_code != 200:
             LOG.warning(f"Received {response.status_code}")
+            return False
     except Exception as e:
         LOG.warning(f"{e}")
+        return False
+    return True
+
+
+def merge_sched_hints(replica_hints):
+    """
+    Merges the scheduling hints computed for each replica (or each class of
+    devices) of a job into the hints for the whole job. Replicas may run on
+    heterogeneous devices, and a synchronous job runs only as fast as its
+    slowest replica, so the perf params are taken from the hints with the
+    largest predicted compute time at the initial batch size.
+
+    Arguments:
+        replica_hints (list): Scheduling hints for each replica.
+
+    Returns (dict): Merged scheduling hints.
+    """
+    def compute_time(hints):
+        if not hints.get("perfParams"):
+            return 0.0
+        params = PerfParams(*[hints["perfParams"][k] for k in PERF_PARAMS])
+        atomic_bsz = ((hints.get("initBatchSize") or 0) /
+                      adaptdl.env.num_replicas())
+        return _predict_accum_time(params, atomic_bsz)
+
+    merged = dict(max(replica_hints, key=compute_time))
+    merged["maxProfiledReplicas"] = max(
+        hints.get("maxProfiledReplicas", 0) for hints in replica_hints)
+    return merged
+
+
+def _changed(old, new, rel_tol):
+    if isinstance(old, numbers.Number) and isinstance(new, numbers.Number) \
+            and not isinstance(old, bool) and not isinstance(new, bool):
+        return abs(new - old) > rel_tol * max(abs(old), abs(new))
+    if isinstance(old, dict) and isinstance(new, dict):
+        return old.keys() != new.keys() or \
+            any(_changed(old[k], new[k], rel_tol) for k in old)
+    if isinstance(old, (list, tuple)) and isinstance(new, (list, tuple)):
+        return len(old) != len(new) or \
+            any(_changed(a, b, rel_tol) for a, b in zip(old, new))
+    return old != new
+
+
+class SchedHintsReporter(object):
+    """
+    Posts scheduling hints to the supervisor from a background thread, so
+    that the training loop never blocks on the network. Only the most recent
+    hints are kept if the supervisor is slow, and only the fields which have
+    changed materially since the last successful post are sent.
+
+    Arguments:
+        job_key (str): Key of the job to report hints for.
+        rel_tol (float): Relative change in a numeric field below which it is
+            not considered to have changed.
+    """
+    def __init__(self, job_key, rel_tol=0.05):
+        self._job_key = job_key
+        self._rel_tol = rel_tol
+        self._sent = {}
+        self._pending = None
+        self._busy = False
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def submit(self, sched_hints):
+        """
+        Queues scheduling hints to be reported, replacing any hints which
+        were queued earlier but not yet reported. Does not block.
+
+        Arguments:
+            sched_hints (dict): Scheduling hints for the job.
+        """
+        with self._cond:
+            self._pending = dict(sched_hints)
+            self._cond.notify_all()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                daemon=True)
+                self._thread.start()
+
+    def flush(self, timeout=None):
+        """
+        Waits until all submitted hints have been reported.
+
+        Arguments:
+            timeout (float): Maximum number of seconds to wait.
+
+        Returns (bool): Whether all submitted hints were reported.
+        """
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: self._pending is None and not self._busy, timeout)
+
+    def _delta(self, sched_hints):
+        return {k: v for k, v in sched_hints.items()
+                if k not in self._sent or
+                _changed(self._sent[k], v, self._rel_tol)}
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending is not None)
+                sched_hints, self._pending = self._pending, None
+                self._busy = True
+            try:
+                delta = self._delta(sched_hints)
+                if delta and post_sched_hints(delta, self._job_key):
+                    self._sent.update(delta)
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
@@ -0,0 +1,60 @@
+# Copyright 2020 Petuum, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import adaptdl.sched_hints
+from adaptdl.sched_hints import (SCHED_HINTS, PERF_PARAMS,
+                                 SchedHintsReporter, merge_sched_hints)
+
+
+def _hints(alpha_c, max_profiled_replicas):
+    hints = SCHED_HINTS.copy()
+    hints["initBatchSize"] = 64
+    hints["perfParams"] = dict(PERF_PARAMS, alpha_c=alpha_c, beta_c=0.01)
+    hints["maxProfiledReplicas"] = max_profiled_replicas
+    return hints
+
+
+def test_merge_sched_hints():
+    merged = merge_sched_hints([_hints(0.1, 2), _hints(0.3, 1),
+                                _hints(0.2, 1)])
+    # Perf params of the slowest replica, max profiled replicas of any.
+    assert merged["perfParams"]["alpha_c"] == 0.3
+    assert merged["maxProfiledReplicas"] == 2
+
+
+def test_reporter(monkeypatch):
+    posted = []
+
+    def post_sched_hints(sched_hints, job_key):
+        posted.append((job_key, sched_hints))
+        return True
+
+    monkeypatch.setattr(adaptdl.sched_hints, "post_sched_hints",
+                        post_sched_hints)
+    reporter = SchedHintsReporter("job", rel_tol=0.05)
+    reporter.submit(_hints(0.1, 1))
+    assert reporter.flush(timeout=10)
+    assert len(posted) == 1 and posted[0][0] == "job"
+    assert posted[0][1] == _hints(0.1, 1)
+    # Immaterial changes are not sent.
+    reporter.submit(_hints(0.101, 1))
+    assert reporter.flush(timeout=10)
+    assert len(posted) == 1
+    # Only the materially changed fields are sent.
+    reporter.submit(_hints(0.2, 1))
+    assert reporter.flush(timeout=10)
+    assert len(posted) == 2
+    assert posted[1][1].keys() == {"perfParams"}
+    assert posted[1][1]["perfParams"]["alpha_c"] == 0.2
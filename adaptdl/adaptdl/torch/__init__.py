@@ -34,6 +34,7 @@ from .epoch import current_epoch, finished_epochs, remaining_epochs_until
 from .data import current_dataloader, AdaptiveDataLoader, ElasticSampler, ElasticHeteroSampler, HeteroDataLoader
 from .parallel import AdaptiveDataParallel
 from .accumulator import Accumulator
+from . import _exporter
 
 logging.basicConfig(level=logging.INFO)
 LOG = logging.getLogger(__name__)
@@ -128,6 +129,12 @@ def init_process_group(backend,
 
     LOG.info("torch.distributed initialized")
 
+    if adaptdl.env.metrics_port() is not None:
+        try:
+            _exporter.start_server()
+        except OSError as exc:
+            LOG.warning("Could not serve metrics: %s", exc)
+
 
 __all__ = [
     "init_process_group",
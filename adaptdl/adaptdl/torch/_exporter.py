@@ -0,0 +1,172 @@
+# Copyright 2020 Petuum, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+This module serves training metrics in the Prometheus text format from a
+background thread. The training thread only updates plain attributes of the
+metrics defined below, which is cheap and needs no locks since it is the only
+writer. All formatting is done by the server thread when scraped.
+"""
+
+import http.server
+import logging
+import threading
+
+import adaptdl.env
+
+logging.basicConfig(level=logging.INFO)
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.INFO)
+
+_METRICS = []
+
+
+class _Metric(object):
+    __slots__ = ("name", "kind", "help", "value")
+
+    def __init__(self, name, kind, help):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.value = None
+        _METRICS.append(self)
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value = (self.value or 0) + amount
+
+
+PROFILED_STEPS = _Metric("job_profiled_steps_total", "counter",
+                         "Number of profiled optimizer steps.")
+PROFILED_TIME_TOTAL = _Metric("job_profiled_step_seconds_total", "counter",
+                              "Seconds spent in profiled optimizer steps.")
+PROFILED_TIME_SYNC = _Metric("job_profiled_sync_seconds_total", "counter",
+                             "Seconds spent synchronizing gradients in "
+                             "profiled optimizer steps.")
+COMM_BYTES_RAW = _Metric("job_comm_raw_bytes_total", "counter",
+                         "Bytes of gradients all-reduced, before "
+                         "compression.")
+COMM_BYTES_SENT = _Metric("job_comm_sent_bytes_total", "counter",
+                          "Bytes of gradients all-reduced, after "
+                          "compression.")
+ACCUM_STEPS = _Metric("job_accum_steps_total", "counter",
+                      "Number of profiled gradient accumulation steps.")
+ACCUM_TIME = _Metric("job_accum_seconds_total", "counter",
+                     "Seconds spent in profiled accumulation steps.")
+REPLICAS = _Metric("job_replicas", "gauge", "Number of replicas.")
+LOCAL_BSZ = _Metric("job_local_bsz", "gauge",
+                    "Local batch size of this replica.")
+ACCUMULATION_STEPS = _Metric("job_accumulation_steps", "gauge",
+                             "Gradient accumulation steps per optimizer "
+                             "step.")
+LOCAL_STEPS = _Metric("job_local_steps", "gauge",
+                      "Optimizer steps between parameter averages.")
+DATA_RATIO = _Metric("job_data_ratio", "gauge",
+                     "Fraction of the total batch processed by this "
+                     "replica.")
+MAX_ATOMIC_BSZ = _Metric("job_max_atomic_bsz", "gauge",
+                         "Probed max atomic batch size of this replica.")
+CHECKPOINT_SNAPSHOT_TIME = _Metric("job_checkpoint_snapshot_seconds", "gauge",
+                                   "Seconds the last checkpoint blocked "
+                                   "training to take snapshots.")
+CHECKPOINT_WRITE_TIME = _Metric("job_checkpoint_write_seconds", "gauge",
+                                "Seconds taken to write the last checkpoint "
+                                "in the background.")
+CHECKPOINT_CHUNK_BYTES = _Metric("job_checkpoint_chunk_bytes_total", "counter",
+                                 "Bytes of chunks referenced by "
+                                 "checkpoints.")
+CHECKPOINT_CHUNK_BYTES_WRITTEN = _Metric(
+    "job_checkpoint_chunk_written_bytes_total", "counter",
+    "Bytes of chunks written by checkpoints, excluding existing chunks.")
+CHECKPOINT_BYTES_RAW = _Metric("job_checkpoint_raw_bytes_total", "counter",
+                               "Bytes of checkpointed state written, before "
+                               "compression.")
+CHECKPOINT_BYTES_STORED = _Metric(
+    "job_checkpoint_stored_bytes_total", "counter",
+    "Bytes of checkpointed state written, after compression.")
+CHECKPOINT_RESTORE_TIME = _Metric(
+    "job_checkpoint_restore_seconds_total", "counter",
+    "Seconds spent restoring checkpointed states.")
+GAIN = _Metric("job_gain", "gauge", "Estimated gain ratio.")
+LR_FACTOR = _Metric("job_lr_factor", "gauge", "Learning rate factor.")
+GRAD_SQR = _Metric("job_grad_sqr", "gauge",
+                   "Estimated squared norm of the true gradient.")
+GRAD_VAR = _Metric("job_grad_var", "gauge",
+                   "Estimated trace of the gradient covariance.")
+PROGRESS = _Metric("job_progress", "gauge",
+                   "Training progress in scale-invariant iterations.")
+
+
+def render():
+    """
+    Formats the current value of every metric which has been set.
+
+    Returns (str): Metrics in the Prometheus text exposition format.
+    """
+    labels = '{{job="{}",replica="{}"}}'.format(
+        adaptdl.env.job_id() or "", adaptdl.env.replica_rank())
+    lines = []
+    for metric in _METRICS:
+        value = metric.value  # Read once, may be updated concurrently.
+        if value is None:
+            continue
+        lines.append("# HELP {} {}".format(metric.name, metric.help))
+        lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+        lines.append("{}{} {}".format(metric.name, labels, float(value)))
+    return "\n".join(lines) + "\n"
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Do not log every scrape.
+
+
+_SERVER = None
+
+
+def start_server(port=None):
+    """
+    Starts serving the metrics at ``/metrics`` from a background thread, if
+    not already started.
+
+    Arguments:
+        port (int): Port to listen on, defaults to
+            :func:`adaptdl.env.metrics_port`. Zero picks a free port.
+
+    Returns (int): The port being listened on.
+    """
+    global _SERVER
+    if _SERVER is None:
+        if port is None:
+            port = adaptdl.env.metrics_port()
+        _SERVER = http.server.ThreadingHTTPServer(("0.0.0.0", port),
+                                                  _Handler)
+        _SERVER.daemon_threads = True
+        threading.Thread(target=_SERVER.serve_forever, daemon=True).start()
+        LOG.info("Serving metrics on port %s", _SERVER.server_address[1])
+    return _SERVER.server_address[1]
@@ -0,0 +1,46 @@
+# Copyright 2020 Petuum, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import urllib.error
+import urllib.request
+
+import pytest
+
+from adaptdl.conftest import elastic_multiprocessing
+
+
+@elastic_multiprocessing
+def test_exporter():
+    from adaptdl.torch import _exporter
+    from adaptdl.torch._metrics import (
+            profile_step_start, profile_sync_time, profile_step_commit)
+    port = _exporter.start_server(0)
+    assert _exporter.start_server() == port  # Only started once.
+    url = "http://127.0.0.1:{}/metrics".format(port)
+    body = urllib.request.urlopen(url).read().decode()
+    assert "job_profiled_steps_total" not in body  # Not set yet.
+    for _ in range(2):
+        profile_step_start(4)
+        profile_sync_time(0.5)
+        profile_step_commit()
+    _exporter.LOCAL_BSZ.set(4)
+    body = urllib.request.urlopen(url).read().decode()
+    labels = '{job="tmpjob",replica="0"}'
+    assert "# TYPE job_profiled_steps_total counter" in body
+    assert "job_profiled_steps_total{} 2.0".format(labels) in body
+    assert "job_profiled_sync_seconds_total{} 1.0".format(labels) in body
+    assert "job_local_bsz{} 4.0".format(labels) in body
+    with pytest.raises(urllib.error.HTTPError):
+        urllib.request.urlopen("http://127.0.0.1:{}/other".format(port))
@@ -14,16 +14,25 @@
 
 
 import collections
+import logging
 import pickle
 import time
 
 import numpy as np
+import torch
 
 import adaptdl.checkpoint
 import adaptdl.collective
 import adaptdl.env
-from adaptdl.goodput import GoodputFunction, fit_perf_params
-from adaptdl.sched_hints import SCHED_HINTS, PERF_PARAMS, post_sched_hints
+from adaptdl._sketch import QuantileSketch
+from adaptdl.torch import _exporter
+from adaptdl.goodput import GoodputFunction, fit_perf_params, perf_fit_error
+from adaptdl.sched_hints import (SCHED_HINTS, PERF_PARAMS,
+                                 SchedHintsReporter, merge_sched_hints)
+
+logging.basicConfig(level=logging.INFO)
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.INFO)
 
 
 def profile_step_start(atomic_bsz):
@@ -31,19 +40,28 @@ def profile_step_start(atomic_bsz):
     state.atomic_bsz = atomic_bsz
     state.step_start = time.time()
     state.sync_time = 0.0
-    
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
 
 
 def profile_sync_time(sync_time):
     _metrics_state().sync_time += sync_time
-    
 
 
-_PREV_REPORT = None
+def profile_comm_bytes(raw_bytes, sent_bytes):
+    # Gradient bytes all-reduced by this replica, before and after any
+    # compression done by the communication hook.
+    _exporter.COMM_BYTES_RAW.inc(raw_bytes)
+    _exporter.COMM_BYTES_SENT.inc(sent_bytes)
+
+
+def profile_freed_memory(nbytes):
+    # Optimizer state memory which this replica does not need to keep, such
+    # as the shards of other replicas with a sharded optimizer.
+    _metrics_state().freed_memory = nbytes
 
 
 def profile_step_commit(accumulation_step=False):
-    global _PREV_REPORT
     global key
     state = _metrics_state()
     step_time = time.time() - state.step_start
@@ -51,13 +69,27 @@ def profile_step_commit(accumulation_step=False):
     num_nodes = adaptdl.env.num_nodes()
     num_replicas = adaptdl.env.num_replicas()
     key = (num_nodes, num_replicas, state.atomic_bsz)
+    sketches = state.sketches[key]
+    if torch.cuda.is_available():
+        state.peak_memory[state.atomic_bsz] = max(
+            state.peak_memory.get(state.atomic_bsz, 0),
+            torch.cuda.max_memory_allocated())
     if accumulation_step:
         state.profile[key]["accum_step_time"] += step_time
         state.profile[key]["accum_count"] += 1
+        _sketch(sketches, "compute_time").add(step_time)
+        _exporter.ACCUM_STEPS.inc()
+        _exporter.ACCUM_TIME.inc(step_time)
     else:
         state.profile[key]["optim_step_time"] += step_time
         state.profile[key]["optim_sync_time"] += state.sync_time
         state.profile[key]["optim_count"] += 1
+        _sketch(sketches, "compute_time").add(step_time - state.sync_time)
+        _sketch(sketches, "optim_step_time").add(step_time)
+        _sketch(sketches, "optim_sync_time").add(state.sync_time)
+        _exporter.PROFILED_STEPS.inc()
+        _exporter.PROFILED_TIME_TOTAL.inc(step_time)
+        _exporter.PROFILED_TIME_SYNC.inc(state.sync_time)
     # print("key", key)
     # print("step time", state.profile[key]["optim_step_time"])
     # print("sync time", state.profile[key]["optim_sync_time"])
@@ -66,31 +98,133 @@ def profile_step_commit(accumulation_step=False):
     del state.step_start
     del state.sync_time
     if not accumulation_step:
-        if _PREV_REPORT is None:
-            _PREV_REPORT = time.time()
-        # if adaptdl.env.replica_rank() == 0 and time.time() - _PREV_REPORT > 30:
-        if time.time() - _PREV_REPORT > 30:
-            _fit_perf_params()
+        _optim_step_commit()
+
+
+def _sketch(sketches, name):
+    if name not in sketches:
+        sketches[name] = QuantileSketch()
+    return sketches[name]
+
+
+def _add_sketches(sketches, other):
+    for key, val in other.items():
+        for name, sketch in val.items():
+            if name in sketches.setdefault(key, {}):
+                sketches[key][name] = sketches[key][name] + sketch
+            else:
+                sketches[key][name] = sketch.copy()
+
+
+# Target number of seconds between scheduling hint reports.
+_REPORT_INTERVAL = 30
+# Optimizer steps committed so far, and the step of the next report. Every
+# replica commits the same sequence of optimizer steps, so the hints can be
+# gathered with a collective on the same step everywhere.
+_OPTIM_STEPS = 0
+_NEXT_REPORT = 5
+_PREV_REPORT = None  # (time, step) of the previous report.
+_REPORT_FUTURE = None
+_REPORT_SNAPSHOT = None
+_REPORTER = None
+
+
+def _optim_step_commit():
+    global _PREV_REPORT, _OPTIM_STEPS, _NEXT_REPORT
+    global _REPORT_FUTURE, _REPORT_SNAPSHOT
+    _OPTIM_STEPS += 1
+    if _REPORT_FUTURE is not None:
+        # Gathered one step ago, so it should not block for long.
+        gathered = _REPORT_FUTURE.result()
+        _REPORT_FUTURE = None
+        # The interval until the next report is decided by rank 0.
+        _NEXT_REPORT = _OPTIM_STEPS + gathered[0][0]
+        _merge_profiles([delta for _, delta in gathered], _REPORT_SNAPSHOT)
+        _fit_perf_params()
+        if adaptdl.env.replica_rank() == 0:
             _report_sched_hints()
-            _PREV_REPORT = time.time()
+    elif _OPTIM_STEPS >= _NEXT_REPORT:
+        now = time.time()
+        interval = _NEXT_REPORT
+        if _PREV_REPORT is not None:
+            prev_time, prev_steps = _PREV_REPORT
+            step_time = (now - prev_time) / (_OPTIM_STEPS - prev_steps)
+            interval = max(int(_REPORT_INTERVAL / max(step_time, 1e-8)), 1)
+        _PREV_REPORT = (now, _OPTIM_STEPS)
+        # Gather the profiles of all replicas in one collective.
+        _REPORT_SNAPSHOT = _copy_profile(_metrics_state().profile)
+        _REPORT_FUTURE = adaptdl.collective.allreduce_async(
+            [(interval, _profile_delta())], lambda a, b: a + b)
 
 
 
 _GRAD_PARAM_DICT = {}
 
 
-def update_grad_params(edp_key, grad_norm_sqr, grad_variance):
+def update_grad_params(edp_key, grad_norm_sqr, grad_variance,
+                       grad_norm_sqr_std=0.0, grad_variance_std=0.0):
     global _GRAD_PARAM_DICT
     # print("input:", grad_norm_sqr, grad_variance)
-    _GRAD_PARAM_DICT[edp_key] = np.asarray([grad_norm_sqr, grad_variance])
+    _GRAD_PARAM_DICT[edp_key] = np.asarray([grad_norm_sqr, grad_variance,
+                                            grad_norm_sqr_std ** 2,
+                                            grad_variance_std ** 2])
     # print("dictionary", _GRAD_PARAM_DICT[edp_key])
     grad_params = sum(_GRAD_PARAM_DICT.values())
     # print("grad params:", grad_params)
-    _metrics_state().grad_params = (grad_params[0], grad_params[1])
+    state = _metrics_state()
+    state.grad_params = (grad_params[0], grad_params[1])
+    _exporter.GRAD_SQR.set(grad_params[0])
+    _exporter.GRAD_VAR.set(grad_params[1])
+    # The efficiency only depends on the ratio var / sqr, so its log-scale
+    # error is bounded by the relative error of that ratio.
+    state.grad_err = float(np.sqrt(
+        grad_params[2] / max(grad_params[0], 1e-8) ** 2 +
+        grad_params[3] / max(grad_params[1], 1e-8) ** 2))
+
+
+def profile_switch(elapsed, atomic_bsz, switched):
+    """
+    Records the time taken to reach the end of the first step after the
+    batch size was re-synchronized, which includes respawning the data loader
+    workers and warming up the new batch size. Only the excess over the
+    profiled step time is counted.
+
+    Arguments:
+        elapsed (float): Seconds from re-synchronization to the end of the
+            first step.
+        atomic_bsz (int): Batch size the first step was profiled with.
+        switched (bool): Whether the batch size configuration was changed.
+    """
+    state = _metrics_state()
+    key = (adaptdl.env.num_nodes(), adaptdl.env.num_replicas(), atomic_bsz)
+    if not state.profile.get(key, {}).get("optim_count"):
+        return  # Unknown steady-state step time, nothing to compare with.
+    step_time = (state.profile[key]["optim_step_time"] /
+                 state.profile[key]["optim_count"])
+    prefix = "switch" if switched else "stay"
+    state.switch_profile[prefix + "_time"] += max(elapsed - step_time, 0.0)
+    state.switch_profile[prefix + "_count"] += 1
+
+
+def get_switch_cost():
+    """
+    Measured cost in seconds of switching the batch size configuration, in
+    excess of the overhead which is incurred when it is kept the same.
+
+    Returns (float): Switching cost, or 0.0 if not yet measured.
+    """
+    switch_profile = _metrics_state().switch_profile
+    if not switch_profile["switch_count"]:
+        return 0.0
+    cost = switch_profile["switch_time"] / switch_profile["switch_count"]
+    if switch_profile["stay_count"]:
+        cost -= switch_profile["stay_time"] / switch_profile["stay_count"]
+    return max(cost, 0.0)
 
 
 def update_progress(progress):
     _metrics_state().progress = progress
+    _exporter.PROGRESS.set(progress)
 
 
 def get_progress():
@@ -106,17 +240,133 @@ def set_batch_size(init_batch_size, max_batch_size, local_bsz_bounds,
     state.gradient_accumulation = gradient_accumulation
 
 
+def probe_max_atomic_bsz(probe_fn, min_bsz, max_bsz):
+    """
+    Finds the largest atomic batch size between min_bsz and max_bsz which
+    fits in the memory of the local device, by running probe_fn at doubling
+    batch sizes until it runs out of memory, and then binary searching. The
+    peak memory of each batch size which fits is recorded. Devices of a class
+    which was already probed, e.g. before a restart, are not probed again.
+    Must be invoked by all replicas.
+
+    Arguments:
+        probe_fn (callable): Runs a forward and backward pass at the batch
+            size it is called with.
+        min_bsz (int): Smallest batch size to probe, assumed to fit.
+        max_bsz (int): Largest batch size to probe.
+
+    Returns (dict): Device class -> max atomic batch size of all replicas.
+    """
+    state = _metrics_state()
+    device_class = _device_class()
+    max_atomic_bsz = state.device_max_atomic_bsz.get(device_class)
+    if max_atomic_bsz is None:
+        max_atomic_bsz = _probe(probe_fn, min_bsz, max_bsz)
+    # Replicas of the same device class may have different memory free.
+    gathered = adaptdl.collective.allreduce(
+        {device_class: max_atomic_bsz},
+        lambda a, b: {k: min(a.get(k, v), v) for k, v in {**a, **b}.items()})
+    state.device_max_atomic_bsz.update(gathered)
+    _exporter.MAX_ATOMIC_BSZ.set(state.device_max_atomic_bsz[device_class])
+    return gathered
+
+
+def _probe(probe_fn, min_bsz, max_bsz):
+    def fits(bsz):
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        try:
+            probe_fn(bsz)
+        except RuntimeError as exc:  # Including torch.cuda.OutOfMemoryError.
+            if "out of memory" not in str(exc):
+                raise
+            oom = True
+        else:
+            oom = False
+        if torch.cuda.is_available():
+            if not oom:
+                state.peak_memory[bsz] = max(state.peak_memory.get(bsz, 0),
+                                             torch.cuda.max_memory_allocated())
+            torch.cuda.empty_cache()
+        return not oom
+
+    state = _metrics_state()
+    low, high = min_bsz, None  # Largest which fits, smallest which does not.
+    while high is None and low < max_bsz:
+        bsz = min(2 * low, max_bsz)
+        if fits(bsz):
+            low = bsz
+        else:
+            high = bsz
+    while high is not None and high - low > 1:
+        bsz = (low + high) // 2
+        if fits(bsz):
+            low = bsz
+        else:
+            high = bsz
+    LOG.info("max atomic batch size of %s is %s", _device_class(), low)
+    return low
+
+
+def get_local_bsz_bounds(local_bsz_bounds, device_class=None):
+    """
+    Local batch size bounds of a device class, defaults to the local one.
+    The max local batch size is capped at the probed max atomic batch size,
+    see :func:`probe_max_atomic_bsz`. Otherwise, it is raised by how many more
+    examples fit in the memory freed by the optimizer on the local device,
+    see :func:`profile_freed_memory`. The memory used by each example is
+    estimated from the peak memory measured at different batch sizes.
+
+    Returns (tuple): The (min_local_bsz, max_local_bsz) bounds.
+    """
+    state = _metrics_state()
+    local = device_class is None or device_class == _device_class()
+    device_class = device_class or _device_class()
+    probed = state.device_max_atomic_bsz.get(device_class)
+    if probed is not None:
+        # Measured directly, including any memory freed by the optimizer.
+        low, high = local_bsz_bounds or (None, None)
+        return (low, probed if high is None else min(high, probed))
+    if not local or not local_bsz_bounds or local_bsz_bounds[1] is None or \
+            not state.freed_memory or not state.peak_memory:
+        return local_bsz_bounds
+    atomic_bsz, peak_memory = (np.array(v, dtype=np.float64) for v in
+                               zip(*sorted(state.peak_memory.items())))
+    # Includes the memory taken by the model itself if only one batch size
+    # was measured, which underestimates the examples that fit.
+    example_memory = peak_memory[-1] / atomic_bsz[-1]
+    if len(atomic_bsz) > 1:
+        slope = np.polyfit(atomic_bsz, peak_memory, 1)[0]
+        if slope > 0:
+            example_memory = slope
+    extra = int(state.freed_memory // example_memory)
+    return (local_bsz_bounds[0], local_bsz_bounds[1] + extra)
+
+
 def get_goodput_fn():
     state = _metrics_state()
     if state.grad_params is None or state.perf_params is None:
         return None
     return GoodputFunction(state.perf_params, state.grad_params,
-                           state.init_batch_size)
+                           state.init_batch_size, perf_err=state.perf_err,
+                           grad_err=state.grad_err)
 
 
 def _fit_perf_params():
     state = _metrics_state()
-    profile = {k: v for k, v in state.profile.items() if v.get("optim_count")}
+    sketches = {}
+    _add_sketches(sketches, state.device_sketches.get(_device_class(), {}))
+    _add_sketches(sketches, state.sketches)
+    state.perf_params, state.perf_err = _fit_profile(state.profile, sketches)
+
+
+# Quantiles between which step times are averaged for fitting, excluding
+# outliers like garbage collection pauses, checkpoint stalls and warmups.
+_TRIM_QUANTILES = (0.1, 0.9)
+
+
+def _fit_profile(profile, sketches=None):
+    profile = {k: v for k, v in profile.items() if v.get("optim_count")}
     # Convert profile into numpy arrays.
     num_nodes, num_replicas, atomic_bsz = (
         np.array(k) for k in zip(*profile.keys()))
@@ -139,9 +389,112 @@ def _fit_perf_params():
     print("check some parameters:", accum_step_time, optim_step_time, optim_sync_time)
     accum_step_time /= accum_count
     optim_step_time /= optim_count
+    # Prefer robust estimates from the step time distributions if available.
+    for i, key in enumerate(profile):
+        compute = (sketches or {}).get(key, {}).get("compute_time")
+        optim = (sketches or {}).get(key, {}).get("optim_step_time")
+        if compute and optim:
+            accum_step_time[i] = compute.trimmed_mean(*_TRIM_QUANTILES)
+            optim_step_time[i] = optim.trimmed_mean(*_TRIM_QUANTILES)
     print("check some parameters:", accum_step_time, optim_step_time)
-    state.perf_params = fit_perf_params(num_nodes, num_replicas, atomic_bsz,
-                                        accum_step_time, optim_step_time)
+    perf_params = fit_perf_params(num_nodes, num_replicas, atomic_bsz,
+                                  accum_step_time, optim_step_time)
+    perf_err = perf_fit_error(perf_params, num_nodes, num_replicas,
+                              atomic_bsz, accum_step_time, optim_step_time)
+    return perf_params, perf_err
+
+
+def _device_class():
+    # Replicas running on the same kind of device share a profile.
+    if torch.cuda.is_available():
+        return torch.cuda.get_device_name()
+    return "cpu"
+
+
+def _copy_profile(profile):
+    copy = collections.defaultdict(collections.Counter)
+    for key, val in profile.items():
+        copy[key] = collections.Counter(val)
+    return copy
+
+
+def _subtract_profile(profile, base):
+    delta = {}
+    for key, val in profile.items():
+        diff = collections.Counter({k: v - base.get(key, {}).get(k, 0)
+                                    for k, v in val.items()})
+        if any(diff.values()):
+            delta[key] = diff
+    return delta
+
+
+def _profile_delta():
+    # Measurements taken locally since the profiles were last merged. The
+    # local sketches are handed over and replaced with empty ones.
+    state = _metrics_state()
+    sketches = dict(state.sketches)
+    state.sketches = collections.defaultdict(dict)
+    return (_device_class(),
+            _subtract_profile(state.profile, state.profile_base), sketches)
+
+
+def _merge_profiles(deltas, snapshot=None):
+    # Merge the per-device deltas gathered from all replicas into the device
+    # profiles. Local measurements taken after the deltas were computed (at
+    # the time of snapshot) are kept in the local profile.
+    state = _metrics_state()
+    extra = (_subtract_profile(state.profile, snapshot)
+             if snapshot is not None else {})
+    for device_class, delta, sketches in deltas:
+        profile = state.device_profiles.setdefault(
+            device_class, collections.defaultdict(collections.Counter))
+        for key, val in delta.items():
+            profile[key].update(val)
+        _add_sketches(state.device_sketches.setdefault(device_class, {}),
+                      sketches)
+    merged = state.device_profiles.get(_device_class(), {})
+    state.profile_base = _copy_profile(merged)
+    # Update in place, references to the local profile remain valid.
+    state.profile.clear()
+    state.profile.update(_copy_profile(merged))
+    for key, val in extra.items():
+        state.profile[key].update(val)
+
+
+def _sync_profiles():
+    delta = _profile_delta()
+    if adaptdl.env.num_replicas() > 1:
+        deltas = adaptdl.collective.allreduce([delta], lambda a, b: a + b)
+    else:
+        deltas = [delta]
+    _merge_profiles(deltas)
+
+
+# Version of the layout written by _MetricsState.save. Checkpoints written
+# before it was versioned start with the profile instead.
+_STATE_VERSION = 1
+
+_PROFILE_FIELDS = ("accum_step_time", "accum_count", "optim_step_time",
+                   "optim_sync_time", "optim_count")
+
+
+def _pack_profile(profile):
+    # One row of (num_nodes, num_replicas, atomic_bsz, *_PROFILE_FIELDS) per
+    # profiled configuration.
+    return np.array([list(key) + [val.get(f, 0) for f in _PROFILE_FIELDS]
+                     for key, val in profile.items()],
+                    dtype=np.float64).reshape(-1, 3 + len(_PROFILE_FIELDS))
+
+
+def _unpack_profile(array):
+    profile = collections.defaultdict(collections.Counter)
+    for row in array:
+        key = tuple(int(x) if float(x).is_integer() else float(x)
+                    for x in row[:3])
+        for field, val in zip(_PROFILE_FIELDS, row[3:]):
+            profile[key][field] = (int(val) if field.endswith("_count")
+                                   else float(val))
+    return profile
 
 
 def _get_sched_hints():
@@ -152,40 +505,92 @@ def _get_sched_hints():
     return _metrics_state()
 
 
-def _report_sched_hints():
-    # assert adaptdl.env.replica_rank() == 0
+def _get_sched_hints_for(perf_params, profile, device_class=None):
     state = _metrics_state()
     # Scheduling hints
     sched_hints = SCHED_HINTS.copy()
     sched_hints["perfParams"] = {k: v for (k, v) in
                                  zip(PERF_PARAMS.keys(),
-                                 state.perf_params)}
+                                 perf_params)}
     sched_hints["maxBatchSize"] = state.max_batch_size
-    sched_hints["localBszBounds"] = state.local_bsz_bounds
+    sched_hints["localBszBounds"] = get_local_bsz_bounds(
+        state.local_bsz_bounds, device_class)
     sched_hints["initBatchSize"] = state.init_batch_size
     if state.grad_params:
         sched_hints["gradParams"] = {}
         sched_hints["gradParams"]["norm"] = state.grad_params[0]
         sched_hints["gradParams"]["var"] = state.grad_params[1]
-    sched_hints["maxProfiledReplicas"] = max(key[1] for key in state.profile)
+    sched_hints["maxProfiledReplicas"] = max(key[1] for key in profile)
     sched_hints["gradientAccumulation"] = state.gradient_accumulation
-    post_sched_hints(sched_hints, adaptdl.env.job_id())
+    return sched_hints
+
+
+def _report_sched_hints():
+    global _REPORTER
+    assert adaptdl.env.replica_rank() == 0
+    state = _metrics_state()
+    # Fit each device class separately, and report for the whole job.
+    device_hints = []
+    for device_class, profile in state.device_profiles.items():
+        if device_class == _device_class():
+            perf_params = state.perf_params
+        elif any(v.get("optim_count") for v in profile.values()):
+            perf_params, _ = _fit_profile(
+                profile, state.device_sketches.get(device_class))
+        else:
+            continue
+        state.device_perf_params[device_class] = perf_params
+        device_hints.append(_get_sched_hints_for(perf_params, profile,
+                                                 device_class))
+    if _REPORTER is None:
+        _REPORTER = SchedHintsReporter(adaptdl.env.job_id())
+    _REPORTER.submit(merge_sched_hints(device_hints))
 
 
 class _MetricsState(adaptdl.checkpoint.State):
     def __init__(self):
         super().__init__("adaptdl-metrics")
+        # Profile of the local device class, including local measurements
+        # which are not yet merged with the other replicas.
         self.profile = collections.defaultdict(collections.Counter)
+        # The local profile as of the last merge.
+        self.profile_base = collections.defaultdict(collections.Counter)
+        # Device class -> merged profile of all replicas of that class.
+        self.device_profiles = {}
+        # Step time sketches of the local measurements which are not yet
+        # merged, and of each device class, for each profile key.
+        self.sketches = collections.defaultdict(dict)
+        self.device_sketches = {}
+        # Device class -> perf params fitted to its profile.
+        self.device_perf_params = {}
         self.perf_params = None
         self.grad_params = None
+        # Log-scale errors of the perf and grad params, see GoodputFunction.
+        self.perf_err = 0.0
+        self.grad_err = 0.0
+        # Overheads of the first step after batch size re-synchronization.
+        self.switch_profile = collections.Counter()
         self.init_batch_size = None
         self.max_batch_size = None
         self.local_bsz_bounds = None
         self.gradient_accumulation = False
         self.progress = 0.0  # Progress in scale-invariant iterations.
+        # Device class -> probed max atomic batch size.
+        self.device_max_atomic_bsz = {}
+        # Not saved, since they depend on the device and number of replicas.
+        self.freed_memory = 0  # Bytes, see profile_freed_memory.
+        self.peak_memory = {}  # Atomic batch size -> peak bytes allocated.
+
+    def sync(self):
+        _sync_profiles()
 
     def save(self, fileobj):
-        pickle.dump(self.profile, fileobj)
+        pickle.dump(_STATE_VERSION, fileobj)
+        pickle.dump({device_class: _pack_profile(profile) for
+                     device_class, profile in self.device_profiles.items()},
+                    fileobj)
+        pickle.dump(self.device_sketches, fileobj)
+        pickle.dump(self.device_perf_params, fileobj)
         pickle.dump(self.perf_params, fileobj)
         pickle.dump(self.grad_params, fileobj)
         pickle.dump(self.init_batch_size, fileobj)
@@ -193,9 +598,44 @@ class _MetricsState(adaptdl.checkpoint.State):
         pickle.dump(self.local_bsz_bounds, fileobj)
         pickle.dump(self.gradient_accumulation, fileobj)
         pickle.dump(self.progress, fileobj)
+        pickle.dump((self.perf_err, self.grad_err), fileobj)
+        pickle.dump(self.switch_profile, fileobj)
+        pickle.dump(self.device_max_atomic_bsz, fileobj)
 
     def load(self, fileobj):
-        self.profile = pickle.load(fileobj)
+        version = pickle.load(fileobj)
+        if not isinstance(version, int):
+            self._load_unversioned(version, fileobj)
+            return
+        if version > _STATE_VERSION:
+            raise ValueError("unsupported metrics state version {}"
+                             .format(version))
+        self.device_profiles = {
+            device_class: _unpack_profile(array) for
+            device_class, array in pickle.load(fileobj).items()}
+        self.device_sketches = pickle.load(fileobj)
+        self.device_perf_params = pickle.load(fileobj)
+        self.profile = _copy_profile(
+            self.device_profiles.get(_device_class(), {}))
+        self.profile_base = _copy_profile(self.profile)
+        self.perf_params = self.device_perf_params.get(
+            _device_class(), pickle.load(fileobj))
+        self.grad_params = pickle.load(fileobj)
+        self.init_batch_size = pickle.load(fileobj)
+        self.max_batch_size = pickle.load(fileobj)
+        self.local_bsz_bounds = pickle.load(fileobj)
+        self.gradient_accumulation = pickle.load(fileobj)
+        self.progress = pickle.load(fileobj)
+        self.perf_err, self.grad_err = pickle.load(fileobj)
+        self.switch_profile = pickle.load(fileobj)
+        self.device_max_atomic_bsz = pickle.load(fileobj)
+
+    def _load_unversioned(self, profile, fileobj):
+        # Written before profiles were kept for each device class, so the
+        # profile is assumed to be of the local one.
+        self.profile = _copy_profile(profile)
+        self.profile_base = _copy_profile(profile)
+        self.device_profiles = {_device_class(): _copy_profile(profile)}
         self.perf_params = pickle.load(fileobj)
         self.grad_params = pickle.load(fileobj)
         self.init_batch_size = pickle.load(fileobj)
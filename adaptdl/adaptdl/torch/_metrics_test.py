@@ -13,7 +13,11 @@
 # limitations under the License.
 
 
+import numpy as np
 import pytest
+from unittest.mock import Mock
+
+from adaptdl._sketch import QuantileSketch
 
 from adaptdl.conftest import elastic_multiprocessing
 
@@ -156,3 +160,211 @@ def test_profile_accumulation(num_replicas):
         assert profile[key]["optim_count"] == 2
         assert profile[key]["optim_sync_time"] == 12.0
         assert profile[key]["optim_step_time"] > old_step_time > 0.0
+
+
+@elastic_multiprocessing
+def test_switch_cost():
+    from adaptdl.torch._metrics import (
+            profile_step_start, profile_step_commit, profile_switch,
+            get_switch_cost, _metrics_state)
+    assert get_switch_cost() == 0.0
+    # Nothing is recorded without a profiled step time.
+    profile_switch(1.0, 2, switched=True)
+    assert get_switch_cost() == 0.0
+    profile_step_start(2)
+    profile_step_commit()
+    step_time = _metrics_state().profile[(1, 1, 2)]["optim_step_time"]
+    profile_switch(step_time + 3.0, 2, switched=True)
+    assert np.isclose(get_switch_cost(), 3.0)
+    # Overheads also incurred without switching are not counted.
+    profile_switch(step_time + 1.0, 2, switched=False)
+    assert np.isclose(get_switch_cost(), 2.0)
+    profile_switch(step_time + 5.0, 2, switched=False)
+    assert get_switch_cost() == 0.0
+
+
+@elastic_multiprocessing
+def test_local_bsz_bounds():
+    from adaptdl.torch._metrics import (
+            profile_freed_memory, get_local_bsz_bounds, _metrics_state)
+    state = _metrics_state()
+    state.peak_memory = {8: 1000 + 8 * 100}
+    # Nothing is freed yet.
+    assert get_local_bsz_bounds((4, 16)) == (4, 16)
+    profile_freed_memory(1000)
+    # Per-example memory overestimated from a single batch size.
+    assert get_local_bsz_bounds((4, 16)) == (4, 16 + 1000 // 225)
+    state.peak_memory[16] = 1000 + 16 * 100
+    assert get_local_bsz_bounds((4, 16)) == (4, 26)
+    # No ceiling to raise.
+    assert get_local_bsz_bounds((4, None)) == (4, None)
+    assert get_local_bsz_bounds(None) is None
+
+
+@pytest.mark.parametrize("num_replicas", [3])
+@elastic_multiprocessing
+def test_probe_max_atomic_bsz(num_replicas):
+    import adaptdl.checkpoint
+    import adaptdl.collective
+    import adaptdl.torch._metrics as metrics
+    from adaptdl.env import num_restarts, replica_rank
+    if num_restarts() == 0:
+        return num_replicas
+    adaptdl.collective.initialize("0.0.0.0")
+    # Ranks 0 and 2 share a device class, but rank 2 has less memory free.
+    device_class = "dev{}".format(replica_rank() % 2)
+    metrics._device_class = lambda: device_class
+    limit = [40, 100, 37][replica_rank()]
+    probed = []
+
+    def probe_fn(bsz):
+        probed.append(bsz)
+        if bsz > limit:
+            raise RuntimeError("CUDA out of memory")
+
+    result = metrics.probe_max_atomic_bsz(probe_fn, 4, 64)
+    if num_restarts() == 1:
+        assert result == {"dev0": 37, "dev1": 64}
+        assert len(probed) < 10
+        assert metrics.get_local_bsz_bounds((4, None)) == \
+            (4, result[device_class])
+        assert metrics.get_local_bsz_bounds((4, 16), "dev0") == (4, 16)
+        assert metrics.get_local_bsz_bounds(None, "dev1") == (None, 64)
+        adaptdl.checkpoint.save_all_states()
+        return num_replicas
+    # Not probed again after restarting on the same devices.
+    assert not probed
+    assert result == {"dev0": 37, "dev1": 64}
+
+
+@pytest.mark.parametrize("num_replicas", [2])
+@elastic_multiprocessing
+def test_report_sched_hints(num_replicas):
+    import adaptdl.collective
+    import adaptdl.torch._metrics as metrics
+    from adaptdl.env import num_restarts, replica_rank
+    if num_restarts() == 0:
+        return num_replicas
+    adaptdl.collective.initialize("0.0.0.0")
+    submitted = []
+    metrics._REPORTER = Mock(submit=submitted.append)
+    metrics.set_batch_size(8, None, None, False)
+    for step in range(metrics._NEXT_REPORT + 1):
+        metrics.profile_step_start(4 + replica_rank())
+        metrics.profile_sync_time(0.0)
+        metrics.profile_step_commit()
+    # Hints gathered from all replicas are reported once, by rank 0 only.
+    assert metrics._REPORT_FUTURE is None
+    assert metrics._NEXT_REPORT > metrics._OPTIM_STEPS
+    assert len(submitted) == (1 if replica_rank() == 0 else 0)
+
+
+@pytest.mark.parametrize("num_replicas", [3])
+@elastic_multiprocessing
+def test_device_profiles(num_replicas):
+    import adaptdl.checkpoint
+    import adaptdl.collective
+    import adaptdl.torch._metrics as metrics
+    from adaptdl.env import num_restarts, replica_rank
+    if num_restarts() == 0:
+        return num_replicas
+    # Ranks 0 and 2 share a device class, rank 1 is different.
+    device_class = "dev{}".format(replica_rank() % 2)
+    metrics._device_class = lambda: device_class
+    if num_restarts() == 1:
+        adaptdl.collective.initialize("0.0.0.0")
+        state = metrics._metrics_state()
+        for _ in range(2):
+            metrics.profile_step_start(replica_rank() + 1)
+            metrics.profile_sync_time(0.0)
+            metrics.profile_step_commit()
+        adaptdl.checkpoint.save_all_states()
+        # Merged profiles contain each device's measurements separately.
+        assert state.device_profiles.keys() == {"dev0", "dev1"}
+        assert state.device_profiles["dev0"].keys() == {(1, 3, 1), (1, 3, 3)}
+        assert state.device_profiles["dev1"].keys() == {(1, 3, 2)}
+        assert state.device_profiles["dev1"][(1, 3, 2)]["optim_count"] == 2
+        assert state.profile == state.device_profiles[device_class]
+        return num_replicas
+    # Each device class is restored from the checkpoint.
+    state = metrics._metrics_state()
+    assert state.device_profiles.keys() == {"dev0", "dev1"}
+    assert state.profile == state.device_profiles[device_class]
+    if device_class == "dev1":
+        assert state.profile[(1, 3, 2)]["optim_count"] == 2
+        assert isinstance(state.profile[(1, 3, 2)]["optim_count"], int)
+    else:
+        assert state.profile[(1, 3, 3)]["optim_count"] == 2
+
+
+@elastic_multiprocessing
+def test_robust_fit():
+    import adaptdl.checkpoint
+    from adaptdl.env import num_restarts
+    from adaptdl.torch._metrics import (
+            profile_step_start, profile_step_commit, _metrics_state,
+            _fit_profile)
+    if num_restarts() == 0:
+        profile_step_start(4)
+        profile_step_commit()
+        state = _metrics_state()
+        sketches = state.sketches[(1, 1, 4)]
+        assert len(sketches["optim_step_time"]) == 1
+        assert len(sketches["compute_time"]) == 1
+        adaptdl.checkpoint.save_all_states()
+        # Local sketches are merged into the device sketches on sync.
+        assert not state.sketches
+        return 1
+    state = _metrics_state()
+    (device_sketches,) = state.device_sketches.values()
+    assert len(device_sketches[(1, 1, 4)]["optim_step_time"]) == 1
+    # Steady step times, with a few long stalls in one configuration.
+    for atomic_bsz in (4, 8):
+        key = (1, 1, atomic_bsz)
+        for i in range(100):
+            stall = atomic_bsz == 8 and i % 20 == 0
+            step_time = 10.0 if stall else 0.01 * atomic_bsz
+            state.profile[key]["optim_step_time"] += step_time
+            state.profile[key]["optim_count"] += 1
+            for name in ("compute_time", "optim_step_time"):
+                if name not in state.sketches[key]:
+                    state.sketches[key][name] = QuantileSketch()
+                state.sketches[key][name].add(step_time)
+    mean_params, _ = _fit_profile(state.profile)
+    robust_params, robust_err = _fit_profile(state.profile, state.sketches)
+    # The stalls inflate the fitted compute time unless they are trimmed.
+    assert mean_params.beta_c > 2 * robust_params.beta_c
+    assert np.isclose(robust_params.beta_c, 0.01, rtol=0.1)
+    assert robust_err < 0.1
+
+
+@elastic_multiprocessing
+def test_load_unversioned():
+    import io
+    import pickle
+    import adaptdl.torch._metrics as metrics
+    from adaptdl.goodput import GradParams, PerfParams
+    # Layout of checkpoints written before the state was versioned.
+    profile = {(1, 2, 8): {"optim_step_time": 1.0, "optim_count": 4}}
+    perf_params = PerfParams(*range(7))
+    fileobj = io.BytesIO()
+    for obj in (profile, perf_params, GradParams(1.0, 2.0), 32, 1024,
+                (16, 64), True, 10.0):
+        pickle.dump(obj, fileobj)
+    fileobj.seek(0)
+    state = metrics._metrics_state()
+    state.load(fileobj)
+    assert state.profile[(1, 2, 8)]["optim_count"] == 4
+    assert state.device_profiles == {metrics._device_class(): state.profile}
+    assert state.perf_params == perf_params
+    assert state.grad_params == GradParams(1.0, 2.0)
+    assert state.local_bsz_bounds == (16, 64)
+    assert state.gradient_accumulation and state.progress == 10.0
+    # Saved again with the current layout.
+    fileobj = io.BytesIO()
+    state.save(fileobj)
+    fileobj.seek(0)
+    state.profile, state.perf_params = None, None
+    state.load(fileobj)
+    assert state.profile[(1, 2, 8)]["optim_count"] == 4
+    assert state.perf_params == perf_params
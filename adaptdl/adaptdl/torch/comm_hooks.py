@@ -0,0 +1,235 @@
+# Copyright 2020 Petuum, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Communication hooks for :class:`adaptdl.torch.AdaptiveDataParallel`, which
+sum the gradients of all replicas weighted by their share of the total batch
+size. They can be passed as the ``comm_hook`` argument of
+``AdaptiveDataParallel``.
+"""
+
+import torch
+import torch.distributed as dist
+
+import adaptdl.env
+
+import adaptdl.torch.data
+from adaptdl.torch._metrics import profile_comm_bytes
+
+__all__ = ["proportional_allreduce_hook", "fp16_compress_hook",
+           "bf16_compress_hook", "PowerSGDState", "powersgd_hook"]
+
+
+def _allreduce_fut_proportion(process_group, tensor, dtype=None):
+    # Weights the input tensor in place by the data share of this replica,
+    # optionally compresses it to dtype, and sums it across all replicas.
+    # Returns a future holding the result in the input tensor.
+    group_to_use = process_group if process_group is not None \
+        else dist.group.WORLD
+    # Apply the weight first to avoid overflow, especially for FP16.
+    tensor.mul_(adaptdl.torch.data.grad_ratio())
+    if dtype is None or dtype == tensor.dtype:
+        compressed = tensor
+    else:
+        compressed = tensor.to(dtype)
+    profile_comm_bytes(tensor.numel() * tensor.element_size(),
+                       compressed.numel() * compressed.element_size())
+    fut = dist.all_reduce(compressed, group=group_to_use,
+                          async_op=True).get_future()
+
+    def decompress(fut):
+        if compressed is not tensor:
+            tensor.copy_(fut.value()[0])
+        return tensor
+
+    return fut.then(decompress)
+
+
+def proportional_allreduce_hook(process_group, bucket):
+    """
+    Sums the gradients of all replicas weighted by their data shares.
+    """
+    return _allreduce_fut_proportion(process_group, bucket.buffer())
+
+
+def fp16_compress_hook(process_group, bucket):
+    """
+    Like :func:`proportional_allreduce_hook`, but sends the weighted gradients
+    as float16, halving the communicated bytes.
+    """
+    return _allreduce_fut_proportion(process_group, bucket.buffer(),
+                                     torch.float16)
+
+
+def bf16_compress_hook(process_group, bucket):
+    """
+    Like :func:`proportional_allreduce_hook`, but sends the weighted gradients
+    as bfloat16, halving the communicated bytes without the risk of overflow.
+    Requires a backend with bfloat16 support, such as NCCL.
+    """
+    return _allreduce_fut_proportion(process_group, bucket.buffer(),
+                                     torch.bfloat16)
+
+
+class PowerSGDState(object):
+    """
+    State of :func:`powersgd_hook`, which should be passed together with it
+    as the ``comm_state`` argument of ``AdaptiveDataParallel``. It is saved
+    and restored with the other state of ``AdaptiveDataParallel``.
+
+    Arguments:
+        process_group (ProcessGroup): Process group to communicate in,
+            defaults to all replicas.
+        rank (int): Rank of the low-rank approximation of each gradient.
+        start_iter (int): Number of optimizer steps to all-reduce densely at
+            first, until the gradient buckets are finalized.
+        seed (int): Seed for the random initial projections, must be the
+            same on every replica.
+    """
+    def __init__(self, process_group=None, rank=1, start_iter=10, seed=0):
+        self.process_group = process_group
+        self.rank = rank
+        self.start_iter = start_iter
+        self.seed = seed
+        self.iter = 0
+        # Bucket index -> compression residual of this replica.
+        self.errors = {}
+        # Bucket index -> flattened projections, reused as warm starts.
+        self.qs = {}
+        self._saved_errors = None
+
+    def sync(self):
+        # The residuals of each replica only matter in total, since they
+        # are re-added before summing. Save their sum so that it can be
+        # split among any number of replicas after restarting.
+        group = self.process_group or dist.group.WORLD
+        self._saved_errors = {}
+        for index, error in self.errors.items():
+            error = error.clone()
+            dist.all_reduce(error, group=group)
+            self._saved_errors[index] = error.cpu()
+
+    def state_dict(self):
+        errors = self._saved_errors
+        if errors is None:
+            errors = {index: error.cpu() for index, error in
+                      self.errors.items()}
+        return {"iter": self.iter, "errors": errors,
+                "qs": {index: q.cpu() for index, q in self.qs.items()}}
+
+    def load_state_dict(self, state_dict):
+        num_replicas = adaptdl.env.num_replicas()
+        self.iter = state_dict["iter"]
+        self.errors = {index: error / num_replicas for index, error in
+                       state_dict["errors"].items()}
+        self.qs = dict(state_dict["qs"])
+
+
+def _orthogonalize(matrix):
+    matrix.copy_(torch.linalg.qr(matrix).Q)
+
+
+def _powersgd_fut(state, index, buffer, tensors):
+    # Sums the weighted buffer across replicas using low-rank approximations
+    # of its matrices, as in PowerSGD (https://arxiv.org/abs/1905.13727),
+    # and writes the result into buffer. Tensors are views of the buffer.
+    group = state.process_group or dist.group.WORLD
+    ratio = adaptdl.torch.data.grad_ratio()
+    buffer.mul_(ratio)
+    error = state.errors.get(index)
+    if error is not None and error.shape == buffer.shape:
+        buffer.add_(error.to(buffer.device))
+    local = buffer.clone()
+
+    matrices, dense = [], []
+    for tensor in tensors:
+        n = tensor.shape[0] if tensor.ndim > 1 else 1
+        m = tensor.numel() // n
+        rank = min(n, m, state.rank)
+        if tensor.ndim > 1 and (n + m) * rank < n * m:
+            matrices.append((tensor.view(n, m), rank))
+        else:
+            dense.append(tensor)
+    dense_flat = torch.cat([t.flatten() for t in dense]) if dense \
+        else buffer.new_empty(0)
+    dense_fut = dist.all_reduce(dense_flat, group=group,
+                                async_op=True).get_future()
+
+    p_all = buffer.new_empty(sum(mat.shape[0] * r for mat, r in matrices))
+    q_numel = sum(mat.shape[1] * r for mat, r in matrices)
+    q_all = state.qs.get(index)
+    if q_all is None or q_all.numel() != q_numel:
+        generator = torch.Generator().manual_seed(state.seed + index)
+        q_all = torch.randn(q_numel, generator=generator)
+    q_all = q_all.to(buffer.device, buffer.dtype)
+    state.qs[index] = q_all
+    ps, qs = [], []
+    p_offset = q_offset = 0
+    for mat, r in matrices:
+        n, m = mat.shape
+        ps.append(p_all[p_offset:p_offset + n * r].view(n, r))
+        qs.append(q_all[q_offset:q_offset + m * r].view(m, r))
+        p_offset += n * r
+        q_offset += m * r
+    for (mat, _), p, q in zip(matrices, ps, qs):
+        torch.matmul(mat, q, out=p)
+    p_fut = dist.all_reduce(p_all, group=group, async_op=True).get_future()
+
+    def compute_qs(fut):
+        for (mat, _), p, q in zip(matrices, ps, qs):
+            _orthogonalize(p)
+            torch.matmul(mat.t(), p, out=q)
+        return dist.all_reduce(q_all, group=group,
+                               async_op=True).get_future().wait()[0]
+
+    def decompress(fut):
+        for (mat, _), p, q in zip(matrices, ps, qs):
+            torch.matmul(p, q.t(), out=mat)
+        value = dense_fut.wait()[0]
+        offset = 0
+        for tensor in dense:
+            tensor.copy_(value[offset:offset + tensor.numel()]
+                         .view_as(tensor))
+            offset += tensor.numel()
+        # Keep what this replica's share of the sum did not get across.
+        state.errors[index] = local.sub_(buffer, alpha=ratio)
+        profile_comm_bytes(buffer.numel() * buffer.element_size(),
+                           (dense_flat.numel() + p_all.numel() + q_numel)
+                           * buffer.element_size())
+        return buffer
+
+    return p_fut.then(compute_qs).then(decompress)
+
+
+def powersgd_hook(state, bucket):
+    """
+    Sums the gradients of all replicas weighted by their data shares, but
+    communicates low-rank approximations of each gradient matrix instead of
+    the gradients themselves. What each approximation misses is added back
+    on the next step (error feedback). Vectors, such as biases, and matrices
+    too small to benefit are all-reduced densely.
+
+    Arguments:
+        state (PowerSGDState): State of the compression.
+        bucket (GradBucket): Bucket of gradients to all-reduce.
+    """
+    if state.iter < state.start_iter:
+        fut = _allreduce_fut_proportion(state.process_group, bucket.buffer())
+    else:
+        fut = _powersgd_fut(state, bucket.index(), bucket.buffer(),
+                            bucket.gradients())
+    if bucket.is_last():
+        state.iter += 1
+    return fut
@@ -0,0 +1,69 @@
+import torch
+
+from adaptdl.conftest import elastic_multiprocessing
+
+
+@elastic_multiprocessing
+def test_allreduce_fut_proportion():
+    import adaptdl.env
+    import adaptdl.torch as adl
+    import adaptdl.torch.data
+    from adaptdl.torch import _exporter
+    from adaptdl.torch.comm_hooks import _allreduce_fut_proportion
+    adl.init_process_group("gloo")
+    rank = adaptdl.env.replica_rank()
+    num_replicas = adaptdl.env.num_replicas()
+    # Unequal shares of the total batch size, in rank order.
+    shares = [rank + 1 for rank in range(num_replicas)]
+    adaptdl.torch.data.data_ratio = shares[rank] / sum(shares)
+    expected = sum(share * share for share in shares) / sum(shares)
+    for dtype in (None, torch.float16):
+        _exporter.COMM_BYTES_RAW.set(0)
+        _exporter.COMM_BYTES_SENT.set(0)
+        tensor = torch.full((4,), rank + 1.0)
+        result = _allreduce_fut_proportion(None, tensor, dtype).wait()
+        # Weighted in place, and the result is returned in the same tensor.
+        assert result is tensor
+        assert torch.allclose(result, torch.tensor(expected), rtol=1e-3)
+        assert _exporter.COMM_BYTES_RAW.value == 16
+        assert _exporter.COMM_BYTES_SENT.value == (8 if dtype else 16)
+    return [3, 0][adaptdl.env.num_restarts()]
+
+
+@elastic_multiprocessing
+def test_powersgd():
+    import torch.distributed as dist
+    import adaptdl.env
+    import adaptdl.torch as adl
+    import adaptdl.torch.data
+    from adaptdl.torch.comm_hooks import PowerSGDState, _powersgd_fut
+    adl.init_process_group("gloo")
+    rank = adaptdl.env.replica_rank()
+    num_replicas = adaptdl.env.num_replicas()
+    shares = [rank + 1 for rank in range(num_replicas)]
+    adaptdl.torch.data.data_ratio = shares[rank] / sum(shares)
+    state = PowerSGDState(rank=1)
+    torch.manual_seed(rank)
+    # A full-rank matrix, and a vector which is all-reduced densely.
+    buffer = torch.randn(6 * 4 + 3)
+    tensors = [buffer[:24].view(6, 4), buffer[24:]]
+    local = buffer * adaptdl.torch.data.data_ratio
+    expected = local.clone()
+    dist.all_reduce(expected)
+    result = _powersgd_fut(state, 0, buffer, tensors).wait()
+    assert result is buffer
+    assert torch.allclose(buffer[24:], expected[24:], atol=1e-5)
+    # The approximation is rank 1, what it misses is kept as residuals
+    # which sum to the error of the approximation across replicas.
+    assert torch.linalg.matrix_rank(buffer[:24].view(6, 4)) == 1
+    errors = state.errors[0].clone()
+    dist.all_reduce(errors)
+    assert torch.allclose(errors, expected - buffer, atol=1e-5)
+    # The residuals are saved as their sum, and split on restore.
+    state.sync()
+    restored = PowerSGDState(rank=1)
+    restored.load_state_dict(state.state_dict())
+    assert torch.allclose(restored.errors[0] * num_replicas, errors,
+                          atol=1e-5)
+    assert torch.equal(restored.qs[0], state.qs[0])
+    return [2, 0][adaptdl.env.num_restarts()]
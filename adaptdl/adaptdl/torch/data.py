@@ -17,11 +17,13 @@ from contextlib import contextmanager
 import collections
 from dataclasses import dataclass
 import functools
+import itertools
 import logging
 import math
 import numpy as np
 import pickle
 import random
+import time
 import torch
 from torch.utils.data import DataLoader, Sampler
 
@@ -30,10 +32,13 @@ from torch.utils.data import DataLoader, Sampler
 import adaptdl.checkpoint
 import adaptdl.collective
 import adaptdl.env
+import adaptdl.trace
+from adaptdl.torch import _exporter
 from adaptdl.torch.epoch import current_epoch
 from adaptdl.torch._metrics import (
-    profile_step_start, profile_step_commit,
-    set_batch_size, get_goodput_fn, get_progress)
+    profile_step_start, profile_step_commit, profile_switch,
+    set_batch_size, get_goodput_fn, get_progress, get_switch_cost,
+    get_local_bsz_bounds, probe_max_atomic_bsz)
 from adaptdl._signal import get_exit_flag
 
 logging.basicConfig(level=logging.INFO)
@@ -43,6 +48,45 @@ LOG.setLevel(logging.INFO)
 # global data_ratio 
 data_original = 0.5
 data_ratio = 0.5
+# Shares of the total batch size of all replicas, in rank order, or None if
+# unknown.
+data_shares = None
+# Number of optimizer steps each replica takes between averaging parameters
+# with the other replicas, 1 if gradients are synchronized every step.
+local_steps = 1
+# Number of backward passes (accumulation steps + 1) each replica takes per
+# optimizer step, in rank order, or None if the same on every replica.
+accum_counts = None
+
+
+def mean_accum_count():
+    """
+    Number of backward passes per optimizer step averaged over all replicas,
+    weighted by their shares of the total batch size. The synchronized
+    gradient is the average gradient of the total batch times this count.
+
+    Returns (float): Average count, or None if the same on every replica.
+    """
+    if accum_counts is None:
+        return None
+    return sum(share * count for share, count in
+               zip(data_shares, accum_counts))
+
+
+def grad_ratio():
+    """
+    Weight of the gradients of this replica in the sum over all replicas.
+    Gradients are summed over accumulation steps, so the gradients of each
+    replica are rescaled to the average number of backward passes if the
+    replicas take different numbers of accumulation steps.
+
+    Returns (float): Weight of the local gradients.
+    """
+    if accum_counts is None:
+        return data_ratio
+    count = accum_counts[adaptdl.env.replica_rank()]
+    return data_ratio * mean_accum_count() / count
+
 
 class ElasticSampler(Sampler):
     """
@@ -223,14 +267,19 @@ class HeteroAdaptiveDataLoaderHelper(object):
         # Autoscale batch size fields.
         self._max_batch_size = None
         self._local_bsz_bounds = None
+        self._max_local_steps = 1
         # Create and load state.
         self._state = _AdaptiveDataLoaderState()
         adaptdl.checkpoint.load_state(self._state)
         self.batch_size = batch_size
         self.future_exit = None
         self._gradient_accumulation = False
-        self._speedup_threshold = 1.05
         self._accum_count = 0
+        # Time of the last batch size re-synchronization, the interval since
+        # the one before it, and whether the first step after it is pending.
+        self._sync_time = None
+        self._sync_interval = None
+        self._switch_pending = None
 
     @property
     def current_index(self):
@@ -306,6 +355,14 @@ class HeteroAdaptiveDataLoaderHelper(object):
         """
         return self._state.accumulation_steps
 
+    @property
+    def local_steps(self):
+        """
+        The number of optimizer steps taken by each replica between averaging
+        parameters with the other replicas.
+        """
+        return self._state.local_steps
+
     def is_sync_step(self):
         return self._accum_count >= self._state.accumulation_steps
 
@@ -332,7 +389,8 @@ class HeteroAdaptiveDataLoaderHelper(object):
                        self.local_bsz_bounds, self._gradient_accumulation)
 
     def autoscale_batch_size(self, max_batch_size, local_bsz_bounds=None,
-                             gradient_accumulation=False):
+                             gradient_accumulation=False, max_local_steps=1,
+                             probe_fn=None):
         """
         Enables adaptive batch size. Should be invoked once after the data
         loader object is created.
@@ -340,6 +398,15 @@ class HeteroAdaptiveDataLoaderHelper(object):
             max_batch_size (int): Maximum total batch size allowed.
             local_bsz_bounds (tuple): A pair of (min_local_bsz, max_local_bsz),
                 the min and max local batch sizes allowed on each replica.
+            max_local_steps (int): Maximum number of optimizer steps each
+                replica may take between averaging parameters with the other
+                replicas (local SGD). The number of local steps is chosen
+                together with the batch size, 1 disables local SGD.
+            probe_fn (callable): Runs a forward and backward pass at the local
+                batch size it is called with. If given, the largest local
+                batch size which fits in device memory is probed on each
+                replica, and used as its max local batch size. Only probed
+                once for each type of device, including across restarts.
         Raises:
             ValueError: If any of the provided batch size bounds are invalid.
         """
@@ -352,57 +419,113 @@ class HeteroAdaptiveDataLoaderHelper(object):
                 local_bsz_bounds[1] is not None and
                 local_bsz_bounds[1] < self.batch_size):
             raise ValueError("invalid local_bsz_bounds")
+        if not isinstance(max_local_steps, int) or max_local_steps < 1:
+            raise ValueError("invalid max_local_steps")
         self._max_batch_size = max_batch_size
         self._local_bsz_bounds = local_bsz_bounds
         self._gradient_accumulation = gradient_accumulation
+        self._max_local_steps = max_local_steps
+        if probe_fn is not None:
+            bounds = local_bsz_bounds or (None, None)
+            probe_max_atomic_bsz(probe_fn, bounds[0] or 1,
+                                 bounds[1] or max_batch_size)
         self.train()
 
+    def _data_ratio(self):
+        return data_ratio
+
+    def _switch_threshold(self):
+        # Minimum speedup needed to amortize the measured cost of switching
+        # the batch size over the expected time until the next decision.
+        if not self._sync_interval:
+            return 1.0
+        return 1.0 + get_switch_cost() / self._sync_interval
+
+    def _balance_step_time(self, goodput_fn):
+        # Replicas choose their own (atomic_bsz, accum_steps) for their own
+        # devices, e.g. more accumulation steps of smaller atomic batches on
+        # devices with less memory. Replicas which are predicted to finish
+        # their optimizer steps early are given more examples, so that all
+        # replicas synchronize gradients at about the same time.
+        num_nodes = adaptdl.env.num_nodes()
+        num_replicas = adaptdl.env.num_replicas()
+        config = (self._state.current_local_bsz,
+                  int(self._state.accumulation_steps),
+                  self._state.local_steps)
+        step_time = float(goodput_fn.step_time(num_nodes, num_replicas,
+                                               *config))
+        configs = adaptdl.collective.allreduce(
+            [config + (step_time,)], lambda a, b: a + b)
+        local_bszs = [bsz * (accum + 1) for bsz, accum, _, _ in configs]
+        local_bsz = local_bszs[adaptdl.env.replica_rank()]
+        # Keep the total batch size within max_batch_size.
+        max_local_bsz = max(local_bsz, int(self._max_batch_size * local_bsz /
+                                           sum(local_bszs)))
+        bounds = get_local_bsz_bounds(self._local_bsz_bounds) or (None, None)
+        self._state.current_local_bsz, self._state.accumulation_steps = \
+            goodput_fn.fill_step_time(
+                num_nodes, num_replicas, config[0], config[1],
+                max(time for _, _, _, time in configs),
+                bounds[1] or self._max_batch_size, max_local_bsz,
+                accumulation=self._gradient_accumulation,
+                local_steps=config[2])
+
     def _sync_local_bsz(self):
-        global data_ratio
+        global data_ratio, data_shares, local_steps, accum_counts
+        prev_config = (self._state.current_local_bsz,
+                       self._state.accumulation_steps)
         goodput_fn = get_goodput_fn()
         if self.max_batch_size is None or goodput_fn is None:
             # No autoscale batch size, just divide batch size evenly.
             self._state.current_local_bsz = math.ceil(
                 data_original * self.batch_size)
             self._state.accumulation_steps = 0
+            self._state.local_steps = 1
         elif not self._state.current_local_bsz:
             # if init, use the batch size suggested
-            _, atomic_bsz, accum_steps = goodput_fn.optimize(
+            _, atomic_bsz, accum_steps, steps = goodput_fn.optimize(
                 adaptdl.env.num_nodes(), adaptdl.env.num_replicas(),
                 max_batch_size=self._max_batch_size,
-                atomic_bsz_range=self._local_bsz_bounds,
-                accumulation=self._gradient_accumulation)
+                atomic_bsz_range=get_local_bsz_bounds(
+                    self._local_bsz_bounds),
+                accumulation=self._gradient_accumulation,
+                max_local_steps=self._max_local_steps)
             # self._state.current_local_bsz = math.ceil(data_ratio * atomic_bsz)
             self._state.current_local_bsz = atomic_bsz
             self._state.accumulation_steps = accum_steps
+            self._state.local_steps = steps
            
         else:
             # if not first time, we check against the relative speedup
-            print(adaptdl.env.num_nodes(), adaptdl.env.num_replicas(),
-                self._max_batch_size,
-                self._local_bsz_bounds,
-                self._gradient_accumulation)
             # get current goodput
             current_goodput = goodput_fn(
                 adaptdl.env.num_nodes(), adaptdl.env.num_replicas(),
-                self.current_local_bsz, self.accumulation_steps)
-            print("current goodput", current_goodput)
-            suggest_goodput, atomic_bsz, accum_steps = goodput_fn.optimize(
-                adaptdl.env.num_nodes(), adaptdl.env.num_replicas(),
-                max_batch_size=self._max_batch_size,
-                atomic_bsz_range=self._local_bsz_bounds,
-                accumulation=self._gradient_accumulation)
+                self.current_local_bsz, self.accumulation_steps,
+                self.local_steps)
+            suggest_goodput, atomic_bsz, accum_steps, steps = \
+                goodput_fn.optimize(
+                    adaptdl.env.num_nodes(), adaptdl.env.num_replicas(),
+                    max_batch_size=self._max_batch_size,
+                    atomic_bsz_range=get_local_bsz_bounds(
+                        self._local_bsz_bounds),
+                    accumulation=self._gradient_accumulation,
+                    max_local_steps=self._max_local_steps)
             # # get current goodput
             # current_goodput = goodput_fn(
             #     adaptdl.env.num_nodes(), adaptdl.env.num_replicas(),
             #     self.current_local_bsz, self.accumulation_steps)
             # use only if speedup is significant
             speedup = suggest_goodput / max(current_goodput, 1e-8)
-            if speedup > self._speedup_threshold:
+            if goodput_fn.speedup_lower_bound(speedup) > \
+                    self._switch_threshold():
                 # self._state.current_local_bsz = math.ceil(data_ratio * atomic_bsz)
                 self._state.current_local_bsz = atomic_bsz
                 self._state.accumulation_steps = accum_steps
-            print(self._state.current_local_bsz, self._state.accumulation_steps)
+                self._state.local_steps = steps
+            LOG.debug("goodput %s, suggested %s, local batch size %s, "
+                      "accumulation steps %s", current_goodput,
+                      suggest_goodput, self._state.current_local_bsz,
+                      self._state.accumulation_steps)
         if self.max_batch_size is None or goodput_fn is None:
             self._state.current_local_bsz_broad = math.ceil(self._state.current_local_bsz / data_original)
             self._state.current_local_bsz, self._state.accumulation_steps = \
@@ -411,19 +534,53 @@ class HeteroAdaptiveDataLoaderHelper(object):
             self._state.current_local_bsz = math.ceil(self._state.current_local_bsz * data_original)
             self._state.total_bsz = self._state.current_local_bsz * adaptdl.env.num_nodes()
             data_ratio = data_original
+            data_shares = None
+            accum_counts = None
         else:
-           self._state.current_local_bsz_broad = self._state.current_local_bsz 
-           self._state.total_bsz = adaptdl.collective.allreduce(self._state.current_local_bsz_broad)
-           data_ratio = self._state.current_local_bsz / self._state.total_bsz
-           print(data_ratio)
+            self._balance_step_time(goodput_fn)
+            configs = adaptdl.collective.allreduce(
+                [(self._state.current_local_bsz,
+                  self._state.accumulation_steps,
+                  self._state.local_steps)], lambda a, b: a + b)
+            # Each replica takes its own number of accumulation steps, and
+            # synchronizes gradients after the last one.
+            local_bszs = [bsz * (accum + 1) for bsz, accum, _ in configs]
+            # Replicas must agree on when to average parameters.
+            self._state.local_steps = min(steps for _, _, steps in configs)
+            self._state.total_bsz = sum(local_bszs)
+            rank = adaptdl.env.replica_rank()
+            data_ratio = local_bszs[rank] / self._state.total_bsz
+            data_shares = tuple(bsz / self._state.total_bsz
+                                for bsz in local_bszs)
+            accum_counts = tuple(accum + 1 for _, accum, _ in configs)
+            if len(set(accum_counts)) == 1:
+                accum_counts = None
+            LOG.debug("data ratio %s of total batch size %s", data_ratio,
+                      self._state.total_bsz)
+        local_steps = self._state.local_steps
 
 
         # self._state.current_local_bsz, self._state.accumulation_steps = \
         #     adaptdl.collective.broadcast((self._state.current_local_bsz,
         #                                   self._state.accumulation_steps))
 
+        self._record_sync(prev_config)
         return self.current_local_bsz
 
+    def _record_sync(self, prev_config):
+        _exporter.REPLICAS.set(adaptdl.env.num_replicas())
+        _exporter.LOCAL_BSZ.set(self._state.current_local_bsz)
+        _exporter.ACCUMULATION_STEPS.set(self._state.accumulation_steps)
+        _exporter.LOCAL_STEPS.set(self._state.local_steps)
+        _exporter.DATA_RATIO.set(self._data_ratio())
+        now = time.time()
+        if self._sync_time is not None:
+            self._sync_interval = now - self._sync_time
+        self._sync_time = now
+        if prev_config[0]:  # Not the initial batch size decision.
+            self._switch_pending = prev_config != (
+                self._state.current_local_bsz, self._state.accumulation_steps)
+
     @property
     def training(self):
         return self is HeteroAdaptiveDataLoaderHelper._training
@@ -433,22 +590,39 @@ class HeteroAdaptiveDataLoaderHelper(object):
         """
         Every iteration of every epoch should be profiled under this context.
         Note that, custom DataLoader writers should make sure that it gets
-        called equal number of times on each replica.
+        called for the same number of optimizer steps on each replica.
         Arguments:
             commit (bool): Whether to commit the profiled results.
         """
         # Synchronize the exit signal so all replicas exit after
         # the same iteration. Do this asynchronously to prevent
         # unnecessary blocking on the network.
-        if self.future_exit is not None and self.future_exit.result():
-            adaptdl.checkpoint.save_all_states()
-            exit(143)  # Standard exit code response to SIGTERM.
-        self.future_exit = adaptdl.collective.allreduce_async(
-                    get_exit_flag(), lambda a, b: a or b)
-        profile_step_start(self._state.total_bsz)
+        # Trace dump requests are synchronized in the same way.
+        # Replicas may take different numbers of accumulation steps, so only
+        # synchronize on the last one, which every replica takes.
+        if self.future_exit is not None and self.is_optim_step():
+            exit_flag, dump_flag = self.future_exit.result()
+            self.future_exit = None
+            if dump_flag:
+                adaptdl.trace.dump()
+            if exit_flag:
+                adaptdl.checkpoint.save_all_states()
+                exit(143)  # Standard exit code response to SIGTERM.
+        if self.future_exit is None and self.is_optim_step():
+            self.future_exit = adaptdl.collective.allreduce_async(
+                (get_exit_flag(), adaptdl.trace.get_dump_flag()),
+                lambda a, b: (a[0] or b[0], a[1] or b[1]))
+        atomic_bsz = self._state.total_bsz
+        profile_step_start(atomic_bsz)
+        adaptdl.trace.step_start(atomic_bsz=atomic_bsz)
         yield
+        adaptdl.trace.step_end()
         if commit:
             profile_step_commit(self.is_accum_step())
+        if self._switch_pending is not None and self.training:
+            profile_switch(time.time() - self._sync_time, atomic_bsz,
+                           self._switch_pending)
+        self._switch_pending = None
         self._accum_count = (0 if self.is_optim_step()
                               else self._accum_count + 1)
 
@@ -540,14 +714,19 @@ class AdaptiveDataLoaderHelper(object):
         # Autoscale batch size fields.
         self._max_batch_size = None
         self._local_bsz_bounds = None
+        self._max_local_steps = 1
         # Create and load state.
         self._state = _AdaptiveDataLoaderState()
         adaptdl.checkpoint.load_state(self._state)
         self.batch_size = batch_size
         self.future_exit = None
         self._gradient_accumulation = False
-        self._speedup_threshold = -100
         self._accum_count = 0
+        # Time of the last batch size re-synchronization, the interval since
+        # the one before it, and whether the first step after it is pending.
+        self._sync_time = None
+        self._sync_interval = None
+        self._switch_pending = None
 
     @property
     def current_index(self):
@@ -614,6 +793,14 @@ class AdaptiveDataLoaderHelper(object):
         """
         return self._state.accumulation_steps
 
+    @property
+    def local_steps(self):
+        """
+        The number of optimizer steps taken by each replica between averaging
+        parameters with the other replicas.
+        """
+        return self._state.local_steps
+
     def is_sync_step(self):
         return self._accum_count >= self._state.accumulation_steps
 
@@ -640,7 +827,8 @@ class AdaptiveDataLoaderHelper(object):
                        self.local_bsz_bounds, self._gradient_accumulation)
 
     def autoscale_batch_size(self, max_batch_size, local_bsz_bounds=None,
-                             gradient_accumulation=False):
+                             gradient_accumulation=False, max_local_steps=1,
+                             probe_fn=None):
         """
         Enables adaptive batch size. Should be invoked once after the data
         loader object is created.
@@ -648,6 +836,15 @@ class AdaptiveDataLoaderHelper(object):
             max_batch_size (int): Maximum total batch size allowed.
             local_bsz_bounds (tuple): A pair of (min_local_bsz, max_local_bsz),
                 the min and max local batch sizes allowed on each replica.
+            max_local_steps (int): Maximum number of optimizer steps each
+                replica may take between averaging parameters with the other
+                replicas (local SGD). The number of local steps is chosen
+                together with the batch size, 1 disables local SGD.
+            probe_fn (callable): Runs a forward and backward pass at the local
+                batch size it is called with. If given, the largest local
+                batch size which fits in device memory is probed on each
+                replica, and used as its max local batch size. Only probed
+                once for each type of device, including across restarts.
         Raises:
             ValueError: If any of the provided batch size bounds are invalid.
         """
@@ -660,54 +857,109 @@ class AdaptiveDataLoaderHelper(object):
                 local_bsz_bounds[1] is not None and
                 local_bsz_bounds[1] < self.batch_size):
             raise ValueError("invalid local_bsz_bounds")
+        if not isinstance(max_local_steps, int) or max_local_steps < 1:
+            raise ValueError("invalid max_local_steps")
         self._max_batch_size = max_batch_size
         self._local_bsz_bounds = local_bsz_bounds
         self._gradient_accumulation = gradient_accumulation
+        self._max_local_steps = max_local_steps
+        if probe_fn is not None:
+            bounds = local_bsz_bounds or (None, None)
+            probe_max_atomic_bsz(probe_fn, bounds[0] or 1,
+                                 bounds[1] or max_batch_size)
         self.train()
 
+    def _data_ratio(self):
+        return 1 / adaptdl.env.num_replicas()
+
+    def _switch_threshold(self):
+        # Minimum speedup needed to amortize the measured cost of switching
+        # the batch size over the expected time until the next decision.
+        if not self._sync_interval:
+            return 1.0
+        return 1.0 + get_switch_cost() / self._sync_interval
+
+    def _atomic_bsz_range(self):
+        # Rank 0 picks the local batch size for all replicas, so it must fit
+        # in the memory of the replica with the smallest max local batch size.
+        # Must be invoked by all replicas.
+        bounds = get_local_bsz_bounds(self._local_bsz_bounds)
+        high = adaptdl.collective.allreduce(
+            bounds[1] if bounds else None,
+            lambda a, b: b if a is None else a if b is None else min(a, b))
+        if high is None:
+            return bounds
+        return (bounds[0] if bounds else None, high)
+
     def _sync_local_bsz(self):
+        global local_steps
+        prev_config = (self._state.current_local_bsz,
+                       self._state.accumulation_steps)
         goodput_fn = get_goodput_fn()
         if self.max_batch_size is None or goodput_fn is None:
             # No autoscale batch size, just divide batch size evenly.
             self._state.current_local_bsz = math.ceil(
                 self.batch_size / adaptdl.env.num_replicas())
             self._state.accumulation_steps = 0
+            self._state.local_steps = 1
         elif not self._state.current_local_bsz:
             # if init, use the batch size suggested
-            _, atomic_bsz, accum_steps = goodput_fn.optimize(
+            _, atomic_bsz, accum_steps, steps = goodput_fn.optimize(
                 adaptdl.env.num_nodes(), adaptdl.env.num_replicas(),
                 max_batch_size=self._max_batch_size,
-                atomic_bsz_range=self._local_bsz_bounds,
-                accumulation=self._gradient_accumulation)
+                atomic_bsz_range=self._atomic_bsz_range(),
+                accumulation=self._gradient_accumulation,
+                max_local_steps=self._max_local_steps)
             self._state.current_local_bsz = atomic_bsz
             self._state.accumulation_steps = accum_steps
+            self._state.local_steps = steps
         else:
             # if not first time, we check against the relative speedup
-            print(
-                self._max_batch_size,
-                self._local_bsz_bounds,
-                self._gradient_accumulation)
-            suggest_goodput, atomic_bsz, accum_steps = goodput_fn.optimize(
-                adaptdl.env.num_nodes(), adaptdl.env.num_replicas(),
-                max_batch_size=self._max_batch_size,
-                atomic_bsz_range=self._local_bsz_bounds,
-                accumulation=self._gradient_accumulation)
+            suggest_goodput, atomic_bsz, accum_steps, steps = \
+                goodput_fn.optimize(
+                    adaptdl.env.num_nodes(), adaptdl.env.num_replicas(),
+                    max_batch_size=self._max_batch_size,
+                    atomic_bsz_range=self._atomic_bsz_range(),
+                    accumulation=self._gradient_accumulation,
+                    max_local_steps=self._max_local_steps)
             # get current goodput
             current_goodput = goodput_fn(
                 adaptdl.env.num_nodes(), adaptdl.env.num_replicas(),
-                self.current_local_bsz, self.accumulation_steps)
+                self.current_local_bsz, self.accumulation_steps,
+                self.local_steps)
             # use only if speedup is significant
             speedup = suggest_goodput / max(current_goodput, 1e-8)
-            if speedup > self._speedup_threshold:
+            if goodput_fn.speedup_lower_bound(speedup) > \
+                    self._switch_threshold():
                 self._state.current_local_bsz = atomic_bsz
                 self._state.accumulation_steps = accum_steps
-            print(self._state.current_local_bsz, self._state.accumulation_steps)
-        self._state.current_local_bsz, self._state.accumulation_steps = \
-            adaptdl.collective.broadcast((self._state.current_local_bsz,
-                                          self._state.accumulation_steps))
-        print(self.current_local_bsz)
+                self._state.local_steps = steps
+            LOG.debug("goodput %s, suggested %s, local batch size %s, "
+                      "accumulation steps %s", current_goodput,
+                      suggest_goodput, self._state.current_local_bsz,
+                      self._state.accumulation_steps)
+        (self._state.current_local_bsz, self._state.accumulation_steps,
+         self._state.local_steps) = adaptdl.collective.broadcast(
+            (self._state.current_local_bsz, self._state.accumulation_steps,
+             self._state.local_steps))
+        local_steps = self._state.local_steps
+        self._record_sync(prev_config)
         return self.current_local_bsz
 
+    def _record_sync(self, prev_config):
+        _exporter.REPLICAS.set(adaptdl.env.num_replicas())
+        _exporter.LOCAL_BSZ.set(self._state.current_local_bsz)
+        _exporter.ACCUMULATION_STEPS.set(self._state.accumulation_steps)
+        _exporter.LOCAL_STEPS.set(self._state.local_steps)
+        _exporter.DATA_RATIO.set(self._data_ratio())
+        now = time.time()
+        if self._sync_time is not None:
+            self._sync_interval = now - self._sync_time
+        self._sync_time = now
+        if prev_config[0]:  # Not the initial batch size decision.
+            self._switch_pending = prev_config != (
+                self._state.current_local_bsz, self._state.accumulation_steps)
+
     @property
     def training(self):
         return self is AdaptiveDataLoaderHelper._training
@@ -724,15 +976,28 @@ class AdaptiveDataLoaderHelper(object):
         # Synchronize the exit signal so all replicas exit after
         # the same iteration. Do this asynchronously to prevent
         # unnecessary blocking on the network.
-        if self.future_exit is not None and self.future_exit.result():
-            adaptdl.checkpoint.save_all_states()
-            exit(143)  # Standard exit code response to SIGTERM.
+        # Trace dump requests are synchronized in the same way.
+        if self.future_exit is not None:
+            exit_flag, dump_flag = self.future_exit.result()
+            if dump_flag:
+                adaptdl.trace.dump()
+            if exit_flag:
+                adaptdl.checkpoint.save_all_states()
+                exit(143)  # Standard exit code response to SIGTERM.
         self.future_exit = adaptdl.collective.allreduce_async(
-                    get_exit_flag(), lambda a, b: a or b)
-        profile_step_start(self.current_local_bsz)
+            (get_exit_flag(), adaptdl.trace.get_dump_flag()),
+            lambda a, b: (a[0] or b[0], a[1] or b[1]))
+        atomic_bsz = self.current_local_bsz
+        profile_step_start(atomic_bsz)
+        adaptdl.trace.step_start(atomic_bsz=atomic_bsz)
         yield
+        adaptdl.trace.step_end()
         if commit:
             profile_step_commit(self.is_accum_step())
+        if self._switch_pending is not None and self.training:
+            profile_switch(time.time() - self._sync_time, atomic_bsz,
+                           self._switch_pending)
+        self._switch_pending = None
         self._accum_count = (0 if self.is_optim_step()
                              else self._accum_count + 1)
         # if self.training and self.current_index > self.current_batch_size and record:
@@ -818,9 +1083,33 @@ class AdaptiveDataLoaderMixin(object):
         self._elastic = AdaptiveDataLoaderHelper(batch_size)
 
     def autoscale_batch_size(self, max_batch_size, local_bsz_bounds=None,
-                             gradient_accumulation=False):
+                             gradient_accumulation=False, max_local_steps=1,
+                             probe_fn=None):
+        """
+        Enables adaptive batch size, see
+        :meth:`AdaptiveDataLoaderHelper.autoscale_batch_size`. If ``probe_fn``
+        is given, it is called with batches of examples from the dataset, and
+        should run the forward and backward pass of the model on them without
+        stepping the optimizer. Since it is called before the model is wrapped
+        in :class:`adaptdl.torch.AdaptiveDataParallel`, the memory of any
+        optimizer state which is not allocated yet is not accounted for.
+        """
+        if probe_fn is not None:
+            probe_fn = functools.partial(self._probe, probe_fn)
         self._elastic.autoscale_batch_size(max_batch_size, local_bsz_bounds,
-                                           gradient_accumulation)
+                                           gradient_accumulation,
+                                           max_local_steps, probe_fn)
+
+    def _probe(self, probe_fn, bsz):
+        # Calls probe_fn with the first bsz examples, repeated if the dataset
+        # is smaller.
+        if isinstance(self.dataset, torch.utils.data.IterableDataset):
+            examples = list(itertools.islice(itertools.cycle(self.dataset),
+                                             bsz))
+        else:
+            examples = [self.dataset[index % len(self.dataset)]
+                        for index in range(bsz)]
+        probe_fn(self.collate_fn(examples))
 
     @property
     def current_local_bsz(self):
@@ -883,9 +1172,33 @@ class HeteroAdaptiveDataLoaderMixin(object):
         self._elastic = HeteroAdaptiveDataLoaderHelper(batch_size)
 
     def autoscale_batch_size(self, max_batch_size, local_bsz_bounds=None,
-                             gradient_accumulation=False):
+                             gradient_accumulation=False, max_local_steps=1,
+                             probe_fn=None):
+        """
+        Enables adaptive batch size, see
+        :meth:`AdaptiveDataLoaderHelper.autoscale_batch_size`. If ``probe_fn``
+        is given, it is called with batches of examples from the dataset, and
+        should run the forward and backward pass of the model on them without
+        stepping the optimizer. Since it is called before the model is wrapped
+        in :class:`adaptdl.torch.AdaptiveDataParallel`, the memory of any
+        optimizer state which is not allocated yet is not accounted for.
+        """
+        if probe_fn is not None:
+            probe_fn = functools.partial(self._probe, probe_fn)
         self._elastic.autoscale_batch_size(max_batch_size, local_bsz_bounds,
-                                           gradient_accumulation)
+                                           gradient_accumulation,
+                                           max_local_steps, probe_fn)
+
+    def _probe(self, probe_fn, bsz):
+        # Calls probe_fn with the first bsz examples, repeated if the dataset
+        # is smaller.
+        if isinstance(self.dataset, torch.utils.data.IterableDataset):
+            examples = list(itertools.islice(itertools.cycle(self.dataset),
+                                             bsz))
+        else:
+            examples = [self.dataset[index % len(self.dataset)]
+                        for index in range(bsz)]
+        probe_fn(self.collate_fn(examples))
 
     @property
     def current_local_bsz(self):
@@ -966,14 +1279,21 @@ class HeteroDataLoader(DataLoader, HeteroAdaptiveDataLoaderMixin):
                 for idx, batch in enumerate(super().__iter__()):
                     with self._elastic.profile(self.training and idx >= 1):
                         yield batch
+                        if self._elastic.is_accum_step():
+                            # Replicas may take different numbers of
+                            # accumulation steps, count optimizer steps.
+                            continue
                         # Increment by the number of data samples processed
-                        self._elastic.current_index += \
-                            math.ceil(self.batch_sampler.batch_size / data_ratio)
+                        # by all replicas.
+                        total_bsz = math.ceil(
+                            self.batch_sampler.batch_size *
+                            (self._elastic.accumulation_steps + 1) /
+                            data_ratio)
+                        self._elastic.current_index += total_bsz
                         self.index_count += 1
-                        # print(self.index_count, len(self.dataset), self.batch_sampler.batch_size, data_ratio)
                         if self._elastic.max_batch_size is not None and \
                                 self.index_count > len(self.dataset) / \
-                                 self.batch_sampler.batch_size * data_ratio:
+                                total_bsz:
                             done = True
                             break
                 if self._elastic.max_batch_size is None:
@@ -1082,6 +1402,7 @@ class _AdaptiveDataLoaderState(adaptdl.checkpoint.State):
         self.last_position = {}  # Epoch -> position of last completed loop.
         self.current_local_bsz = 0
         self.accumulation_steps = 0
+        self.local_steps = 1
         self.total_bsz = 0
 
     def save(self, fileobj):
@@ -1,3 +1,4 @@
+import collections
 import functools
 import logging
 import math
@@ -7,11 +8,11 @@ import torch.optim
 
 from torch.autograd import Variable
 
+import adaptdl.env
 import adaptdl.utils
 
 import adaptdl.torch.data
 import adaptdl.torch.parallel
-import adaptdl.collective
 
 __all__ = ["GradientNoiseScale"]
 
@@ -20,46 +21,151 @@ LOG = logging.getLogger(__name__)
 LOG.setLevel(logging.INFO)
 
 
-def _average_groups(grads1, grads2):
+def _round_bfloat16(tensor):
+    # Round to bfloat16 by truncating the low 16 bits of float32 after adding
+    # uniform noise to them. Each element is rounded up with probability
+    # proportional to its distance from the lower value, so the result is an
+    # unbiased estimate of the input.
+    bits = tensor.float().view(torch.int32)
+    bits = bits + torch.randint_like(bits, 0, 1 << 16)
+    return bits.bitwise_and_(-(1 << 16)).view(torch.float32).bfloat16()
+
+
+def _dot_groups(grads1, grads2, pinvs):
     ret = []
-    for group1, group2 in zip(grads1, grads2):
-        ret.append([])
-        for g1, g2 in zip(group1, group2):
-            if g1 is None:
-                ret[-1].append(g2)
-            elif g2 is None:
-                ret[-1].append(g1)
-            else:
-                ret[-1].append((g1 + g2) / 2)
-    return ret
+    for group1, group2, pinv_group in zip(grads1, grads2, pinvs):
+        dot = 0.0
+        for g1, g2, pinv in zip(group1, group2, pinv_group):
+            if g1 is None or g2 is None:
+                continue
+            g2 = g2.float()
+            if pinv is not None:
+                g2 = g2.div_(pinv).div_(pinv)
+            dot += torch.dot(g1.float().flatten(), g2.flatten()).double()
+        ret.append(float(dot))
+    return np.array(ret)
+
+
+@functools.lru_cache(maxsize=64)
+def _opt_weights(shares, total=1.0):
+    """
+    Weights minimizing the variance of the combined gradient norm (G) and
+    gradient variance (S) estimates of replicas with unequal batch sizes.
+
+    Arguments:
+        shares (tuple): Batch size of each replica.
+        total (float): Total batch size, should equal the sum of shares.
+
+    Returns:
+        (np.ndarray, np.ndarray): Weights of each replica for the G and S
+            estimates.
+    """
+    b = np.asarray(shares, dtype=np.float64)
+    if not np.isclose(np.sum(b), total):
+        raise ValueError("invalid input: b_i do not sum to B")
+    if not np.all(b):
+        raise ValueError("invalid input: cannot have b_i=0")
+    if len(b) == 1:
+        return np.ones(1), np.ones(1)
+    B = total
+    bi, bj = b[:, np.newaxis], b[np.newaxis, :]
+    A_G = (B ** 2 - bi ** 2 - bj ** 2) / (B * (B - bi) * (B - bj))
+    np.fill_diagonal(A_G, (B + 2 * b) / (B ** 2 - B * b))
+    A_S = bi * bj * (B - bi - bj) / ((B - bi) * (B - bj))
+    np.fill_diagonal(A_S, B * b / (B - b))
+    weights = []
+    for A in (A_G, A_S):
+        # w = A^-1 1 / (1' A^-1 1)
+        x = np.linalg.solve(A, np.ones(len(b)))
+        weights.append(x / np.sum(x))
+    return tuple(weights)
+
+
+# Gradients are reduced in buckets of about this many bytes, so that their
+# squared norms can be computed with a few fused kernels.
+_BUCKET_BYTES = 25 * 1024 * 1024
+
+
+def _normsqr(grads, pinvs, device):
+    # Sum of squared l2-norms of grads, each divided elementwise by its
+    # preconditioner if not None, as a float64 tensor on device.
+    total = torch.zeros((), dtype=torch.float64, device=device)
+    plain = [g for g, p in zip(grads, pinvs) if p is None]
+    scaled = [(g, p) for g, p in zip(grads, pinvs) if p is not None]
+    if scaled:
+        gs, ps = zip(*scaled)
+        if hasattr(torch, "_foreach_div"):
+            plain.extend(torch._foreach_div(list(gs), list(ps)))
+        else:
+            plain.extend(g / p for g, p in scaled)
+    buckets = collections.defaultdict(list)
+    for g in plain:
+        buckets[g.device, g.dtype].append(g)
+    for (_, dtype), bucket in buckets.items():
+        if hasattr(torch, "_foreach_norm") and \
+                dtype in (torch.float32, torch.float64):
+            norms = torch.stack(torch._foreach_norm(bucket)).double()
+            total += norms.pow(2).sum().to(device)
+        else:
+            # Low precision norms can overflow, accumulate in float64.
+            for g in bucket:
+                total += g.pow(2).sum(dtype=torch.float64).to(device)
+    return total
 
 
 def _normsqr_groups(grads, pinvs):
     ret = []
     for group, pinv_group in zip(grads, pinvs):
-        normsqr = [(g / pinv).pow(2).sum(dtype=torch.float64)
-                   for g, pinv in zip(group, pinv_group) if g is not None]
-        ret.append(sum(normsqr).item() if normsqr else 0.0)
+        pairs = [(g, pinv) for g, pinv in zip(group, pinv_group)
+                 if g is not None]
+        if not pairs:
+            ret.append(0.0)
+            continue
+        group, pinv_group = zip(*pairs)
+        ret.append(_normsqr(group, pinv_group, group[0].device).item())
     return np.array(ret)
 
 
 class GradientNoiseScale(object):
     """This class tracks gradient related stats and takes care of gradient
-    accumulation."""
+    accumulation.
+
+    Arguments:
+        interval (int): Measure the gradient statistics once every this many
+            optimizer steps. The backward hooks do no work in between.
+        rtol (float): If not None, also measure on every optimizer step while
+            the relative standard error of either estimate exceeds rtol.
+    """
     def __init__(self, adp, optimizer,
                  mp_scaler=None,
                  num_replicas=None,
-                 accum_scale=None):
+                 accum_scale=None,
+                 interval=1,
+                 rtol=None):
+        if interval < 1:
+            raise ValueError("interval must be at least 1")
         self._adp = adp
         self._optimizer = optimizer
         self._orig_optimizer_zero_grad = optimizer.zero_grad
         self._should_zero_grad = True
         self._mp_scaler = mp_scaler
         self._local_sqr = None
+        self._buckets = [[] for _ in optimizer.param_groups]
+        self._bucket_bytes = 0
         self._num_replicas = (num_replicas if num_replicas is not None
                               else torch.distributed.get_world_size())
         self._accum_scale = accum_scale or self._num_replicas
+        # Whether gradients are not synchronized between replicas.
+        self._local = False
         self._prev_grads = None
+        self._pending_stats = None
+        self._interval = interval
+        self._rtol = rtol
+        self._measuring = True
+        # Optimizer steps since the gradient statistics were last measured,
+        # and those of measurements dropped since the estimates were updated.
+        self._steps = 0
+        self._dropped_steps = 0
 
         self.reset_accumulation()
 
@@ -87,7 +193,11 @@ class GradientNoiseScale(object):
     def reset_accumulation(self):
         """reset accumulation calculations and gradients."""
         self._orig_optimizer_zero_grad()
-        self._local_sqr = None
+        if self._local_sqr is not None:
+            self._local_sqr.zero_()
+        for bucket in self._buckets:
+            bucket.clear()
+        self._bucket_bytes = 0
         self._accum_count = 0
 
     @property
@@ -107,8 +217,20 @@ class GradientNoiseScale(object):
             self.reset_accumulation()
             self._accum_scale = accum_scale
 
+    def set_local(self, local):
+        """
+        Set whether the gradients are not synchronized between replicas, as
+        in the local steps of local SGD. The statistics are then estimated
+        from the gradients of each replica alone, and averaged over replicas.
+        """
+        if local != self._local:
+            self.reset_accumulation()
+            self._prev_grads = None
+            self._local = local
+
     @property
     def raw_sqr_avg(self):
+        self._update_stats(block=False)
         view = self._state["sqr_avg"].view()
         view.flags.writeable = False
         return view
@@ -120,11 +242,13 @@ class GradientNoiseScale(object):
 
         Returns (float): Estimate of squared l2-norm.
         """
+        self._update_stats(block=False)
         # print("sqr average", float(np.sum(np.maximum(self._state["sqr_avg"], 0.0))))
         return float(np.sum(np.maximum(self._state["sqr_avg"], 0.0)))
 
     @property
     def raw_var_avg(self):
+        self._update_stats(block=False)
         view = self._state["var_avg"].view()
         view.flags.writeable = False
         return view
@@ -136,9 +260,38 @@ class GradientNoiseScale(object):
 
         Returns (float): Estimate of trace of the covariance.
         """
+        self._update_stats(block=False)
         # print("var average", float(np.sum(np.maximum(self._state["var_avg"], 1e-6))))
         return float(np.sum(np.maximum(self._state["var_avg"], 1e-6)))
 
+    def sqr_std(self):
+        """
+        Standard error of the smoothed estimate returned by :meth:`sqr_avg`.
+
+        Returns (float): Standard error of the squared l2-norm estimate.
+        """
+        return self._std_err("sqr_avg")
+
+    def var_std(self):
+        """
+        Standard error of the smoothed estimate returned by :meth:`var_avg`.
+
+        Returns (float): Standard error of the covariance trace estimate.
+        """
+        return self._std_err("var_avg")
+
+    def _std_err(self, param_name):
+        # Each raw estimate has variance E[x^2] - E[x]^2, and an exponential
+        # moving average with factor theta has an effective sample size of
+        # (1 + theta) / (1 - theta).
+        self._update_stats(block=False)
+        if param_name + "_sq" not in self._state:
+            return 0.0
+        mean = np.asarray(self._state[param_name])
+        variance = np.maximum(self._state[param_name + "_sq"] - mean ** 2, 0.0)
+        theta = self._state.get("theta", self._smoothing)
+        return float(np.sqrt(np.sum(variance) * (1 - theta) / (1 + theta)))
+
     def get_progress(self):
         return self._state["progress"]
 
@@ -170,25 +323,44 @@ class GradientNoiseScale(object):
     def _reset_avg(self, param_name):
         self._state.pop(param_name + "_biased", None)
         self._state.pop(param_name + "_unbias", None)
+        self._state.pop(param_name + "_sq_biased", None)
+        self._state.pop(param_name + "_sq_unbias", None)
+        self._state.pop(param_name + "_sq", None)
 
     @adaptdl.utils.print_exc
     def _backward_hook(self, idx, param, grad):
         # This method should be invoked once for each parameter during the
         # backward pass, before gradients are synchronized between replicas.
+        if not self._callback_queued:
+            Variable._execution_engine.queue_callback(self._queue_callback)
+        self._callback_queued = True
+        if not self._measuring:
+            return
         if self._local_sqr is None:
             self._local_sqr = torch.zeros(len(self._optimizer.param_groups),
                                           device=grad.device,
                                           dtype=torch.float64)
 
-        # Get the preconditioning matrix for the optimizer
+        # Get the preconditioning matrix for the optimizer, None if identity.
         preconditioner = self._calculate_preconditioner(idx, param)
 
-        # Update the local gradient square sum
-        self._local_sqr[idx] += \
-            (grad.detach() / preconditioner).pow(2).sum(dtype=torch.float64)
-        if not self._callback_queued:
-            Variable._execution_engine.queue_callback(self._queue_callback)
-        self._callback_queued = True
+        # Defer updating the local gradient square sum until enough gradients
+        # are bucketed. The bucketed gradients are not modified before they
+        # are flushed at the end of the backward pass at the latest.
+        grad = grad.detach()
+        self._buckets[idx].append((grad, preconditioner))
+        self._bucket_bytes += grad.numel() * grad.element_size()
+        if self._bucket_bytes >= _BUCKET_BYTES:
+            self._flush_buckets()
+
+    def _flush_buckets(self):
+        for idx, bucket in enumerate(self._buckets):
+            if bucket:
+                grads, pinvs = zip(*bucket)
+                self._local_sqr[idx] += _normsqr(grads, pinvs,
+                                                 self._local_sqr.device)
+                bucket.clear()
+        self._bucket_bytes = 0
 
     @adaptdl.utils.print_exc
     def _queue_callback(self):
@@ -200,6 +372,7 @@ class GradientNoiseScale(object):
         # self._final_callback from this method, which should ensure it is
         # invoked after the gradient synchronization callback.
         self._callback_queued = False
+        self._flush_buckets()
         self._accum_count += 1
         if self._adp.require_backward_grad_sync:
             # Asynchronously sum the local squared-gradient statistics. The
@@ -224,37 +397,81 @@ class GradientNoiseScale(object):
     def _final_callback(self):
         # This method should be invoked once the gradients have been
         # synchronized between all replicas and accumulation steps.
-        # if self._num_replicas > 1:
-        #     self._async_op.wait()
-        #     # self._async_op
-        
-        grads = []
+        self._steps += 1
+        if self._measuring:
+            self._measure()
+        self._measuring = self._should_measure()
+
+    def _should_measure(self):
+        # Whether to measure the gradient statistics in the next step.
+        if self._prev_grads is not None and self._interval > 1:
+            return True  # Complete the pair for the differenced estimator.
+        # The differenced estimator needs to start a step earlier to update
+        # the estimates at the same interval.
+        lead = 2 if self._state["biased"] else 1
+        if self._steps + lead >= self._interval:
+            return True
+        if self._rtol is not None:
+            # Apply the pending estimates first, so that every replica
+            # decides from the same estimates.
+            self._update_stats()
+            if "sqr_avg_sq" not in self._state:
+                return True
+            return (self.sqr_std() > self._rtol * self.sqr_avg() or
+                    self.var_std() > self._rtol * self.var_avg())
+        return False
+
+    def _measure(self):
+        # Every replica reduces its estimates, or a flag to drop them if it
+        # has none for this step, so that the reductions match across all
+        # replicas.
+        self._update_stats()
+        steps = self._steps + self._dropped_steps
+        self._steps = self._dropped_steps = 0
+        estimates = self._estimate()
+        if estimates is None:
+            zeros = np.zeros(len(self._optimizer.param_groups))
+            self._reduce_stats(zeros, zeros, 1.0, steps, skip=True)
+            return
+        grad_sqr, grad_var, scale = estimates
+        # Each measurement stands in for all steps since the previous one,
+        # so that sparser measurements are smoothed over the same window.
+        theta = self._smoothing ** (scale * steps)
+        self._reduce_stats(grad_sqr, grad_var, theta, steps)
+
+    def _estimate(self):
+        # Returns the weighted estimates of this replica and the scale they
+        # were measured at, or None if it has none for this step.
         if self._mp_scaler is not None:
             mixed_precision_scale = self._mp_scaler.get_scale()
         else:
             mixed_precision_scale = 1.0
-        for group in self._optimizer.param_groups:
-            grads.append([])
-            for param in group["params"]:
-                if param.grad is None:
-                    grads[-1].append(None)
-                    continue
-                grad = param.grad.detach().float()
-                grads[-1].append(
-                    grad / mixed_precision_scale / self._accum_count)
+        # Gradients are used as-is and their statistics rescaled afterwards,
+        # to avoid making a copy of every gradient.
+        grad_scale = mixed_precision_scale * self._accum_count
+        if adaptdl.torch.data.accum_counts is not None and not self._local:
+            # Replicas took different numbers of accumulation steps, and
+            # their gradients were rescaled to the average number.
+            grad_scale = (mixed_precision_scale *
+                          adaptdl.torch.data.mean_accum_count())
+        grads = [[param.grad.detach() if param.grad is not None else None
+                  for param in group["params"]]
+                 for group in self._optimizer.param_groups]
         preconditioner = self._get_preconditioner()
 
         # Note: mixed precision can result in nan/inf gradients,
         # which propogate into our norm and variance estimates.
         # Mixed precision autoscaling skips the skip where
         # there are nan/inf, so we also skip the update here
-        grads_normsqr = _normsqr_groups(grads, preconditioner)
+        grads_normsqr = _normsqr_groups(grads, preconditioner) / grad_scale ** 2
         if not np.all(np.isfinite(grads_normsqr)):
             LOG.warning("GradientNoiseScale detected invalid gradient! "
                         "Skipping step.")
-            return
+            return None
         # count = math.ceil(self._accum_count / adaptdl.torch.data.data_ratio)
-        count = self._num_replicas * self._accum_count
+        count = self._accum_count
+        if not self._local:
+            count *= self._num_replicas
         scale = self._accum_scale * self._accum_count
 
         if count > 1:
@@ -272,80 +489,95 @@ class GradientNoiseScale(object):
             self._state["biased"] = False
             self._prev_grads = None
         else:
-            # Single gradient datapoint, use difference estimation.
+            # Single gradient datapoint, use difference estimation. Only the
+            # squared norm of the previous gradient and a bfloat16 copy of it
+            # are kept. The copy is stochastically rounded, so the cross term
+            # computed from it is still unbiased.
             if self._prev_grads is not None:
-                local_sqr = (_normsqr_groups(self._prev_grads, preconditioner)
-                             + grads_normsqr) / 2
-                avg_grads = _average_groups(grads, self._prev_grads)
-                total_sqr = _normsqr_groups(avg_grads, preconditioner)
+                prev_normsqr, prev_grads = self._prev_grads
+                cross = _dot_groups(grads, prev_grads, preconditioner)
+                local_sqr = (prev_normsqr + grads_normsqr) / 2
+                total_sqr = (prev_normsqr + grads_normsqr
+                             + 2 * cross / grad_scale) / 4
                 count = 2
                 scale = 2 * self._accum_scale
             self._state["biased"] = True
-            self._prev_grads = [[g.clone() if g is not None else None
-                                 for g in group] for group in grads]
-        if count > 1:
-            def make_A_G(B,b):
-                A = np.zeros([len(b),len(b)])
-                for i in range(len(b)):
-                    for j in range(len(b)):
-                        if i == j:
-                            A[i][j] = (B+2*b[i])/(B**2-B*b[i])
-                        else:
-                            A[i][j] = (B**2-b[i]**2-b[j]**2)/(B*(B-b[i])*(B-b[j]))
-                return A
-
-            def make_A_S(B,b):
-                A = np.zeros([len(b),len(b)])
-                for i in range(len(b)):
-                    for j in range(len(b)):
-                        if i == j:
-                            A[i][j] = (B*b[i])/(B-b[i])
-                        else:
-                            A[i][j] = (b[i]*b[j]*(B-b[i]-b[j]))/((B-b[i])*(B-b[j]))
-                return A
-
-            def opt_weights(B,b,est_type):
-                if est_type not in ['G','S']:
-                    raise ValueError("invalid input: choose estimator type")
-                
-                if sum(b)!=B: 
-                    raise ValueError("invalid input: b_i do not sum to B")
-                    
-                if not all(b):
-                    raise ValueError("invalid input: cannot have b_i=0")
-                
-                if est_type == 'G':
-                    A = np.linalg.inv(make_A_G(B,b))
-                else:
-                    A = np.linalg.inv(make_A_S(B,b))
-                w = A.dot(np.ones(len(b)))/np.ones(len(b)).dot(A.dot(np.ones(len(b))))
-                return w
-
-            w_norm = opt_weights(1,[adaptdl.torch.data.data_ratio,1-adaptdl.torch.data.data_ratio],'G')
-            w_var = opt_weights(1, [adaptdl.torch.data.data_ratio,1-adaptdl.torch.data.data_ratio],'S')
+            if self._prev_grads is not None and self._interval > 1:
+                # Measured sparsely, start a new pair next time.
+                self._prev_grads = None
+            else:
+                self._prev_grads = (grads_normsqr, [
+                    [_round_bfloat16(g / grad_scale) if g is not None
+                     else None for g in group] for group in grads])
+        if count <= 1:
+            return None
+        ratio = adaptdl.torch.data.data_ratio
+        if adaptdl.torch.data.data_shares is not None:
+            shares = adaptdl.torch.data.data_shares
+            rank = adaptdl.env.replica_rank()
+        else:
+            shares, rank = (ratio, 1 - ratio), 0
+        if self._local:
+            # Estimates from the samples of this replica, weighted by its
+            # share of the total batch size.
+            grad_sqr = (count * total_sqr - local_sqr) / (count - 1) * ratio
+            grad_var = (local_sqr - total_sqr) * scale / (count - 1) * ratio
+        else:
+            # Each local squared norm is of the batch of one accumulation
+            # step, a fraction of the share of this replica.
+            counts = adaptdl.torch.data.accum_counts or \
+                (self._accum_count,) * len(shares)
+            shares = np.divide(shares, counts)
+            ratio = shares[rank]
+            w_norm, w_var = _opt_weights(tuple(shares / np.sum(shares)))
             # grad_sqr = (count * total_sqr - local_sqr) / (count - 1)
             # grad_var = (local_sqr - total_sqr) * scale / (count - 1)
-            # print("data ratio", adaptdl.torch.data.data_ratio)
-            grad_sqr = ((total_sqr / adaptdl.torch.data.data_ratio - local_sqr) / (1 / adaptdl.torch.data.data_ratio - 1)) * w_norm[0]
-            grad_sqr = adaptdl.collective.allreduce(grad_sqr) 
-            grad_var = ((local_sqr - total_sqr) * scale / (1 / adaptdl.torch.data.data_ratio - 1)) * w_var[0]
-            grad_var = adaptdl.collective.allreduce(grad_var) 
-            # grad_sqr = torch.tensor((total_sqr / adaptdl.torch.data.data_ratio - local_sqr) / (1 / adaptdl.torch.data.data_ratio - 1)/ self._num_replicas)
-            # grad_sqr = grad_sqr.to(device='cuda')
-
-            # grad_sqr = torch.distributed.all_reduce(grad_sqr, async_op=True) 
-            # # grad_sqr.wait()
-            # grad_var = torch.tensor((local_sqr - total_sqr) * scale / (1 / adaptdl.torch.data.data_ratio - 1)/ self._num_replicas)
-            # grad_var = grad_var.to(device='cuda')
-            # grad_var = torch.distributed.all_reduce(grad_var, async_op=True) 
-            # grad_sqr = np.float(torch.tensor(grad_sqr).cpu())
-            # grad_var = np.float(torch.tensor(grad_var).cpu())
-
-            # grad_var.wait()
-            # print("grad_sqr", grad_sqr)
-            theta = self._smoothing ** scale
-            self._update_avg('sqr_avg', grad_sqr, theta)
-            self._update_avg('var_avg', grad_var, theta)
+            grad_sqr = ((total_sqr / ratio - local_sqr) / (1 / ratio - 1)
+                        * w_norm[rank])
+            grad_var = ((local_sqr - total_sqr) * scale / (1 / ratio - 1)
+                        * w_var[rank])
+        return grad_sqr, grad_var, scale
+
+    def _reduce_stats(self, grad_sqr, grad_var, theta, steps=0, skip=False):
+        # Sum the weighted estimates of all replicas in a single packed
+        # tensor, without waiting for the result. It is applied once it is
+        # needed, or at the latest before the next estimates are reduced.
+        # The last element counts the replicas which skipped this step.
+        stats = torch.from_numpy(np.concatenate([grad_sqr, grad_var,
+                                                 [float(skip)]]))
+        work = None
+        if torch.distributed.is_initialized() and \
+                torch.distributed.get_world_size() > 1:
+            if self._local_sqr is not None:
+                stats = stats.to(self._local_sqr.device)
+            work = torch.distributed.all_reduce(stats, async_op=True)
+        self._pending_stats = (work, stats, theta, steps)
+
+    def _update_stats(self, block=True):
+        # Apply the most recently reduced estimates. If block is False, only
+        # apply them if the reduction already finished, so the estimates can
+        # lag behind by one step instead of stalling training.
+        if self._pending_stats is None:
+            return
+        work, stats, theta, steps = self._pending_stats
+        if work is not None and not block and not work.is_completed():
+            return
+        self._pending_stats = None
+        if work is not None:
+            work.wait()
+        stats = stats.cpu().numpy()
+        if stats[-1] > 0:
+            # Some replicas had no estimates, so the sum is incomplete. Drop
+            # it, and smooth the next estimates over its steps as well.
+            self._dropped_steps += steps
+            return
+        grad_sqr, grad_var = np.split(stats[:-1], 2)
+        self._update_avg('sqr_avg', grad_sqr, theta)
+        self._update_avg('var_avg', grad_var, theta)
+        # Second moments, used to estimate the uncertainty of the above.
+        self._update_avg('sqr_avg_sq', np.square(grad_sqr), theta)
+        self._update_avg('var_avg_sq', np.square(grad_var), theta)
+        self._state["theta"] = theta
 
     def _get_preconditioner(self):
         out = []
@@ -358,37 +590,62 @@ class GradientNoiseScale(object):
         return out
 
     def _calculate_preconditioner(self, idx, param):
-        return torch.ones_like(param, memory_format=torch.preserve_format)
+        return None
 
 
 class AdamGradientNoiseScale(GradientNoiseScale):
+    """GradientNoiseScale for Adam, with gradients preconditioned by Adam's
+    second moment estimates.
+
+    Arguments:
+        precond_dtype (torch.dtype): If not None, compute and keep the
+            preconditioners in this lower precision, e.g. torch.bfloat16.
+    """
     def __init__(self, adp, optimizer,
                  mp_scaler=None,
                  num_replicas=None,
-                 accum_scale=None):
+                 accum_scale=None,
+                 interval=1,
+                 rtol=None,
+                 precond_dtype=None):
         self._adam_param_group = {'beta': [], 'eps': []}
-        super().__init__(adp, optimizer, mp_scaler, num_replicas, accum_scale)
+        # The preconditioner only changes with the optimizer step, so it is
+        # computed once per step into a buffer kept for each parameter.
+        self._precond_dtype = precond_dtype
+        self._preconditioners = {}
+        super().__init__(adp, optimizer, mp_scaler, num_replicas, accum_scale,
+                         interval, rtol)
         for idx, param_group in enumerate(self._optimizer.param_groups):
             self._adam_param_group['beta'].append(param_group['betas'][1])
             self._adam_param_group['eps'].append(param_group['eps'])
 
     def _calculate_preconditioner(self, idx, param):
         state = self._optimizer.state[param]
-        if state.get('step', 0) < 5:
-            return torch.ones_like(param, memory_format=torch.preserve_format)
-
-        exp_avg_sq = state["exp_avg_sq"].clone()  # not sure if clone is needed
+        step = int(state.get('step', 0))
+        if step < 5:
+            return None
+        cached_step, pinv = self._preconditioners.get(param, (None, None))
+        if cached_step == step:
+            return pinv
+        exp_avg_sq = state["exp_avg_sq"]
+        if pinv is None or pinv.shape != exp_avg_sq.shape:
+            pinv = torch.empty_like(exp_avg_sq, dtype=self._precond_dtype)
         beta2 = self._adam_param_group['beta'][idx]
         eps = self._adam_param_group['eps'][idx]
-        correction = 1 - beta2 ** state['step']
-        pinv = (exp_avg_sq.sqrt() / math.sqrt(correction)).add_(eps)
+        correction = 1 - beta2 ** step
+        pinv.copy_(exp_avg_sq).sqrt_().div_(math.sqrt(correction)).add_(eps)
+        self._preconditioners[param] = (step, pinv)
         return pinv
 
     def _reset_adam_state(self, step=0):
-        for group in self._optimizer.param_groups:
+        self._preconditioners.clear()
+        # A sharded optimizer only keeps the state of its own shard.
+        optimizer = getattr(self._optimizer, "local_optimizer",
+                            self._optimizer)
+        for group in optimizer.param_groups:
             beta1, beta2 = group["betas"]
             for param in group["params"]:
-                state = self._optimizer.state[param]
+                state = optimizer.state[param]
                 if state.get("step", 0) > 0:
                     state["exp_avg"].mul_(
                         (1 - beta1 ** step) / (1 - beta1 ** state["step"]))
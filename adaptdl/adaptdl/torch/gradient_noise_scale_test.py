@@ -5,7 +5,10 @@ import random
 
 from unittest.mock import Mock
 
-from adaptdl.torch.gradient_noise_scale import GradientNoiseScale
+from adaptdl.conftest import elastic_multiprocessing
+from adaptdl.torch.gradient_noise_scale import AdamGradientNoiseScale, \
+    GradientNoiseScale, \
+    _dot_groups, _normsqr_groups, _opt_weights, _round_bfloat16
 
 
 def test_object():
@@ -29,6 +32,151 @@ def test_object():
     assert np.isclose(obj.gain(3.0), 2.0)
 
 
+def test_std():
+    params = [torch.tensor([1.0, -1.0], requires_grad=True)]
+    sgd = torch.optim.SGD(params, lr=0.1)
+    adp = Mock(require_backward_grad_sync=True)
+    obj = GradientNoiseScale(adp, sgd, accum_scale=1.0, num_replicas=1)
+    assert obj.sqr_std() == 0.0 and obj.var_std() == 0.0
+    # Constant estimates have no uncertainty.
+    for _ in range(10):
+        obj._update_avg("sqr_avg", np.array([2.0]), 0.9)
+        obj._update_avg("sqr_avg_sq", np.array([4.0]), 0.9)
+    assert np.isclose(obj.sqr_std(), 0.0)
+    # Noisy estimates do, and it shrinks with heavier smoothing.
+    for i in range(10):
+        value = np.array([1.0 if i % 2 else 3.0])
+        obj._update_avg("var_avg", value, 0.9)
+        obj._update_avg("var_avg_sq", np.square(value), 0.9)
+    obj._state["theta"] = 0.9
+    std = obj.var_std()
+    assert std > 0.0
+    obj._state["theta"] = 0.99
+    assert obj.var_std() < std
+    obj._reset_avg("var_avg")
+    assert obj.var_std() == 0.0
+
+
+def test_normsqr_groups():
+    grads = [[torch.randn(3, 4), None, torch.randn(5).half()],
+             [torch.randn(7, dtype=torch.float64)]]
+    pinvs = [[None, None, torch.rand(5).half() + 1],
+             [torch.rand(7, dtype=torch.float64) + 1]]
+    expected = [
+        grads[0][0].double().pow(2).sum() +
+        (grads[0][2].double() / pinvs[0][2].double()).pow(2).sum(),
+        (grads[1][0] / pinvs[1][0]).pow(2).sum(),
+    ]
+    assert np.allclose(_normsqr_groups(grads, pinvs), expected, rtol=1e-3)
+
+
+def test_round_bfloat16():
+    tensor = torch.randn(1000)
+    rounded = torch.stack([_round_bfloat16(tensor) for _ in range(1000)])
+    assert rounded.dtype == torch.bfloat16
+    # Each element rounds to one of its two neighbouring bfloat16 values.
+    lower = tensor.bfloat16().float()
+    assert torch.all((rounded.float() - tensor).abs() <=
+                     (lower - tensor).abs() * 2 + 1e-2 * tensor.abs())
+    # And is unbiased on average, unlike round-to-nearest.
+    error = rounded.float().mean(0) - tensor
+    assert error.abs().mean() < (lower - tensor).abs().mean() / 5
+
+
+def test_dot_groups():
+    grads1 = [[torch.randn(3, 4), None], [torch.randn(5)]]
+    grads2 = [[torch.randn(3, 4), torch.randn(2)], [torch.randn(5)]]
+    pinvs = [[None, None], [torch.rand(5) + 1]]
+    expected = [
+        torch.sum(grads1[0][0] * grads2[0][0]),
+        torch.sum(grads1[1][0] * grads2[1][0] / pinvs[1][0] ** 2),
+    ]
+    assert np.allclose(_dot_groups(grads1, grads2, pinvs), expected)
+
+
+def test_opt_weights():
+    # Equal shares are weighted equally.
+    w_norm, w_var = _opt_weights((0.25, 0.25, 0.25, 0.25))
+    assert np.allclose(w_norm, 0.25) and np.allclose(w_var, 0.25)
+    # Compare against the element-wise definition for two replicas.
+    B, b = 1.0, (0.3, 0.7)
+    A_G = np.array([[(B + 2 * b[0]) / (B ** 2 - B * b[0]),
+                     (B ** 2 - b[0] ** 2 - b[1] ** 2) /
+                     (B * (B - b[0]) * (B - b[1]))],
+                    [(B ** 2 - b[0] ** 2 - b[1] ** 2) /
+                     (B * (B - b[0]) * (B - b[1])),
+                     (B + 2 * b[1]) / (B ** 2 - B * b[1])]])
+    x = np.linalg.inv(A_G).dot(np.ones(2))
+    w_norm, w_var = _opt_weights(b)
+    assert np.allclose(w_norm, x / np.sum(x))
+    assert np.isclose(np.sum(w_var), 1.0)
+    assert _opt_weights(b) is _opt_weights(b)  # Cached.
+    w_norm, w_var = _opt_weights((0.2, 0.3, 0.5))
+    assert np.isclose(np.sum(w_norm), 1.0) and np.isclose(np.sum(w_var), 1.0)
+    with pytest.raises(ValueError):
+        _opt_weights((0.2, 0.3))
+
+
+def test_bucketed_local_sqr():
+    params = [torch.randn(10, requires_grad=True) for _ in range(4)]
+    sgd = torch.optim.SGD(params, lr=0.1)
+    adp = Mock(require_backward_grad_sync=False)
+    obj = GradientNoiseScale(adp, sgd, accum_scale=1.0, num_replicas=1)
+    sum(param.pow(2).sum() for param in params).backward()
+    expected = sum(param.detach().mul(2).pow(2).sum() for param in params)
+    assert np.isclose(obj._local_sqr[0].item(), expected.item())
+    obj.reset_accumulation()
+    assert obj._local_sqr[0].item() == 0.0
+
+
+def test_interval():
+    torch.manual_seed(0)
+    param = torch.zeros(100, requires_grad=True)
+    sgd = torch.optim.SGD([param], lr=0.0)
+    adp = Mock(require_backward_grad_sync=True)
+    obj = GradientNoiseScale(adp, sgd, accum_scale=1.0, num_replicas=1,
+                             interval=5)
+    measure = obj._measure
+    obj._measure = Mock(side_effect=measure)
+    target = torch.ones(100)
+    for _ in range(1000):
+        obj.reset_accumulation()
+        ((param - target - torch.randn(100)) ** 2).sum().div(2).backward()
+    # Pairs of consecutive steps are measured for the differenced estimator.
+    assert obj._measure.call_count == 400
+    # Same estimates as measuring every step (with data_ratio of 0.5).
+    assert np.isclose(obj.sqr_avg(), 50, rtol=0.3)
+    assert np.isclose(obj.var_avg(), 50, rtol=0.3)
+
+
+def test_adam_preconditioner():
+    param = torch.randn(10, requires_grad=True)
+    adam = torch.optim.Adam([param], lr=0.1)
+    adp = Mock(require_backward_grad_sync=False)
+    obj = AdamGradientNoiseScale(adp, adam, accum_scale=1.0, num_replicas=1)
+    bf16 = AdamGradientNoiseScale(adp, adam, accum_scale=1.0, num_replicas=1,
+                                  precond_dtype=torch.bfloat16)
+    for _ in range(6):
+        param.grad = torch.randn(10)
+        adam.step()
+    state = adam.state[param]
+    step = int(state["step"])
+    expected = (state["exp_avg_sq"].sqrt() /
+                np.sqrt(1 - 0.999 ** step)).add_(1e-8)
+    pinv = obj._calculate_preconditioner(0, param)
+    assert torch.allclose(pinv, expected)
+    # Reused within the same step, and recomputed in place after it.
+    assert obj._calculate_preconditioner(0, param) is pinv
+    assert obj._get_preconditioner()[0][0] is pinv
+    param.grad = torch.randn(10)
+    adam.step()
+    assert obj._calculate_preconditioner(0, param) is pinv
+    assert not torch.allclose(pinv, expected)
+    pinv_bf16 = bf16._calculate_preconditioner(0, param)
+    assert pinv_bf16.dtype == torch.bfloat16
+    assert torch.allclose(pinv_bf16.float(), pinv, rtol=1e-2)
+
+
 ATOL = 0.01
 
 
@@ -64,3 +212,97 @@ def test_nan():
             f"non-finite adascale parameters:"
             f"{gns.sqr_avg()}, {gns.var_avg()}"
         )
+
+
+@elastic_multiprocessing
+def test_reduce_stats():
+    import adaptdl.env
+    import adaptdl.torch as adl
+    adl.init_process_group("gloo")
+    rank = adaptdl.env.replica_rank()
+    params = [torch.tensor([1.0, -1.0], requires_grad=True)]
+    sgd = torch.optim.SGD(params, lr=0.1)
+    adp = Mock(require_backward_grad_sync=True)
+    obj = GradientNoiseScale(adp, sgd, accum_scale=1.0)
+    obj._reduce_stats(np.array([rank + 1.0]), np.array([2.0]), 0.9)
+    # Estimates are summed across replicas once the reduction is applied.
+    obj._update_stats()
+    num_replicas = adaptdl.env.num_replicas()
+    assert np.isclose(obj.sqr_avg(), num_replicas * (num_replicas + 1) / 2)
+    assert np.isclose(obj.var_avg(), 2.0 * num_replicas)
+    return [2, 0][adaptdl.env.num_restarts()]
+
+
+@elastic_multiprocessing
+def test_drop_stats():
+    import adaptdl.env
+    import adaptdl.torch as adl
+    if adaptdl.env.num_restarts() == 0:
+        return 2
+    adl.init_process_group("gloo")
+    rank = adaptdl.env.replica_rank()
+    params = [torch.tensor([1.0, -1.0], requires_grad=True)]
+    sgd = torch.optim.SGD(params, lr=0.1)
+    adp = Mock(require_backward_grad_sync=True)
+    obj = GradientNoiseScale(adp, sgd, accum_scale=1.0)
+    # Only rank 0 has estimates, so they are dropped on every replica, and
+    # their steps are carried over to the next estimates.
+    obj._reduce_stats(np.array([1.0]), np.array([2.0]), 0.9, 3,
+                      skip=rank != 0)
+    obj._update_stats()
+    assert obj._dropped_steps == 3
+    assert "sqr_avg_biased" not in obj._state
+    obj._reduce_stats(np.array([1.0]), np.array([2.0]), 0.9, 1)
+    obj._update_stats()
+    assert np.isclose(obj.sqr_avg(), 2.0)
+
+
+@elastic_multiprocessing
+def test_unequal_accumulation():
+    import torch.distributed as dist
+    import adaptdl.env
+    import adaptdl.torch as adl
+    import adaptdl.torch.data as data
+    if adaptdl.env.num_restarts() == 0:
+        return 2
+    adl.init_process_group("gloo")
+    rank = adaptdl.env.replica_rank()
+    # Rank 0 takes two accumulation steps of half the atomic batch size of
+    # rank 1, both have half of the total batch size of 16.
+    atomic_bsz, count = [(4, 2), (8, 1)][rank]
+    data.data_ratio = 0.5
+    data.data_shares = (0.5, 0.5)
+    data.accum_counts = (2, 1)
+    param = torch.zeros(10, requires_grad=True)
+    sgd = torch.optim.SGD([param], lr=0.1)
+    adp = Mock(require_backward_grad_sync=False)
+    gns = GradientNoiseScale(adp, sgd, accum_scale=atomic_bsz / 0.5 / 16)
+
+    def sync_hook(grad):
+        # Sums the weighted gradients like AdaptiveDataParallel.
+        if not adp.require_backward_grad_sync:
+            return None
+        accum = param.grad if param.grad is not None else 0.0
+        total = (grad + accum) * data.grad_ratio()
+        dist.all_reduce(total)
+        return total - accum
+
+    param.register_hook(sync_hook)
+    generator = torch.Generator().manual_seed(rank)
+    grad_sum = torch.zeros(10)
+    for _ in range(1000):
+        for step in range(count):
+            adp.require_backward_grad_sync = step == count - 1
+            inputs = torch.randn(atomic_bsz, 10, generator=generator) + 1.0
+            loss = ((param - inputs) ** 2).sum(1).mean() / 2
+            loss.backward()
+        grad_sum += param.grad / data.mean_accum_count()
+        gns.reset_accumulation()
+    # Synchronized gradient is scaled like the average of the total batch.
+    assert torch.allclose(grad_sum / 1000, torch.full((10,), -1.0),
+                          atol=0.05)
+    gns._update_stats()
+    # Per-example gradients have a squared norm of 10 and variance of 10,
+    # which is 10 / 16 at the initial batch size.
+    assert np.isclose(gns.sqr_avg(), 10.0, rtol=0.1)
+    assert np.isclose(gns.var_avg(), 10.0 / 16, rtol=0.2)
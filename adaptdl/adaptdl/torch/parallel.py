@@ -13,8 +13,10 @@
 # limitations under the License.
 
 
+import copy
 import functools
 import numpy as np
+import os
 import time
 import warnings
 from typing import Optional
@@ -22,46 +24,28 @@ from typing import Optional
 import torch
 import torch.cuda
 import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
 from torch.autograd import Variable
+from torch.distributed.optim import ZeroRedundancyOptimizer
 from torch.nn.parallel import DistributedDataParallel
 
 import adaptdl.checkpoint
 import adaptdl.env
+import adaptdl.trace
 import adaptdl.utils
+from adaptdl.torch import _exporter
+from adaptdl.torch.comm_hooks import proportional_allreduce_hook
 from adaptdl.torch.data import current_dataloader
 import adaptdl.torch.data
+from adaptdl.torch.sharded_optimizer import ShardedOptimizer
 from adaptdl.torch.scaling_rules import AdaScale, AdamScale, ScalingRuleBase
 from adaptdl.torch.gradient_noise_scale import GradientNoiseScale,\
                                                AdamGradientNoiseScale
-from adaptdl.torch._metrics import profile_sync_time, update_grad_params,\
-                                   update_progress
+from adaptdl.torch._metrics import profile_comm_bytes, profile_sync_time,\
+                                   update_grad_params, update_progress
 
 # data_ratio = 0.5
 
-def _allreduce_fut_proportion(
-    process_group: dist.ProcessGroup, tensor: torch.Tensor
-) -> torch.futures.Future[torch.Tensor]:
-    "Averages the input gradient tensor by allreduce and returns a future."
-    group_to_use = process_group if process_group is not None else dist.group.WORLD
-
-    # Apply the division first to avoid overflow, especially for FP16.
-    # tensor.div_(group_to_use.size())
-    # print(group_to_use.size())
-    # print("check in prop all reduce", adaptdl.torch.data.data_ratio)
-    tensor = tensor * (adaptdl.torch.data.data_ratio) #* 2
-
-    return (
-        dist.all_reduce(tensor, group=group_to_use, async_op=True)
-        .get_future()
-        .then(lambda fut: fut.value()[0])
-    )
-
-def proportional_allreduce_hook(
-        process_group: dist.ProcessGroup, bucket: dist.GradBucket
-) -> torch.futures.Future[torch.Tensor]:
-    return _allreduce_fut_proportion(process_group, bucket.buffer())
-
-
 # def _proportional_reduce_hook(process_group: dist.ProcessGroup, tensor: torch.Tensor)-> torch.futures.Future[torch.Tensor]:
 #         # group_to_use = process_group if process_group is not None else dist.group.WORLD
 #         proportional_grad = tensor().mul_(0.01)
@@ -87,51 +71,91 @@ class AdaptiveDataParallel(DistributedDataParallel):
         model (torch.nn.Module): Model to be distributed.
         optimizer (torch.optim.Optimizer): Optimizer used to update the given
         model's parameters, will be patched using subclass of
-        :class:`adaptdl.torch.scaling_rules.ScalingRuleBase`.
+        :class:`adaptdl.torch.scaling_rules.ScalingRuleBase`. May be a
+        :class:`adaptdl.torch.sharded_optimizer.ShardedOptimizer` to shard
+        the optimizer state across replicas.
         scaling_rule (ScalingRuleBase): Scaling rule used to
         patch the given optimizer, default to AdaScale.
         lr_scheduler (torch.optim.lr_scheduler._LRScheduler): LR scheduler used
         to anneal the learning rate for the given optimizer.
         name (string): Unique name for each instance of this class, needed only
         if multiple instances exist.
+        gns_interval (int): Measure the gradient noise scale once every this
+        many optimizer steps, to reduce its overhead for small models.
+        gns_rtol (float): If not None, measure the gradient noise scale on
+        every step while the relative standard error of its estimates is
+        above this tolerance, regardless of gns_interval.
+        gns_precond_dtype (torch.dtype): If not None, compute the Adam
+        preconditioners used by the gradient noise scale in this lower
+        precision, e.g. torch.bfloat16, to save memory.
+        comm_hook (callable): Communication hook which sums the gradients of
+        all replicas weighted by their data shares, one of the hooks in
+        :mod:`adaptdl.torch.comm_hooks`.
+        comm_state (object): State passed to comm_hook, such as a
+        :class:`adaptdl.torch.comm_hooks.PowerSGDState`. Saved and restored
+        with the checkpoint if it has ``state_dict`` and ``load_state_dict``.
+
+    When the training data loader chooses to take more than one local step
+    (see ``max_local_steps`` of ``autoscale_batch_size``), gradients are not
+    synchronized. Instead, each replica takes that many optimizer steps on its
+    own, after which the parameters of all replicas are averaged, weighted by
+    their shares of the total batch size. Parameters are also averaged before
+    a checkpoint is saved.
     """
     def __init__(self, model, optimizer, lr_scheduler=None, mp_scaler=None,
                  scaling_rule: Optional[ScalingRuleBase] = None,
-                 name="adaptdl-dataparallel", **kwargs):
+                 name="adaptdl-dataparallel", gns_interval=1, gns_rtol=None,
+                 gns_precond_dtype=None,
+                 comm_hook=proportional_allreduce_hook, comm_state=None,
+                 **kwargs):
         super().__init__(model, **kwargs)
         self._key = id(self)
-        # Register backward hooks on model parameters. Depends on these hooks
-        # being invoked before gradients are averaged. This is technically an
-        # internal behavior of DistributedDataParallel, but seems to be abused
-        # pretty widely so there should be little chance of it changing.
-        # https://discuss.pytorch.org/t/59291
-        DistributedDataParallel.register_comm_hook(self, state=None, hook=proportional_allreduce_hook)
-        # print("register proportional reduce hook")
-        for param in model.parameters():
-            param.register_hook(functools.partial(self._backward_hook, param))
-        
-
-        # Setup for the scaling_rule, must be after registering backward hooks
-        # because some of them need to register their own backward hooks.
-        if not scaling_rule and (isinstance(optimizer, torch.optim.Adam) or
-                                 isinstance(optimizer, torch.optim.AdamW)):
+        # Time gradient synchronization from the buckets reduced by the
+        # communication hook, from when the first bucket is launched until
+        # the last bucket is reduced.
+        self._comm_hook = comm_hook
+        DistributedDataParallel.register_comm_hook(
+            self, state=comm_state, hook=self._timed_comm_hook)
+        self._final_callback_queued = False
+        self._sync_start = None
+        self._sync_end = None
+        # Whether the current step is a local step, and the number of local
+        # optimizer steps taken since parameters were last averaged.
+        self._local_step = False
+        self._local_count = 0
+
+        if isinstance(optimizer, ZeroRedundancyOptimizer) and \
+                not isinstance(optimizer, ShardedOptimizer):
+            raise ValueError("use ShardedOptimizer instead of "
+                             "ZeroRedundancyOptimizer")
+        local_optimizer = getattr(optimizer, "local_optimizer", optimizer)
+
+        # Setup for the scaling_rule, some of them need to register their own
+        # backward hooks.
+        if not scaling_rule and (
+                isinstance(local_optimizer, torch.optim.Adam) or
+                isinstance(local_optimizer, torch.optim.AdamW)):
             self.scaling_rule = AdamScale()
         else:
             self.scaling_rule = scaling_rule or AdaScale()
 
         if isinstance(scaling_rule, AdamScale):
             self.gns = AdamGradientNoiseScale(self, optimizer,
-                                              mp_scaler=mp_scaler)
+                                              mp_scaler=mp_scaler,
+                                              interval=gns_interval,
+                                              rtol=gns_rtol,
+                                              precond_dtype=gns_precond_dtype)
         else:
-            self.gns = GradientNoiseScale(self, optimizer, mp_scaler=mp_scaler)
+            self.gns = GradientNoiseScale(self, optimizer, mp_scaler=mp_scaler,
+                                          interval=gns_interval,
+                                          rtol=gns_rtol)
         self.scaling_rule.initialize(self, optimizer, patch_optimizer=True)
 
         self._state = _AdaptiveDataParallelState(
-            model, optimizer, lr_scheduler, mp_scaler, name)
+            self, model, optimizer, lr_scheduler, mp_scaler, name,
+            comm_state=comm_state)
         adaptdl.checkpoint.load_state(self._state)
 
-        self._sync_start = None
-
 
     # def _proportional_reduce_hook(process_group: dist.ProcessGroup, bucket: dist.GradBucket)-> torch.futures.Future:
     #     group_to_use = process_group if process_group is not None else dist.group.WORLD
@@ -151,26 +175,86 @@ class AdaptiveDataParallel(DistributedDataParallel):
         # Do not do gradient synchronization during gradient accumulation.
         dataloader = current_dataloader()
         if dataloader is not None and dataloader.training:
+            local_steps = adaptdl.torch.data.local_steps
+            if self._local_count and self._local_count >= local_steps:
+                profile_sync_time(self._average_parameters())
             self.require_backward_grad_sync = dataloader.is_optim_step()
+            self._local_step = local_steps > 1
             # accum_scale = (dataloader.current_local_bsz *
             #                adaptdl.env.num_replicas() / dataloader.batch_size)
             accum_scale = (dataloader.current_local_bsz / \
                            adaptdl.torch.data.data_ratio / dataloader.batch_size)
+            if self._local_step:
+                # Each local step only uses the batch of this replica.
+                accum_scale *= adaptdl.torch.data.data_ratio
+            self.gns.set_local(self._local_step)
             self.gns.set_accum_scale(accum_scale)
-        return super().forward(*args, **kwargs)
+        outputs = super().forward(*args, **kwargs)
+        if torch.is_grad_enabled():
+            # The gradients of the outputs are the first to be computed
+            # during the backward pass, which lets _final_callback be queued
+            # once per backward pass instead of once per parameter.
+            for tensor in _find_grad_tensors(outputs):
+                tensor.register_hook(self._output_hook)
+        return outputs
+
+    @staticmethod
+    def _timestamp(tensor):
+        if tensor.device.type.startswith("cuda"):
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.time()
 
     @adaptdl.utils.print_exc
-    def _backward_hook(self, param, grad):
-        # This method should be invoked once for each parameter during the
-        # backward pass, before gradients are synchronized between replicas.
-        if grad.device.type.startswith("cuda"):
-            self._sync_start = torch.cuda.Event(enable_timing=True)
-            self._sync_start.record()
-        else:
-            self._sync_start = time.time()
+    def _output_hook(self, grad):
+        # This method should be invoked at the start of each backward pass.
+        adaptdl.trace.grad_ready()
         self._final_callback_queued = False
         Variable._execution_engine.queue_callback(self._queue_callback)
-        # print("parallel 3")
+
+    def _timed_comm_hook(self, state, bucket):
+        # Wraps the communication hook to record when the first bucket is
+        # launched and when each bucket is reduced. Buckets are only
+        # reduced during optimizer steps, never during gradient accumulation.
+        if self._local_step:
+            # Keep the local gradients during local steps.
+            fut = torch.futures.Future()
+            fut.set_result(bucket.buffer())
+            return fut
+        if self._sync_start is None:
+            self._sync_start = self._timestamp(bucket.buffer())
+        fut = self._comm_hook(state, bucket)
+
+        def record_end(fut):
+            value = fut.value()
+            end = self._timestamp(value)
+            if isinstance(end, float) and self._sync_end is not None:
+                end = max(end, self._sync_end)
+            self._sync_end = end
+            return value
+
+        return fut.then(record_end)
+
+    def _average_parameters(self):
+        # Average the parameters of all replicas after local steps, weighted
+        # by their shares of the total batch size.
+        params = [param.data for param in self.module.parameters()]
+        flat = _flatten_dense_tensors(params)
+        flat.mul_(adaptdl.torch.data.data_ratio)
+        start = self._timestamp(flat)
+        dist.all_reduce(flat, group=self.process_group)
+        end = self._timestamp(flat)
+        nbytes = flat.numel() * flat.element_size()
+        profile_comm_bytes(nbytes, nbytes)
+        for param, avg in zip(params, _unflatten_dense_tensors(flat, params)):
+            param.copy_(avg)
+        self._local_count = 0
+        # Returns the time spent communicating.
+        if isinstance(start, torch.cuda.Event):
+            end.synchronize()
+            return start.elapsed_time(end) / 1e3
+        return end - start
 
     @adaptdl.utils.print_exc
     def _queue_callback(self):
@@ -183,6 +267,8 @@ class AdaptiveDataParallel(DistributedDataParallel):
         # invoked after the gradient synchronization callback.
         if self._final_callback_queued:
             return
+        # All local gradients have been computed by now.
+        adaptdl.trace.grad_ready()
         self._final_callback_queued = True
         Variable._execution_engine.queue_callback(self._final_callback)
         # print("parallel 1")
@@ -192,19 +278,17 @@ class AdaptiveDataParallel(DistributedDataParallel):
         # This method should be invoked once for each backward pass, after
         # gradients have been synchronized between each replica.
         self._final_callback_queued = False
-        # self._sync_start should mark the last time any local gradient
-        # from this module was produced. We assume the duration until now was
-        # primarily spent waiting for gradient synchronization.
-        # TODO: Depends on the internal behavior of DistributedDataParallel,
-        #       which might break with future versions of PyTorch. Any better
-        #       and well-supported way to measure the synchronization time?
-        if isinstance(self._sync_start, torch.cuda.Event):
-            sync_end = torch.cuda.Event(enable_timing=True)
-            sync_end.record()
-            sync_end.synchronize()
-            profile_sync_time(self._sync_start.elapsed_time(sync_end) / 1e3)
-        else:
-            profile_sync_time(time.time() - self._sync_start)
+        if self._sync_start is not None and self._sync_end is not None:
+            if isinstance(self._sync_start, torch.cuda.Event):
+                self._sync_end.synchronize()
+                profile_sync_time(
+                    self._sync_start.elapsed_time(self._sync_end) / 1e3)
+            else:
+                profile_sync_time(self._sync_end - self._sync_start)
+        self._sync_start = self._sync_end = None
+        if self._local_step and self.require_backward_grad_sync:
+            self._local_count += 1
+        adaptdl.trace.grad_synced()
 
         dataloader = current_dataloader()
         if dataloader is None:
@@ -218,12 +302,14 @@ class AdaptiveDataParallel(DistributedDataParallel):
         self._state.gain = self.gns.gain(scale)
         self._state.lr_factor = \
             np.average(self.scaling_rule.scale_lr(scale))
+        _exporter.GAIN.set(self._state.gain)
+        _exporter.LR_FACTOR.set(self._state.lr_factor)
         update_progress(self.gns.get_progress())
         if dataloader.max_batch_size and \
                 dataloader.max_batch_size > dataloader.batch_size:
             update_grad_params(self._key, self.gns.sqr_avg(),
-                               self.gns.var_avg())
-        self._sync_start = None
+                               self.gns.var_avg(), self.gns.sqr_std(),
+                               self.gns.var_std())
         # print("parallel 2")
         
 
@@ -258,21 +344,77 @@ class AdaptiveDataParallel(DistributedDataParallel):
                           self._state.lr_factor, global_step)
 
 
+def _find_grad_tensors(obj):
+    # Yields the tensors requiring gradients in the output of a module.
+    if isinstance(obj, torch.Tensor):
+        if obj.requires_grad:
+            yield obj
+    elif isinstance(obj, (list, tuple)):
+        for item in obj:
+            yield from _find_grad_tensors(item)
+    elif isinstance(obj, dict):
+        for item in obj.values():
+            yield from _find_grad_tensors(item)
+
+
 class _AdaptiveDataParallelState(adaptdl.checkpoint.State):
-    def __init__(self, model, optimizer, lr_scheduler, mp_scaler,
-                 name="adaptdl-dataparallel"):
+    def __init__(self, adp, model, optimizer, lr_scheduler, mp_scaler,
+                 name="adaptdl-dataparallel", comm_state=None):
         super().__init__(name)
+        self.adp = adp
         self.model = model
         self.optimizer = optimizer
         self.lr_scheduler = lr_scheduler
         self.mp_scaler = mp_scaler
+        # Only checkpointed if it has state, e.g. compression residuals.
+        self.comm_state = comm_state \
+            if hasattr(comm_state, "state_dict") else None
         # TODO: Gain/goodput should be tracked in the metrics module instead.
         self.gain = 1.0
         # lr_factor summary
         self.lr_factor = 1.0
+        # Taken by snapshot_shards, without the tensors saved in shards.
+        self._structure = None
 
     def save(self, fileobj):
-        state_dicts = [self.model.state_dict(), self.optimizer.state_dict()]
+        torch.save(self._checkpoint(), fileobj)
+
+    def snapshot(self):
+        if self._structure is not None:
+            structure, self._structure = self._structure, None
+            return functools.partial(torch.save, structure)
+        # Only copied to host memory here, serialized by the writer thread.
+        return functools.partial(torch.save,
+                                 _copy_to_host(self._checkpoint()))
+
+    def snapshot_shards(self):
+        # The tensors, which should be the same on every replica, are split
+        # evenly by size among all replicas. With a ShardedOptimizer, each
+        # replica also writes the optimizer state of its own shard.
+        rank = adaptdl.env.replica_rank()
+        checkpoint = self._checkpoint(local=True)
+        shards = {}
+        if isinstance(self.optimizer, ShardedOptimizer):
+            optim_shard, = checkpoint[0][1].pop("shards")
+            shards[f"optimizer-{rank}"] = functools.partial(
+                _save_chunked, _copy_to_host(optim_shard))
+        structure, tensors = _extract_tensors(checkpoint)
+        owners = _partition([t.numel() * t.element_size() for t in tensors],
+                            adaptdl.env.num_replicas())
+        owned = {index: tensor for index, tensor in enumerate(tensors)
+                 if owners[index] == rank}
+        shards[f"tensors-{rank}"] = functools.partial(
+            _save_chunked, _copy_to_host(owned))
+        if rank == 0:
+            self._structure = structure
+        return shards
+
+    def _checkpoint(self, local=False):
+        if local and isinstance(self.optimizer, ShardedOptimizer):
+            optimizer_state_dict = self.optimizer.local_state_dict()
+        else:
+            optimizer_state_dict = self.optimizer.state_dict()
+        state_dicts = [self.model.state_dict(), optimizer_state_dict]
 
         if self.lr_scheduler is not None:
             state_dicts.append(self.lr_scheduler.state_dict())
@@ -283,13 +425,171 @@ class _AdaptiveDataParallelState(adaptdl.checkpoint.State):
             state_dicts.append(self.mp_scaler.state_dict())
         else:
             state_dicts.append(None)
-        torch.save((state_dicts, self.gain, self.lr_factor), fileobj)
+
+        if self.comm_state is not None:
+            state_dicts.append(self.comm_state.state_dict())
+        else:
+            state_dicts.append(None)
+        return (state_dicts, self.gain, self.lr_factor)
+
+    def sync(self):
+        if self.adp._local_count:
+            # Replicas diverged after local steps.
+            self.adp._average_parameters()
+        if hasattr(self.optimizer, "sync") and \
+                not adaptdl.checkpoint.saving_shards():
+            # Gather the shards of a ShardedOptimizer, unless each replica
+            # saves its own shard.
+            self.optimizer.sync()
+        if hasattr(self.comm_state, "sync"):
+            self.comm_state.sync()
 
     def load(self, fileobj):
-        state_dicts, self.gain, self.lr_factor = torch.load(fileobj)
+        self._load_checkpoint(_load(fileobj))
+
+    def load_sharded(self, fileobj, shards):
+        structure = _load(fileobj)
+        names = [name for name in shards.names
+                 if name.startswith("tensors-")]
+        optim_names = [name for name in shards.names
+                       if name.startswith("optimizer-")]
+        if optim_names and isinstance(self.optimizer, ShardedOptimizer) \
+                and shards.num_replicas == adaptdl.env.num_replicas():
+            # Partitioned the same way as when saved, only read this shard.
+            optim_names = [f"optimizer-{adaptdl.env.replica_rank()}"]
+        files = shards.read(names + optim_names)
+        tensors = {}
+        for name in names:
+            tensors.update(_load_chunked(files[name], shards))
+        checkpoint = _insert_tensors(structure, tensors)
+        if optim_names:
+            optim_shards = [_load_chunked(files[name], shards)
+                            for name in optim_names]
+            optimizer_state_dict = checkpoint[0][1]
+            if isinstance(self.optimizer, ShardedOptimizer):
+                optimizer_state_dict["shards"] = optim_shards
+            else:
+                for optim_shard in optim_shards:
+                    optimizer_state_dict["state"].update(optim_shard)
+        self._load_checkpoint(checkpoint)
+
+    def _load_checkpoint(self, checkpoint):
+        state_dicts, self.gain, self.lr_factor = checkpoint
         self.model.load_state_dict(state_dicts[0])
         self.optimizer.load_state_dict(state_dicts[1])
         if state_dicts[2] is not None:
             self.lr_scheduler.load_state_dict(state_dicts[2])
         if state_dicts[3] is not None:
             self.mp_scaler.load_state_dict(state_dicts[3])
+        if state_dicts[4] is not None and self.comm_state is not None:
+            self.comm_state.load_state_dict(state_dicts[4])
+
+
+def _load(fileobj):
+    # Memory-maps the tensors if loading from the saved file itself, so that
+    # they are only read from storage as load_state_dict copies them. The
+    # optimizer state includes the gradient noise scale estimates, which are
+    # numpy arrays.
+    path = getattr(fileobj, "name", None)
+    if isinstance(path, str) and os.path.isfile(path):
+        try:
+            return torch.load(path, mmap=True, weights_only=False)
+        except TypeError:
+            pass  # Before torch 2.1, which added mmap.
+        except RuntimeError:
+            pass  # E.g. saved in the legacy format, which cannot be mapped.
+    return torch.load(fileobj, weights_only=False)
+
+
+def _find(obj, match, path=()):
+    # Yields the (path, leaf) of each matching leaf in nested containers.
+    if isinstance(obj, dict):
+        for key, val in obj.items():
+            yield from _find(val, match, path + (key,))
+    elif isinstance(obj, (list, tuple)):
+        for index, val in enumerate(obj):
+            yield from _find(val, match, path + (index,))
+    elif match(obj):
+        yield path, obj
+
+
+def _copy_to_host(obj):
+    # Deep copy of obj with its tensors copied to host memory, which is pinned
+    # for tensors on GPUs so that they can all be copied asynchronously.
+    memo = {}
+    for _, tensor in _find(obj, torch.is_tensor):
+        if id(tensor) not in memo and tensor.layout == torch.strided:
+            host = torch.empty(tensor.shape, dtype=tensor.dtype,
+                               pin_memory=tensor.is_cuda)
+            memo[id(tensor)] = host.copy_(tensor.detach(),
+                                          non_blocking=tensor.is_cuda)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    # Keeps everything else, such as the metadata of module state dicts.
+    return copy.deepcopy(obj, memo)
+
+
+class _ShardedTensor(object):
+    # Placeholder for a tensor saved in a checkpoint shard.
+    __slots__ = ("index",)
+
+    def __init__(self, index):
+        self.index = index
+
+
+def _extract_tensors(obj, match=torch.is_tensor):
+    # Returns a deep copy of obj with its tensors replaced by placeholders,
+    # and the tensors. Tensors are ordered by their paths in obj, which are
+    # the same on every replica even if the insertion order of dicts is not.
+    memo, tensors = {}, []
+    for _, tensor in sorted(_find(obj, match),
+                            key=lambda item: repr(item[0])):
+        if id(tensor) not in memo:
+            memo[id(tensor)] = _ShardedTensor(len(tensors))
+            tensors.append(tensor)
+    return copy.deepcopy(obj, memo), tensors
+
+
+def _insert_tensors(obj, tensors):
+    # Inverse of _extract_tensors, given the tensors by index.
+    memo = {id(placeholder): tensors[placeholder.index] for _, placeholder
+            in _find(obj, lambda val: isinstance(val, _ShardedTensor))}
+    return copy.deepcopy(obj, memo)
+
+
+def _save_chunked(obj, fileobj):
+    # Saves obj with the contents of its tensors, which must be in host
+    # memory, in the chunk store of the checkpoint, so that tensors which did
+    # not change since the last checkpoint are not written again.
+    structure, tensors = _extract_tensors(
+        obj, lambda val: torch.is_tensor(val) and val.layout == torch.strided)
+    metadata = []
+    for tensor in tensors:
+        data = tensor.detach().contiguous().reshape(-1).view(torch.uint8)
+        metadata.append((tensor.dtype, tensor.shape,
+                         adaptdl.checkpoint.write_chunks(data.numpy())))
+    torch.save((structure, metadata), fileobj)
+
+
+def _load_chunked(fileobj, shards):
+    # Inverse of _save_chunked.
+    structure, metadata = torch.load(fileobj, weights_only=False)
+    tensors = []
+    for dtype, shape, chunks in metadata:
+        data = shards.read_chunks(chunks)
+        if data:
+            tensors.append(torch.frombuffer(data, dtype=dtype).reshape(shape))
+        else:
+            tensors.append(torch.empty(shape, dtype=dtype))
+    return _insert_tensors(structure, tensors)
+
+
+def _partition(sizes, num_parts):
+    # Assigns each size to a part, largest first to the smallest part.
+    owners = [0] * len(sizes)
+    totals = [0] * num_parts
+    for index in sorted(range(len(sizes)), key=lambda i: -sizes[i]):
+        part = totals.index(min(totals))
+        owners[index] = part
+        totals[part] += sizes[index]
+    return owners
@@ -14,10 +14,12 @@
 
 
 import numpy as np
+import pytest
 import torch
 
 from torch.utils.data import Dataset
 import adaptdl.torch as adl
+from adaptdl.conftest import elastic_multiprocessing
 
 
 class LRIterableDataset(Dataset):
@@ -37,6 +39,188 @@ class LRIterableDataset(Dataset):
         return self._len
 
 
+@elastic_multiprocessing
+def test_bucket_sync_time():
+    import adaptdl.torch._metrics as metrics
+    adl.init_process_group("gloo")
+    dataset = LRIterableDataset(256, np.asarray([3.0, 4.0]), 1.0)
+    dataloader = adl.HeteroDataLoader(dataset, batch_size=32)
+    model = torch.nn.Sequential(torch.nn.Linear(1, 8), torch.nn.Linear(8, 1))
+    sgd = torch.optim.SGD(model.parameters(), lr=0.001)
+    model = adl.AdaptiveDataParallel(model, sgd, bucket_cap_mb=1e-6)
+    for inputs, targets in dataloader:
+        output = model(torch.reshape(inputs.float(), (-1, 1)))
+        loss = torch.nn.functional.mse_loss(output.flatten(), targets.float())
+        loss.backward()
+        sgd.step()
+    # Timed from the first bucket to the last, and included in step time.
+    profile = metrics._metrics_state().profile
+    assert profile
+    for value in profile.values():
+        assert value["optim_count"] > 0
+        assert 0 < value["optim_sync_time"] <= value["optim_step_time"]
+
+
+@elastic_multiprocessing
+def test_local_sgd():
+    import torch.distributed as dist
+    import adaptdl.env
+    import adaptdl.torch.data
+    if adaptdl.env.num_restarts() == 0:
+        return 2
+    adl.init_process_group("gloo")
+    torch.manual_seed(0)
+    dataset = LRIterableDataset(256, np.asarray([3.0, 4.0]), 1.0)
+    dataloader = adl.HeteroDataLoader(dataset, batch_size=32, shuffle=True)
+    model = torch.nn.Linear(1, 1)
+    sgd = torch.optim.SGD(model.parameters(), lr=0.01)
+    model = adl.AdaptiveDataParallel(model, sgd)
+    num_averages = 0
+    for inputs, targets in dataloader:
+        # Normally chosen by the data loader together with the batch size.
+        adaptdl.torch.data.local_steps = 2
+        local_count = model._local_count
+        params = torch.cat([p.detach().flatten()
+                            for p in model.module.parameters()])
+        expected = params * adaptdl.torch.data.data_ratio
+        dist.all_reduce(expected)
+        output = model(torch.reshape(inputs.float(), (-1, 1)))
+        params = torch.cat([p.detach().flatten()
+                            for p in model.module.parameters()])
+        gathered = [torch.zeros_like(params) for _ in range(2)]
+        dist.all_gather(gathered, params)
+        if local_count == 2:
+            # Averaged, weighted by the data shares, after two local steps.
+            assert torch.allclose(params, expected)
+            assert model._local_count == 0
+            num_averages += 1
+        elif local_count == 1:
+            assert not torch.allclose(gathered[0], gathered[1])
+        loss = torch.nn.functional.mse_loss(output.flatten(), targets.float())
+        loss.backward()
+        sgd.step()
+    assert num_averages > 0
+    # Parameters are averaged before saving a checkpoint.
+    model._state.sync()
+    assert model._local_count == 0
+
+
+@elastic_multiprocessing
+def test_sharded_optimizer():
+    import adaptdl.checkpoint
+    import adaptdl.env
+    from adaptdl.torch.sharded_optimizer import ShardedOptimizer
+    if adaptdl.env.num_restarts() == 0:
+        return 2
+    adl.init_process_group("gloo")
+    torch.manual_seed(0)
+    dataset = LRIterableDataset(128, np.asarray([3.0, 4.0]), 1.0)
+    dataloader = adl.HeteroDataLoader(dataset, batch_size=32)
+    model = torch.nn.Linear(1, 1)
+    adam = ShardedOptimizer(model.parameters(), torch.optim.Adam, lr=0.01)
+    model = adl.AdaptiveDataParallel(model, adam)
+    if adaptdl.env.num_restarts() == 2:
+        # Restored from two shards into three.
+        assert adam.state["gns"]["progress"] > 0
+        assert len(adam.local_optimizer.state) <= 1
+        return 0
+    for inputs, targets in dataloader:
+        output = model(torch.reshape(inputs.float(), (-1, 1)))
+        loss = torch.nn.functional.mse_loss(output.flatten(), targets.float())
+        loss.backward()
+        adam.step()
+    assert len(adam.local_optimizer.state) == 1
+    adaptdl.checkpoint.save_all_states()
+    # Each replica saved its own shard, none were gathered to rank 0.
+    assert not adam._all_state_dicts
+    return 3
+
+
+@elastic_multiprocessing
+def test_sharded_checkpoint():
+    import json
+    import os
+    import torch.distributed as dist
+    import adaptdl.checkpoint
+    import adaptdl.env
+    if adaptdl.env.num_restarts() == 0:
+        return 2
+    adl.init_process_group("gloo")
+    torch.manual_seed(0)
+    dataset = LRIterableDataset(128, np.asarray([3.0, 4.0]), 1.0)
+    dataloader = adl.HeteroDataLoader(dataset, batch_size=32)
+    model = torch.nn.Sequential(torch.nn.Linear(1, 8), torch.nn.Linear(8, 1))
+    adam = torch.optim.Adam(model.parameters(), lr=0.01)
+    model = adl.AdaptiveDataParallel(model, adam)
+    expected_path = os.path.join(adaptdl.env.checkpoint_path(), "expected")
+    if adaptdl.env.num_restarts() == 2:
+        # Each tensor was saved by one of the replicas, which may have
+        # drifted apart slightly, but all of them restore the same values.
+        expected = torch.load(expected_path)
+        params = torch.cat([p.detach().flatten()
+                            for p in model.module.parameters()])
+        gathered = [torch.zeros_like(params) for _ in range(2)]
+        dist.all_gather(gathered, params)
+        assert torch.equal(gathered[0], gathered[1])
+        for key, val in model.module.state_dict().items():
+            assert torch.allclose(val, expected["model"][key], atol=1e-3)
+        for param, val in zip(model.module.parameters(), expected["exp_avg"]):
+            assert torch.allclose(adam.state[param]["exp_avg"], val,
+                                  atol=1e-3)
+        return 0
+    for inputs, targets in dataloader:
+        output = model(torch.reshape(inputs.float(), (-1, 1)))
+        loss = torch.nn.functional.mse_loss(output.flatten(), targets.float())
+        loss.backward()
+        adam.step()
+    adaptdl.checkpoint.save_all_states()
+    if adaptdl.env.replica_rank() == 0:
+        ckpt_dir = os.path.join(adaptdl.env.checkpoint_path(), "checkpoint-1")
+        with open(os.path.join(ckpt_dir, "_manifest")) as f:
+            manifest = json.load(f)
+        # The tensors were written by both replicas.
+        assert sorted(manifest["shards"]["adaptdl-dataparallel"]) == \
+            ["tensors-0", "tensors-1"]
+        for name in manifest["shards"]["adaptdl-dataparallel"]:
+            assert os.path.getsize(
+                os.path.join(ckpt_dir, "adaptdl-dataparallel." + name)) > 0
+        torch.save({"model": model.module.state_dict(),
+                    "exp_avg": [adam.state[param]["exp_avg"] for param in
+                                model.module.parameters()]}, expected_path)
+    return 2
+
+
+@pytest.mark.parametrize("zipfile", [True, False])
+def test_load_mapped(tmp_path, zipfile):
+    from adaptdl.torch.parallel import _load
+    path = tmp_path / "state"
+    expected = ({"weight": torch.randn(4, 3)}, np.ones(2))
+    torch.save(expected, path, _use_new_zipfile_serialization=zipfile)
+    # Legacy files cannot be memory-mapped, and are read instead.
+    with open(path, "rb") as f:
+        loaded = _load(f)
+    assert torch.equal(loaded[0]["weight"], expected[0]["weight"])
+    assert np.array_equal(loaded[1], expected[1])
+
+
+def test_load_without_mmap(tmp_path, monkeypatch):
+    from adaptdl.torch.parallel import _load
+    path = tmp_path / "state"
+    expected = {"weight": torch.randn(4, 3)}
+    torch.save(expected, path)
+    load = torch.load
+
+    def old_load(*args, **kwargs):
+        # Versions of torch before mmap was added.
+        if "mmap" in kwargs:
+            raise TypeError("unexpected keyword argument 'mmap'")
+        return load(*args, **kwargs)
+
+    monkeypatch.setattr(torch, "load", old_load)
+    with open(path, "rb") as f:
+        assert torch.equal(_load(f)["weight"], expected["weight"])
+
+
 def test_single_replica_parallel():
     adl.init_process_group("gloo")
     true_values = np.asarray([3.0, 4.0])
@@ -0,0 +1,152 @@
+# Copyright 2020 Petuum, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Optimizer which shards its state across replicas, for use with
+:class:`adaptdl.torch.AdaptiveDataParallel`.
+"""
+
+import torch
+from torch.distributed.optim import ZeroRedundancyOptimizer
+
+from adaptdl.torch._metrics import profile_freed_memory
+
+__all__ = ["ShardedOptimizer"]
+
+
+class ShardedOptimizer(ZeroRedundancyOptimizer):
+    """
+    Wraps an optimizer so that each replica only keeps the optimizer state
+    (e.g. the Adam moments) of roughly 1/N of the parameters, as in ZeRO
+    stage 1 (https://arxiv.org/abs/1910.02054). Each replica updates its own
+    shard of the parameters, which are then broadcast to the other replicas.
+
+    When saved with ``AdaptiveDataParallel``, the state of every shard is
+    gathered and saved separately, and partitioned among the new replicas
+    after restarting, which may be a different number of replicas. The memory
+    freed by sharding lets the adaptive batch size use larger local batch
+    sizes than the ``local_bsz_bounds`` given to ``autoscale_batch_size``.
+
+    Since each replica only has the Adam moments of its own shard, the
+    gradient noise scale is measured without preconditioning them.
+
+    Arguments:
+        params (iterable): Parameters to optimize.
+        optimizer_class (type): Class of the local optimizer of each shard,
+            e.g. ``torch.optim.Adam``.
+        process_group (ProcessGroup): Process group to shard across, defaults
+            to all replicas.
+        **defaults: Arguments passed to ``optimizer_class``.
+    """
+    def __init__(self, params, optimizer_class, process_group=None,
+                 **defaults):
+        super().__init__(params, optimizer_class,
+                         process_group=process_group, **defaults)
+        self._freed_memory = None
+
+    @property
+    def local_optimizer(self):
+        """
+        The optimizer of the parameters in the shard of this replica.
+        """
+        return self.optim
+
+    def step(self, *args, **kwargs):
+        loss = super().step(*args, **kwargs)
+        if self._freed_memory is None:
+            # The state is allocated on the first step, and keeps its size.
+            self._freed_memory = self._estimate_freed_memory()
+            profile_freed_memory(self._freed_memory)
+        return loss
+
+    def _estimate_freed_memory(self):
+        # Bytes of optimizer state this replica would keep for the shards of
+        # the other replicas, extrapolated from its own shard.
+        state_bytes = owned_numel = 0
+        for param, state in self.optim.state.items():
+            owned_numel += param.numel()
+            state_bytes += sum(val.numel() * val.element_size()
+                               for val in state.values()
+                               if torch.is_tensor(val) and val.dim() > 0)
+        if not owned_numel:
+            return 0
+        total_numel = sum(param.numel() for param in self._index_to_param)
+        return state_bytes * (total_numel - owned_numel) // owned_numel
+
+    def sync(self):
+        """
+        Gather the state of every shard to rank 0 to be saved, must be called
+        on all replicas.
+        """
+        self.consolidate_state_dict(to=0)
+
+    def state_dict(self):
+        """
+        Returns the state of each shard, which is only available on rank 0
+        after :meth:`sync`. Parameters are indexed as in a regular optimizer
+        state dict.
+        """
+        if not self._all_state_dicts:
+            raise RuntimeError("optimizer state was not gathered, call sync "
+                               "on all replicas first")
+        return self._state_dict([self._shard(rank, local) for rank, local
+                                 in enumerate(self._all_state_dicts)])
+
+    def local_state_dict(self):
+        """
+        Returns the state of the shard of this replica only, in the same
+        format as :meth:`state_dict`, without gathering any state.
+        """
+        return self._state_dict([self._shard(self.rank,
+                                             self.optim.state_dict())])
+
+    def _state_dict(self, shards):
+        state_dict = torch.optim.Optimizer.state_dict(self)
+        # Only state which does not belong to any parameter, such as the
+        # gradient noise scale, is kept by the wrapper itself.
+        extra = {key: val for key, val in state_dict["state"].items()
+                 if not isinstance(key, int)}
+        return {"state": extra, "shards": shards,
+                "param_groups": state_dict["param_groups"]}
+
+    def _shard(self, rank, local):
+        # Re-indexes the local state dict of a rank by global parameter index.
+        shard = {}
+        groups = self._partition_parameters()[rank]
+        for local_group, group in zip(local["param_groups"], groups):
+            for index, param in zip(local_group["params"], group["params"]):
+                if index in local["state"]:
+                    shard[self._param_to_index[param]] = local["state"][index]
+        return shard
+
+    def load_state_dict(self, state_dict):
+        """
+        Loads the state of the parameters in the shard of this replica. The
+        parameters are partitioned among the current replicas, regardless of
+        how many replicas saved ``state_dict``. Also accepts the state dict of
+        a regular optimizer.
+        """
+        state = dict(state_dict["state"])
+        for shard in state_dict.get("shards", ()):
+            state.update(shard)
+        extra = {key: state.pop(key) for key in list(state)
+                 if not isinstance(key, int)}
+        super().load_state_dict({"state": state,
+                                 "param_groups": state_dict["param_groups"]})
+        # The local optimizer holds the state of this shard, do not keep a
+        # second copy in the wrapper.
+        self.state.clear()
+        self.state.update(extra)
+        self._freed_memory = None
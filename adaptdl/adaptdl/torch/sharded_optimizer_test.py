@@ -0,0 +1,72 @@
+import os
+
+import torch
+
+from adaptdl.conftest import elastic_multiprocessing
+
+
+@elastic_multiprocessing
+def test_reshard():
+    import adaptdl.checkpoint
+    import adaptdl.collective
+    import adaptdl.env
+    import adaptdl.torch as adl
+    from adaptdl.torch.sharded_optimizer import ShardedOptimizer
+    adl.init_process_group("gloo")
+    rank = adaptdl.env.replica_rank()
+
+    class TestState(adaptdl.checkpoint.State):
+        def sync(self):
+            self.optimizer.sync()
+
+        def save(self, fileobj):
+            torch.save(self.optimizer.state_dict(), fileobj)
+
+        def load(self, fileobj):
+            self.optimizer.load_state_dict(torch.load(fileobj))
+
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Linear(4, 8), torch.nn.Linear(8, 8),
+                                torch.nn.Linear(8, 2))
+    optimizer = ShardedOptimizer(model.parameters(), torch.optim.Adam,
+                                 lr=0.1)
+    optimizer.state["extra"] = 0
+    state = TestState("sharded")
+    state.optimizer = optimizer
+    adaptdl.checkpoint.load_state(state)
+    expected_path = os.path.join(adaptdl.env.checkpoint_path(), "expected")
+    if adaptdl.env.num_restarts() == 2:
+        expected = torch.load(expected_path)
+        params = list(model.parameters())
+        owned = 0
+        for index, param in enumerate(params):
+            if optimizer._param_to_rank[param] == rank:
+                owned += 1
+                for key, val in expected[index].items():
+                    assert torch.equal(optimizer.local_optimizer.state[param]
+                                       [key], val)
+            else:
+                assert param not in optimizer.local_optimizer.state
+        # Every parameter is in exactly one shard.
+        assert adaptdl.collective.allreduce(owned) == len(params)
+        assert dict(optimizer.state) == {"extra": 2}
+        return 0
+    for _ in range(3):
+        model(torch.ones(2, 4)).sum().backward()
+        optimizer.step()
+        optimizer.zero_grad()
+    optimizer.state["extra"] += 1
+    if adaptdl.env.num_replicas() > 1:
+        # Only the state of its own shard is kept.
+        num_params = len(list(model.parameters()))
+        assert 0 < len(optimizer.local_optimizer.state) < num_params
+        assert optimizer._freed_memory > 0
+    adaptdl.checkpoint.save_all_states()
+    if rank == 0:
+        state_dict = optimizer.state_dict()
+        assert len(state_dict["shards"]) == adaptdl.env.num_replicas()
+        expected = {}
+        for shard in state_dict["shards"]:
+            expected.update(shard)
+        torch.save(expected, expected_path)
+    return [3, 2][adaptdl.env.num_restarts()]
@@ -0,0 +1,276 @@
+# Copyright 2020 Petuum, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+This module records a timeline of each training step (data loading, forward,
+backward, gradient synchronization, optimizer) and of the collective
+operations on every replica. The timelines of all replicas can be merged onto
+a shared time axis and written as a Chrome trace, which can be opened in
+``chrome://tracing`` or https://ui.perfetto.dev to find straggling replicas.
+
+Tracing is disabled unless the environment variable ``ADAPTDL_TRACE_EVENTS``
+is set to the number of events each replica should keep, or `enable` is
+called. Only the most recent events are kept. A trace is written when `dump`
+is invoked by all replicas, or at the next training step after `request_dump`
+is called or ``SIGUSR1`` is sent to any replica.
+
+All timestamps are taken on the host, so on GPUs the phases reflect when the
+host launched the work, except for the synchronization phase which waits for
+the device to finish.
+"""
+
+import collections
+import contextlib
+import json
+import logging
+import os
+import signal
+import statistics
+import time
+
+import adaptdl.collective
+import adaptdl.env
+
+logging.basicConfig(level=logging.INFO)
+LOG = logging.getLogger(__name__)
+LOG.setLevel(logging.INFO)
+
+STEP_TID = 0
+COLLECTIVE_TID = 1
+_THREAD_NAMES = {STEP_TID: "step", COLLECTIVE_TID: "collective"}
+
+_EVENTS = None  # Ring buffer of (name, cat, start, end, tid, args).
+_DUMP_FLAG = False
+_NUM_DUMPS = 0
+# State of the current training step, see step_start and grad_synced.
+_STEP_START = None
+_STEP_ARGS = None
+_STEP_END = None
+_CURSOR = None
+_GRAD_FIRST = None
+_GRAD_LAST = None
+_SYNCED = False
+
+
+def enable(max_events=10000):
+    """
+    Start recording events on the current replica, keeping at most
+    ``max_events`` of the most recent events.
+
+    Arguments:
+        max_events (int): Size of the trace buffer.
+    """
+    global _EVENTS
+    events = collections.deque(maxlen=max_events)
+    if _EVENTS is not None:
+        events.extend(_EVENTS)
+    _EVENTS = events
+    try:
+        signal.signal(signal.SIGUSR1, _handler)
+    except ValueError:  # Not invoked from the main thread.
+        LOG.warning("could not install SIGUSR1 handler for tracing")
+
+
+def disable():
+    """
+    Stop recording events on the current replica and discard the trace buffer.
+    """
+    global _EVENTS
+    _EVENTS = None
+
+
+def enabled():
+    """
+    Returns:
+        bool: Whether events are being recorded on the current replica.
+    """
+    return _EVENTS is not None
+
+
+def request_dump():
+    """
+    Request a trace to be written. The request is synchronized with the other
+    replicas, and the trace is written at the start of the next training step
+    on all replicas. Safe to call from signal handlers.
+    """
+    global _DUMP_FLAG
+    _DUMP_FLAG = True
+
+
+def get_dump_flag():
+    return _DUMP_FLAG
+
+
+def complete(name, cat, start, end, tid=STEP_TID, args=None):
+    """
+    Record an event which started at time ``start`` and ended at time
+    ``end``, both as returned by ``time.time()``.
+    """
+    if _EVENTS is not None:
+        _EVENTS.append((name, cat, start, end, tid, args))
+
+
+@contextlib.contextmanager
+def span(name, cat, tid=STEP_TID, args=None):
+    """
+    Record an event spanning the execution of this context.
+    """
+    if _EVENTS is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        complete(name, cat, start, time.time(), tid, args)
+
+
+def step_start(**args):
+    """
+    Mark the start of a training step, the time since the end of the previous
+    step is recorded as waiting for data.
+    """
+    global _STEP_START, _STEP_ARGS, _CURSOR, _GRAD_FIRST, _SYNCED
+    if _EVENTS is None:
+        return
+    now = time.time()
+    if _STEP_END is not None:
+        complete("data", "data", _STEP_END, now)
+    _STEP_START = _CURSOR = now
+    _GRAD_FIRST = None
+    _SYNCED = False
+    _STEP_ARGS = args or None
+
+
+def grad_ready():
+    """
+    Mark that a local gradient was produced during the backward pass.
+    """
+    global _GRAD_FIRST, _GRAD_LAST
+    if _EVENTS is None:
+        return
+    now = time.time()
+    if _GRAD_FIRST is None:
+        _GRAD_FIRST = now
+    _GRAD_LAST = now
+
+
+def grad_synced():
+    """
+    Mark the end of a backward pass, after gradients were synchronized.
+    """
+    global _CURSOR, _GRAD_FIRST, _SYNCED
+    if _EVENTS is None or _GRAD_FIRST is None:
+        return
+    now = time.time()
+    if _CURSOR is not None:
+        complete("forward", "compute", _CURSOR, _GRAD_FIRST)
+    complete("backward", "compute", _GRAD_FIRST, _GRAD_LAST)
+    complete("sync", "comm", _GRAD_LAST, now)
+    _CURSOR = now
+    _GRAD_FIRST = None
+    _SYNCED = True
+
+
+def step_end():
+    """
+    Mark the end of a training step.
+    """
+    global _STEP_START, _STEP_END, _CURSOR
+    if _EVENTS is None or _STEP_START is None:
+        return
+    now = time.time()
+    if _SYNCED:
+        complete("optimizer", "compute", _CURSOR, now)
+    complete("step", "step", _STEP_START, now, args=_STEP_ARGS)
+    _STEP_START = _CURSOR = None
+    _STEP_END = now
+
+
+def _clock_offsets(rounds=5):
+    # All replicas are released from a collective operation at nearly the
+    # same instant, so the local times taken right after one approximate the
+    # same moment. They are gathered in the next collective operation, and
+    # the median over several rounds is used as the offset from rank 0.
+    samples = []
+    prev = None
+    for _ in range(rounds + 1):
+        gathered = adaptdl.collective.allreduce([prev], lambda a, b: a + b)
+        prev = time.time()
+        if gathered[0] is not None:
+            samples.append([t - gathered[0] for t in gathered])
+    return [statistics.median(col) for col in zip(*samples)]
+
+
+def _trace_path():
+    path = adaptdl.env.checkpoint_path() or adaptdl.env.share_path() or "."
+    return os.path.join(path, "trace-{}-{}.json".format(
+        adaptdl.env.num_restarts(), _NUM_DUMPS))
+
+
+def _chrome_events(rank, events, offset):
+    trace = [{"name": "process_name", "ph": "M", "pid": rank,
+              "args": {"name": "replica {}".format(rank)}}]
+    for tid, name in _THREAD_NAMES.items():
+        trace.append({"name": "thread_name", "ph": "M", "pid": rank,
+                      "tid": tid, "args": {"name": name}})
+    for name, cat, start, end, tid, args in events:
+        event = {"name": name, "cat": cat, "ph": "X", "pid": rank,
+                 "tid": tid, "ts": (start - offset) * 1e6,
+                 "dur": (end - start) * 1e6}
+        if args:
+            event["args"] = args
+        trace.append(event)
+    return trace
+
+
+def dump(path=None):
+    """
+    Merge the events recorded by all replicas onto the clock of rank 0 and
+    write them as a Chrome trace. Must be invoked by all replicas, blocks
+    until it has been invoked by all replicas.
+
+    Arguments:
+        path (str): File to write the trace to, defaults to a new file in the
+            checkpoint path, or the share path if unset.
+
+    Returns:
+        str: Path of the written trace on rank 0, ``None`` on other replicas.
+    """
+    global _DUMP_FLAG, _NUM_DUMPS
+    _DUMP_FLAG = False
+    offsets = _clock_offsets()
+    events = list(_EVENTS or ())
+    rank = adaptdl.env.replica_rank()
+    trace = _chrome_events(rank, events, offsets[rank])
+    trace = adaptdl.collective.allreduce(trace, lambda a, b: a + b)
+    _NUM_DUMPS += 1
+    if rank != 0:
+        return None
+    path = path or _trace_path()
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+    os.rename(tmp_path, path)
+    LOG.info("wrote trace of %s replicas to %s", len(offsets), path)
+    return path
+
+
+def _handler(signum, frame):
+    request_dump()
+
+
+if adaptdl.env.trace_events():
+    enable(adaptdl.env.trace_events())
@@ -0,0 +1,68 @@
+import json
+import os
+import time
+
+from adaptdl.conftest import elastic_multiprocessing
+
+
+def test_step_events():
+    import adaptdl.trace
+    adaptdl.trace.enable(max_events=8)
+    try:
+        for _ in range(3):
+            adaptdl.trace.step_start(atomic_bsz=4)
+            adaptdl.trace.grad_ready()
+            adaptdl.trace.grad_ready()
+            adaptdl.trace.grad_synced()
+            adaptdl.trace.step_end()
+        events = list(adaptdl.trace._EVENTS)
+        # Ring buffer only keeps the most recent events.
+        assert len(events) == 8
+        names = [event[0] for event in events]
+        assert names[-6:] == ["data", "forward", "backward", "sync",
+                              "optimizer", "step"]
+        assert events[-1][5] == {"atomic_bsz": 4}
+        for name, cat, start, end, tid, args in events:
+            assert start <= end
+    finally:
+        adaptdl.trace.disable()
+
+
+def test_disabled():
+    import adaptdl.trace
+    adaptdl.trace.disable()
+    adaptdl.trace.step_start()
+    with adaptdl.trace.span("allreduce", "collective"):
+        pass
+    adaptdl.trace.step_end()
+    assert not adaptdl.trace.enabled()
+
+
+@elastic_multiprocessing
+def test_dump(tmpdir):
+    import adaptdl.collective
+    import adaptdl.env
+    import adaptdl.trace
+    # Discard any reducer inherited from other tests in the parent process.
+    adaptdl.collective._REDUCER = None
+    adaptdl.collective.initialize("0.0.0.0")
+    adaptdl.trace.enable()
+    rank = adaptdl.env.replica_rank()
+    adaptdl.trace.step_start()
+    time.sleep(0.01 * (rank + 1))
+    adaptdl.trace.step_end()
+    path = adaptdl.trace.dump(os.path.join(tmpdir, "trace.json"))
+    if rank == 0:
+        with open(path) as f:
+            trace = json.load(f)["traceEvents"]
+        steps = [event for event in trace if event["name"] == "step"]
+        assert sorted(event["pid"] for event in steps) == \
+            list(range(adaptdl.env.num_replicas()))
+        collectives = [event for event in trace
+                       if event.get("cat") == "collective"]
+        assert collectives
+        for event in steps:
+            assert event["dur"] >= 1e4 * (event["pid"] + 1)
+    else:
+        assert path is None
+    return [5, 0][adaptdl.env.num_restarts()]